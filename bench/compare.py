@@ -0,0 +1,68 @@
+#  Copyright 2014 Accuen
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""
+compare two result files from bench/export.py or bench/templates.py
+
+Prints the throughput of each configuration in both runs and the ratio
+new/old, and exits non-zero if any configuration slowed down by more
+than --max-slowdown.
+
+    python bench/compare.py OLD_JSON NEW_JSON [--max-slowdown FRACTION]
+"""
+import json
+import argparse
+
+
+# benchmark -> (function returning a result's label, throughput field)
+BENCHMARKS = {
+    "export": (lambda r: r["format"] if r["level"] is None else "%s:%d" % (r["format"], r["level"]),
+               "rows_per_second"),
+    "templates": (lambda r: r["engine"], "renders_per_second"),
+}
+
+
+def load(filenm):
+    with open(filenm) as fp:
+        return json.load(fp)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="compare rqt benchmark results")
+    parser.add_argument("old")
+    parser.add_argument("new")
+    parser.add_argument("--max-slowdown", type=float, default=None,
+                        help="fail if throughput drops by more than FRACTION (e.g. 0.1)")
+    args = parser.parse_args()
+
+    old, new = load(args.old), load(args.new)
+    if old["benchmark"] != new["benchmark"]:
+        raise SystemExit, "can't compare %s results with %s results" % (old["benchmark"], new["benchmark"])
+    label, field = BENCHMARKS[new["benchmark"]]
+    old_results = dict((label(r), r) for r in old["results"] if "error" not in r)
+    failed = False
+    for r in new["results"]:
+        if "error" in r or label(r) not in old_results:
+            continue
+        before, after = old_results[label(r)][field], r[field]
+        ratio = after / before
+        print "%-14s %s: %.0f -> %.0f (%.2fx)" % (label(r), field, before, after, ratio)
+        if args.max_slowdown is not None and ratio < 1 - args.max_slowdown:
+            failed = True
+    raise SystemExit, 1 if failed else 0
+
+
+if __name__ == "__main__":
+    main()
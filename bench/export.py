@@ -0,0 +1,154 @@
+#  Copyright 2014 Accuen
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""
+export benchmark for rqt
+
+Writes a synthetic result set through the same fetch/convert/write path
+as run-query, once per output format and compression level, and reports
+rows/s, MB/s and peak RSS for each.  Each configuration runs in a fresh
+interpreter so the peak RSS numbers don't bleed into each other.
+
+    python bench/export.py [--rows N] [--columns KIND,...] [--string-width N]
+                           [--null-ratio R] [--formats EXT,...] [--levels N,...]
+                           [--workers N] [--compress-threads N] [--json OUT_FILE]
+
+KIND is one of int, numeric, float, text, timestamp, date, bool.  Levels
+only apply to compressed formats; the other formats run once.  A format
+whose optional dependency isn't installed is reported as an error.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import subprocess
+
+
+BENCH_DIRNM = os.path.dirname(os.path.abspath(__file__))
+LIB_DIRNM = os.path.join(BENCH_DIRNM, "..", "lib")
+
+DEFAULT_COLUMNS = "int,numeric,float,text,text,timestamp,date,bool"
+DEFAULT_FORMATS = "csv,csv.gz,txt.gz,jsonl,jsonl.gz,csv.zst,csv.lz4,parquet"
+DEFAULT_LEVELS = "1,6"
+
+
+def run_child(config):
+    """
+    export once per config in this process and print the result as JSON
+    """
+    sys.path.insert(0, LIB_DIRNM)
+    sys.path.insert(0, BENCH_DIRNM)
+    from rqt import actions
+    from rqt import compress
+    import synthetic
+
+    cs = synthetic.SyntheticCursor(config["columns"], config["rows"], config["string_width"],
+                                   config["null_ratio"])
+    tmp_dirnm = tempfile.mkdtemp(prefix="rqt-bench-")
+    out_filenm = os.path.join(tmp_dirnm, "out." + config["format"])
+    writer_options = {"workers": config["workers"]}
+    if compress.split_codec(out_filenm)[1] is not None:
+        writer_options["compress_level"] = config["level"]
+        writer_options["compress_threads"] = config["compress_threads"]
+    run_log = {"timing": {}}
+    try:
+        t0 = time.time()
+        batches = actions._iter_batches(cs, config["fetch_size"], run_log)
+        actions._step2(cs, batches, out_filenm, run_log, writer_options)
+        elapsed = time.time() - t0
+    finally:
+        if os.path.exists(out_filenm):
+            os.remove(out_filenm)
+        os.rmdir(tmp_dirnm)
+    result = dict(config)
+    result["elapsed_seconds"] = elapsed
+    result["output_bytes"] = run_log["result_size"]
+    result["rows_per_second"] = config["rows"] / elapsed
+    result["mb_per_second"] = run_log["result_size"] / elapsed / 1e6
+    # ru_maxrss is in kilobytes on Linux
+    result["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result["stages"] = run_log["timing"].get("stages")
+    print json.dumps(result)
+
+
+def run_config(config):
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--child", json.dumps(config)],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+        return dict(config, error=err.strip().splitlines()[-1] if err.strip() else "exit %d" % (proc.returncode,))
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def mk_configs(args):
+    columns = args.columns.split(",")
+    levels = [int(x) for x in args.levels.split(",")]
+    base = {"rows": args.rows, "columns": columns, "string_width": args.string_width,
+            "null_ratio": args.null_ratio, "fetch_size": args.fetch_size, "workers": args.workers,
+            "compress_threads": args.compress_threads, "level": None}
+    sys.path.insert(0, LIB_DIRNM)
+    from rqt import compress
+    configs = []
+    for fmt in args.formats.split(","):
+        if compress.split_codec("out." + fmt)[1] is None:
+            configs.append(dict(base, format=fmt))
+        else:
+            configs.extend(dict(base, format=fmt, level=level) for level in levels)
+    return configs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="rqt export benchmark")
+    parser.add_argument("--rows", type=int, default=1000000, help="rows to export (default 1000000)")
+    parser.add_argument("--columns", default=DEFAULT_COLUMNS,
+                        help="comma separated column kinds (default %s)" % (DEFAULT_COLUMNS,))
+    parser.add_argument("--string-width", type=int, default=16, help="characters per text value (default 16)")
+    parser.add_argument("--null-ratio", type=float, default=0.05, help="fraction of NULL cells (default 0.05)")
+    parser.add_argument("--fetch-size", type=int, default=10000, help="rows per batch (default 10000)")
+    parser.add_argument("--formats", default=DEFAULT_FORMATS,
+                        help="comma separated output extensions (default %s)" % (DEFAULT_FORMATS,))
+    parser.add_argument("--levels", default=DEFAULT_LEVELS,
+                        help="comma separated compression levels (default %s)" % (DEFAULT_LEVELS,))
+    parser.add_argument("--workers", type=int, default=1, help="as for run-query (default 1)")
+    parser.add_argument("--compress-threads", type=int, default=1, help="as for run-query (default 1)")
+    parser.add_argument("--json", metavar="OUT_FILE", help="write the results as JSON")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(json.loads(args.child))
+        return
+
+    results = []
+    for config in mk_configs(args):
+        result = run_config(config)
+        results.append(result)
+        label = config["format"] if config["level"] is None else "%s:%d" % (config["format"], config["level"])
+        if "error" in result:
+            print "%-14s error: %s" % (label, result["error"])
+            continue
+        print "%-14s rows/s=%-10d MB/s=%-8.1f output_mb=%-8.1f peak_rss_mb=%.1f" % (
+            label, result["rows_per_second"], result["mb_per_second"],
+            result["output_bytes"] / 1e6, result["peak_rss_kb"] / 1024.0)
+    if args.json:
+        with open(args.json, "w") as fp:
+            json.dump({"benchmark": "export", "created": time.time(), "results": results}, fp, indent=4)
+
+
+if __name__ == "__main__":
+    main()
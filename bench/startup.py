@@ -0,0 +1,122 @@
+#  Copyright 2014 Accuen
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""
+startup benchmark for the rqt CLI
+
+Runs "rqt help" and "rqt show-query" in fresh interpreters, reports the
+wall time and which heavy modules each one imported, and exits non-zero
+if a command imported a heavy module it doesn't need or its median time
+is over --max-ms.
+
+    python bench/startup.py [--runs N] [--max-ms MS] [--json OUT_FILE]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+
+LIB_DIRNM = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib")
+
+HEAVY_MODULES = ["boto", "psycopg2", "jinja2", "mako", "pystache", "pyarrow",
+                 "zstandard", "lz4", "multiprocessing.pool"]
+
+# Runs the CLI in-process and then reports the heavy modules it loaded.
+CHILD = """
+import sys, json
+sys.path.insert(0, %(lib)r)
+argv = %(argv)r
+sys.argv = ["rqt"] + argv
+import rqt.cli
+try:
+    rqt.cli.main()
+except SystemExit:
+    pass
+sys.stderr.write(json.dumps([m for m in %(heavy)r if m in sys.modules]) + "\\n")
+"""
+
+
+def run_once(argv):
+    code = CHILD % {"lib": LIB_DIRNM, "argv": argv, "heavy": HEAVY_MODULES}
+    t0 = time.time()
+    proc = subprocess.Popen([sys.executable, "-c", code],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    elapsed_ms = (time.time() - t0) * 1000
+    if proc.returncode != 0:
+        return elapsed_ms, None, err.strip().splitlines()[-1] if err.strip() else "exit %d" % (proc.returncode,)
+    loaded = json.loads(err.strip().splitlines()[-1])
+    return elapsed_ms, loaded, None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="rqt CLI startup benchmark")
+    parser.add_argument("--runs", type=int, default=10, help="runs per command (default 10)")
+    parser.add_argument("--max-ms", type=float, default=None,
+                        help="fail if a command's median wall time exceeds MS")
+    parser.add_argument("--json", metavar="OUT_FILE", help="write the results as JSON")
+    args = parser.parse_args()
+
+    fd, qt_filenm = tempfile.mkstemp(suffix=".rqt")
+    os.write(fd, "#!jinja2\nselect 1\n")
+    os.close(fd)
+    # command name -> (argv, heavy modules it may import)
+    commands = {
+        "help": (["help"], []),
+        "show-query": (["show-query", qt_filenm], ["jinja2"]),
+    }
+    results = {}
+    failed = False
+    try:
+        for name, (argv, allowed) in sorted(commands.items()):
+            times = []
+            loaded = set()
+            error = None
+            for i in range(args.runs):
+                elapsed_ms, mods, error = run_once(argv)
+                if error is not None:
+                    break
+                times.append(elapsed_ms)
+                loaded.update(mods)
+            if error is not None:
+                # e.g. the template engine isn't installed
+                results[name] = {"error": error}
+                print "%-12s error: %s" % (name, error)
+                failed = True
+                continue
+            times.sort()
+            median = times[len(times) // 2]
+            results[name] = {"median_ms": median, "min_ms": times[0], "max_ms": times[-1],
+                             "heavy_modules": sorted(loaded)}
+            print "%-12s median=%.1fms min=%.1fms max=%.1fms heavy_modules=%s" % (
+                name, median, times[0], times[-1], ",".join(sorted(loaded)) or "-")
+            if loaded - set(allowed):
+                failed = True
+            if args.max_ms is not None and median > args.max_ms:
+                failed = True
+    finally:
+        os.remove(qt_filenm)
+    if args.json:
+        with open(args.json, "w") as fp:
+            json.dump(results, fp, indent=4)
+    raise SystemExit, 1 if failed else 0
+
+
+if __name__ == "__main__":
+    main()
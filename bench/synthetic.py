@@ -0,0 +1,107 @@
+#  Copyright 2014 Accuen
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""
+a synthetic DB-API cursor for benchmarks
+
+Rows come from a seeded random generator, so two runs with the same
+options export identical data.
+"""
+import random
+import decimal
+import datetime
+
+
+def _int(rnd, width):
+    return rnd.randint(-2**31, 2**31 - 1)
+
+
+def _numeric(rnd, width):
+    return decimal.Decimal(rnd.randint(0, 10**9)) / 100
+
+
+def _float(rnd, width):
+    return rnd.random() * 1e6
+
+
+# mostly ASCII, with a two-byte UTF-8 character to exercise escaping
+_TEXT_CHARS = list("abcdefghijklmnopqrstuvwxyz ,\"") + ["\xc3\xa9"]
+
+
+def _text(rnd, width):
+    return "".join(rnd.choice(_TEXT_CHARS) for i in range(width))
+
+
+_EPOCH = datetime.datetime(2014, 1, 1)
+
+
+def _timestamp(rnd, width):
+    return _EPOCH + datetime.timedelta(seconds=rnd.randint(0, 10**8))
+
+
+def _date(rnd, width):
+    return _EPOCH.date() + datetime.timedelta(days=rnd.randint(0, 3650))
+
+
+def _bool(rnd, width):
+    return rnd.random() < 0.5
+
+
+# kind -> (PostgreSQL type OID, value generator)
+KINDS = {
+    "int": (23, _int),
+    "numeric": (1700, _numeric),
+    "float": (701, _float),
+    "text": (1043, _text),
+    "timestamp": (1114, _timestamp),
+    "date": (1082, _date),
+    "bool": (16, _bool),
+}
+
+
+class SyntheticCursor:
+    """
+    A DB-API cursor returning row_count generated rows of the given column kinds.
+
+    Text values are string_width characters long, and each cell is NULL with
+    probability null_ratio.  A pool of distinct rows is generated up front
+    and cycled, so generation cost doesn't dominate the benchmark.
+    """
+
+    name = None # not a server-side cursor
+
+    def __init__(self, kinds, row_count, string_width=16, null_ratio=0.0, seed=0, pool_size=4096):
+        rnd = random.Random(seed)
+        self.description = [("c%d_%s" % (i, kind), KINDS[kind][0], None, None, 18, 2, True)
+                            for i, kind in enumerate(kinds)]
+        gens = [KINDS[kind][1] for kind in kinds]
+        self.pool = [tuple(None if rnd.random() < null_ratio else gen(rnd, string_width) for gen in gens)
+                     for i in range(min(pool_size, max(row_count, 1)))]
+        self.rowcount = row_count
+        self.pos = 0
+
+    def execute(self, sql):
+        self.pos = 0
+
+    def fetchmany(self, size):
+        n = min(size, self.rowcount - self.pos)
+        if n <= 0:
+            return []
+        start = self.pos % len(self.pool)
+        batch = self.pool[start:start+n]
+        while len(batch) < n:
+            batch.extend(self.pool[:n - len(batch)])
+        self.pos += n
+        return batch
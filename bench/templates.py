@@ -0,0 +1,146 @@
+#  Copyright 2014 Accuen
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""
+template expansion benchmark for rqt
+
+Expands a representative query template with each engine (jinja2, mako,
+pystache) through query_template.expand_str and reports the cold
+(compile from scratch), disk-warm (compiled code loaded from the on-disk
+cache) and warm (in-memory cache) times, and renders/s and MB/s for warm
+expansions.  Engines that aren't installed are reported as errors.
+
+    python bench/templates.py [--renders N] [--columns N] [--json OUT_FILE]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+
+LIB_DIRNM = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib")
+
+# The same query in each engine's syntax: a column list built in a loop,
+# a conditional filter and an IN-list.
+TEMPLATES = {
+    "jinja2": """#!jinja2
+select
+{% for col in columns %}    {{ col }}{% if not loop.last %},{% endif %}
+{% endfor %}from events
+where day between '{{ start }}' and '{{ end }}'
+{% if country %}  and country = '{{ country }}'
+{% endif %}  and campaign_id in ({{ campaign_ids|join(", ") }})
+""",
+    "mako": """#!mako
+select
+% for i, col in enumerate(columns):
+    ${col}${"," if i < len(columns) - 1 else ""}
+% endfor
+from events
+where day between '${start}' and '${end}'
+% if country:
+  and country = '${country}'
+% endif
+  and campaign_id in (${", ".join(str(x) for x in campaign_ids)})
+""",
+    "pystache": """#!mustache
+select
+{{#column_items}}    {{name}}{{^last}},{{/last}}
+{{/column_items}}from events
+where day between '{{start}}' and '{{end}}'
+{{#country}}  and country = '{{country}}'
+{{/country}}  and campaign_id in ({{campaign_id_list}})
+""",
+}
+
+
+def mk_namespace(column_count):
+    columns = ["col_%d" % (i,) for i in range(column_count)]
+    campaign_ids = range(1000, 1000 + column_count)
+    return {
+        "columns": columns,
+        "column_items": [{"name": col, "last": i == len(columns) - 1} for i, col in enumerate(columns)],
+        "start": "2014-01-01",
+        "end": "2014-01-31",
+        "country": "US",
+        "campaign_ids": campaign_ids,
+        "campaign_id_list": ", ".join(str(x) for x in campaign_ids),
+    }
+
+
+def reset_memory_cache(query_template):
+    query_template._compiled = query_template.LRUCache()
+    query_template._jinja_env = None
+    query_template._jinja_loader = None
+
+
+def bench_engine(query_template, engine, namespace, renders):
+    s = TEMPLATES[engine]
+    t0 = time.time()
+    query_template.expand_str(s, dict(namespace))
+    cold = time.time() - t0
+    reset_memory_cache(query_template)
+    t0 = time.time()
+    query_template.expand_str(s, dict(namespace))
+    disk_warm = time.time() - t0
+    out_bytes = 0
+    t0 = time.time()
+    for i in range(renders):
+        out_bytes += len(query_template.expand_str(s, dict(namespace)))
+    elapsed = time.time() - t0
+    return {"engine": engine, "cold_ms": cold * 1000, "disk_warm_ms": disk_warm * 1000,
+            "warm_ms": elapsed * 1000 / renders, "renders_per_second": renders / elapsed,
+            "mb_per_second": out_bytes / elapsed / 1e6}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="rqt template expansion benchmark")
+    parser.add_argument("--renders", type=int, default=2000, help="warm renders per engine (default 2000)")
+    parser.add_argument("--columns", type=int, default=50, help="loop length in the template (default 50)")
+    parser.add_argument("--json", metavar="OUT_FILE", help="write the results as JSON")
+    args = parser.parse_args()
+
+    # Start from an empty disk cache so the cold numbers mean something.
+    cache_dirnm = tempfile.mkdtemp(prefix="rqt-bench-")
+    os.environ["RQT_CACHE_DIR"] = cache_dirnm
+    sys.path.insert(0, LIB_DIRNM)
+    from rqt import query_template
+
+    namespace = mk_namespace(args.columns)
+    results = []
+    try:
+        for engine in sorted(TEMPLATES):
+            try:
+                result = bench_engine(query_template, engine, namespace, args.renders)
+            except ImportError, exc:
+                result = {"engine": engine, "error": str(exc)}
+                print "%-10s error: %s" % (engine, exc)
+            else:
+                print "%-10s cold=%.1fms disk_warm=%.1fms warm=%.3fms renders/s=%-8d MB/s=%.1f" % (
+                    engine, result["cold_ms"], result["disk_warm_ms"], result["warm_ms"],
+                    result["renders_per_second"], result["mb_per_second"])
+            results.append(result)
+    finally:
+        shutil.rmtree(cache_dirnm, ignore_errors=True)
+    if args.json:
+        with open(args.json, "w") as fp:
+            json.dump({"benchmark": "templates", "created": time.time(), "results": results}, fp, indent=4)
+
+
+if __name__ == "__main__":
+    main()
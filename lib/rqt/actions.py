@@ -25,69 +25,144 @@ import datetime
 import platform
 import uuid
 import getpass
-
-from boto.s3.connection import S3Connection
+import resource
+import itertools
+import threading
+import contextlib
+import Queue
 
 from .version import __version__
 from . import errors
 from . import query_template
-from .util import open_csv_writer
+from . import converters
+from . import pipeline
+from . import sinks
+from . import unload
+from . import result_cache
+from . import usage
+from . import tracing
+from . import progress
+from . import cancel
+from . import partition
+from . import incremental
+from . import checkpoint
+from . import script
+from . import explain
+from .util import wait_result
 
 
 logger = logging.getLogger(__name__)
 
 
+DEFAULT_FETCH_SIZE = 10000
+
+
 def get_config_filenm(args):
     """
     return the top-level config file name
     """
     default_config_filenm = os.path.expanduser("~/.rqt-config")
-    config_filenm = default_config_filenm if args.config is None else args.config
+    config_filenm = default_config_filenm if args is None or args.config is None else args.config
     return config_filenm
 
 
-def load_config(args):
+# Parsed configs keyed by file name, each with the (mtime, size) it was read at.
+_config_cache = {}
+_config_cache_lock = threading.Lock()
+
+
+def load_config_file(config_filenm):
     """
-    load the top-level JSON configuration
+    load a JSON configuration file; it is only re-read when it changes
     """
-    config_filenm = get_config_filenm(args)
-    if not os.path.exists(config_filenm):
-        raise RQTMissingConfigError, config_filenm
+    try:
+        st = os.stat(config_filenm)
+    except OSError:
+        raise errors.RQTMissingConfigError, config_filenm
+    stamp = (st.st_mtime, st.st_size)
+    with _config_cache_lock:
+        cached = _config_cache.get(config_filenm)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
     with open(config_filenm) as fp:
         config = json.load(fp)
     logger.info("loaded rqt config from %r" % config_filenm)
+    with _config_cache_lock:
+        _config_cache[config_filenm] = (stamp, config)
     return config
 
 
-def get_conn_args(args):
+def load_config(args):
     """
-    return the connection args from the config
+    load the top-level JSON configuration
+    """
+    with tracing.span("config_load"):
+        return load_config_file(get_config_filenm(args))
+
+
+def select_conn_args(config, conn_key):
+    """
+    return the connection args for a connection key from a loaded config
     """
-    config = load_config(args)
     # Which connection key should be used?
-    conn_key = "default" if args.connection is None else args.connection
+    conn_key = "default" if conn_key is None else conn_key
     if conn_key not in config["connections"]:
         raise errors.RQTInvalidConnectionError, conn_key
-    conn_args = config["connections"][conn_key]
-    return conn_args
+    return config["connections"][conn_key]
 
 
-def get_connection(args):
+def get_conn_args(args):
     """
-    get a Redshift connection
+    return the connection args from the config
+    """
+    return select_conn_args(load_config(args), args.connection)
+
+
+def connect(conn_args):
+    """
+    open a Redshift connection from connection args
     """
     import psycopg2 # lazy import so show-query works without psycopg2
-    conn_args = get_conn_args(args)
-    conn = psycopg2.connect( database=conn_args["database"],
-                             host=conn_args["server"], 
-                             port=conn_args["port"], 
-                             user=conn_args["user"], 
-                             password=conn_args["password"],
-                             # sslmode=???
-                           )
+    with tracing.span("connect", host=conn_args["server"]):
+        conn = psycopg2.connect( database=conn_args["database"],
+                                 host=conn_args["server"], 
+                                 port=conn_args["port"], 
+                                 user=conn_args["user"], 
+                                 password=conn_args["password"],
+                                 # sslmode=???
+                               )
     return conn
 
 
+def set_session(cs, query_group, search_path, statement_timeout=None):
+    """
+    run the SET commands for query_group, search_path and statement_timeout (seconds; each if not None)
+    """
+    with tracing.span("set_session"):
+        # Set the statement_timeout, so the server gives up on its own
+        # should this process die without cancelling; a little past the
+        # client's deadline, which normally fires first.
+        if statement_timeout:
+            statement_timeout_ms = int((statement_timeout + cancel.SERVER_TIMEOUT_GRACE) * 1000)
+            cs.execute("SET statement_timeout TO %d;" % (statement_timeout_ms,))
+            logger.info("SET statement_timeout TO %d;" % (statement_timeout_ms,))
+        # Set the query_group.
+        if query_group:
+            cs.execute("SET query_group TO '%s';" % (query_group,))
+            logger.info("SET query_group TO '%s';" % (query_group,))
+        # Set the search_path.
+        if search_path is not None:
+            cs.execute("SET search_path TO %s;" % (search_path,))
+            logger.info("SET search_path TO %s;" % (search_path,))
+
+
+def get_connection(args):
+    """
+    get a Redshift connection
+    """
+    return connect(get_conn_args(args))
+
+
 def setup_namespace(json_filenm):
     """
     return a parameter namespace from an optional json file and the environment
@@ -139,6 +214,11 @@ def do_create_config(args):
             "access_key_id": "AWS ACCESS KEY ID",
             "secret_access_key": "AWS SECRET ACCESS KEY"
         },
+        "s3_unload": {
+            "prefix": "s3://BUCKET/PREFIX FOR UNLOAD SCRATCH FILES [OPTIONAL]",
+            "access_key_id": "AWS ACCESS KEY ID",
+            "secret_access_key": "AWS SECRET ACCESS KEY"
+        },
         "comments": [
             "...",
             "..."
@@ -153,6 +233,21 @@ def do_create_config(args):
 ########################################################################
 
 
+def do_flush_usage(args):
+    """
+    ship the spooled usage logs to S3
+    """
+    config = load_config(args)
+    if not config.get("s3_usage_data", {}):
+        logger.info("no usage data logged")
+        return
+    shipped = usage.flush(config["s3_usage_data"])
+    logger.info("shipped %d usage records" % (shipped,))
+
+
+########################################################################
+
+
 class SIGINTHandler:
     def __init__(self):
         self.calls = []
@@ -169,11 +264,7 @@ def do_run_psql(args):
     """
     run psql session to Redshift
     """
-    config = load_config(args)
-    conn_key = "default" if args.connection is None else args.connection
-    if conn_key not in config["connections"]:
-        raise errors.RQTInvalidConnectionError, conn_key
-    conn_args = config["connections"][conn_key]
+    conn_args = get_conn_args(args)
     os.environ["PGPASSWORD"] = conn_args["password"]
     cmd = [ 
         "psql",
@@ -207,32 +298,147 @@ def do_show_query(args):
 def do_show_plan(args):
     """
     show the query plan as per "explain" 
+
+    The plan is printed as is, as an annotated tree or as JSON; with
+    --fail-on, rqt exits with status 1 if any node has one of the flags.
     """
+    fail_on = explain.parse_flags(args.fail_on) if args.fail_on else None
     # Expand the query template.
     ns = setup_namespace(args.json_params)
     q = query_template.expand_file(args.qt_filename, ns)
     # Get the Redshift connection.
-    conn = get_connection(args)
-    cs = conn.cursor()
-    # Set the query_group.
     conn_args = get_conn_args(args)
-    query_group = _pick_query_group(args, conn_args)
-    if query_group:
-        cs.execute("SET query_group TO '%s';" % (query_group,))
-        logger.info("SET query_group TO '%s';" % (query_group,))
-    # Set the search_path.
-    search_path = conn_args.get("search_path")
-    if search_path is not None:
-        cs.execute("SET search_path TO %s;" % (search_path,))
-        logger.info("SET search_path TO %s;" % (search_path,))
-    # Run the explain.
-    cs.execute("explain "+q)
+    conn = connect(conn_args)
+    with cancel.Canceller(conn, args.timeout):
+        cs = conn.cursor()
+        set_session(cs, _pick_query_group(args, conn_args), conn_args.get("search_path"),
+                    statement_timeout=args.timeout)
+        # Run the explain.
+        lines = run_explain(cs, q)
     # Write the plan to stdout.
-    while 1:
-        row = cs.fetchone()
-        if row is None:
-            break
-        print row[0]
+    if args.format == "raw":
+        for line in lines:
+            print line
+        if not fail_on:
+            return
+    plan = explain.analyze(explain.parse(lines), args.huge_rows)
+    if args.format == "json":
+        print json.dumps(plan.as_dict(args.top), indent=2, sort_keys=True)
+    elif args.format == "tree":
+        print explain.format_tree(plan)
+        print
+        print "hotspots:"
+        print explain.format_hotspots(plan, args.top)
+    if fail_on:
+        flagged = plan.flagged(fail_on)
+        for node in flagged:
+            logger.error("plan check failed: %s (%s)" % (node.op, ",".join(node.flags)))
+        if flagged:
+            raise SystemExit, 1
+
+
+def run_explain(cs, q):
+    """
+    return the lines of the plan of q
+    """
+    with tracing.span("explain"):
+        cs.execute("explain "+q)
+        return [row[0] for row in cs.fetchall()]
+
+
+def do_plan_diff(args):
+    """
+    show how the plans of a template differ between parameter sets or git revisions
+
+    The first variant is the baseline; with --fail-on, rqt exits with
+    status 1 if another variant's plan gains any of the flags.
+    """
+    fail_on = explain.parse_flags(args.fail_on) if args.fail_on else None
+    variants = _plan_variants(args)
+    plans = [explain.analyze(explain.parse(lines), args.huge_rows)
+             for lines in _explain_all(args, [q for label, q in variants])]
+    labels = [label for label, q in variants]
+    diffs = [explain.diff(plans[0], other, args.min_change) for other in plans[1:]]
+    if args.format == "json":
+        print json.dumps({"baseline": labels[0],
+                          "plans": [dict(plan.as_dict(args.top), label=label) for label, plan in zip(labels, plans)],
+                          "diffs": [dict(d, label=label) for label, d in zip(labels[1:], diffs)]},
+                         indent=2, sort_keys=True)
+    else:
+        for label, d in zip(labels[1:], diffs):
+            print explain.format_diff(labels[0], label, d)
+            print
+    if fail_on:
+        failed = False
+        for label, d in zip(labels[1:], diffs):
+            for node in d["new_flags"]:
+                if set(node["flags"]) & set(fail_on):
+                    logger.error("plan check failed: %s has %s (%s)" % (label, node["op"], ",".join(node["flags"])))
+                    failed = True
+        if failed:
+            raise SystemExit, 1
+
+
+def _git_show(filenm, rev):
+    """
+    return filenm as of git revision rev
+    """
+    dirnm, basenm = os.path.split(os.path.abspath(filenm))
+    return subprocess.check_output(["git", "show", "%s:./%s" % (rev, basenm)], cwd=dirnm)
+
+
+def _plan_variants(args):
+    """
+    return [(label, query)] for plan-diff, the baseline first
+    """
+    json_filenms = args.json_params or []
+    if args.rev:
+        if len(json_filenms) > 1:
+            raise ValueError, "--rev takes at most one --json_params file"
+        ns = setup_namespace(json_filenms[0] if json_filenms else None)
+        variants = [("%s:%s" % (rev, args.qt_filename), query_template.expand_str(_git_show(args.qt_filename, rev), ns))
+                    for rev in args.rev]
+        if len(args.rev) == 1:
+            # Compare against the working copy.
+            variants.append((args.qt_filename, query_template.expand_file(args.qt_filename, ns)))
+        return variants
+    if len(json_filenms) < 2:
+        raise ValueError, "plan-diff needs two or more --json_params files or a --rev"
+    return [(json_filenm, query_template.expand_file(args.qt_filename, setup_namespace(json_filenm)))
+            for json_filenm in json_filenms]
+
+
+def _explain_all(args, qs):
+    """
+    return the plan lines of each of qs, explained concurrently over --connections connections
+    """
+    from multiprocessing.pool import ThreadPool # lazy import; only needed for plan-diff
+
+    conn_args = get_conn_args(args)
+    query_group = _pick_query_group(args, conn_args)
+    n = max(1, min(len(qs), args.connections))
+    conn = connect(conn_args)
+    with cancel.Canceller(conn, args.timeout) as canceller:
+        conns = Queue.Queue()
+        for i in range(n):
+            if i > 0:
+                conn = connect(conn_args)
+                canceller.add(conn)
+            set_session(conn.cursor(), query_group, conn_args.get("search_path"), statement_timeout=args.timeout)
+            conns.put(conn)
+
+        def explain_one(q):
+            conn = conns.get()
+            try:
+                return run_explain(conn.cursor(), q)
+            finally:
+                conns.put(conn)
+
+        pool = ThreadPool(n)
+        try:
+            return wait_result(pool.map_async(explain_one, qs))
+        finally:
+            pool.terminate()
 
 
 ########################################################################
@@ -245,6 +451,7 @@ def _step1(cs, sql, run_log):
     q_time_start = time.time()
     cs.execute(sql)
     q_time_end = time.time()
+    tracing.add_span("execute", q_time_start, q_time_end)
     q_time_elapsed = q_time_end - q_time_start
     logger.info("query_elapsed_seconds=%.1f row_count=%s" % (q_time_elapsed, cs.rowcount))
     run_log["row_count"] = cs.rowcount
@@ -254,36 +461,86 @@ def _step1(cs, sql, run_log):
     run_log["timing"]["query"]["elapsed"] = q_time_elapsed
 
 
-def _step2(cs, out_filenm, run_log):
+def _peak_rss_kb():
     """
-    write query results to file and some info to run_log
+    return the peak resident set size of this process in KB
     """
-    wo_time_start = time.time()
-    # Open output...
-    fp_out, wtr = open_csv_writer(out_filenm)
-    # Write header row...
-    col_nms = [desc[0] for desc in cs.description]
-    wtr.writerow(col_nms)
-    # Write query results to output...
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _iter_batches(cs, fetch_size, run_log):
+    """
+    yield batches of rows via fetchmany() and record fetch stats in run_log
+    """
+    fetch_log = run_log.setdefault("fetch", {})
+    fetch_log["fetch_size"] = fetch_size
+    fetch_log["server_side_cursor"] = getattr(cs, "name", None) is not None
+    fetch_log["batch_count"] = 0
+    fetch_log["row_count"] = 0
     while 1:
-        # FINISH: optimize with fetchmany()
-        row = cs.fetchone()
-        if row is None:
+        with tracing.span("fetch"):
+            batch = cs.fetchmany(fetch_size)
+        if not batch:
             break
-        xrow = []
-        for x in row:
-            if type(x) is str:
-                # I think the str's coming out of Redshift are
-                # really UTF-8 byte arrays.  This may be related
-                # to how the psycopg2 connection is set up.  Here 
-                # they are converted into Python unicode string objects.
-                xrow.append(x.decode("utf-8", "replace"))
-            elif x is None:
-                xrow.append(u"NULL")
-            else:
-                xrow.append(unicode(x))
-        wtr.writerow(xrow)
-    fp_out.close()
+        if fetch_log["batch_count"] == 0 and "query" in run_log.get("timing", {}):
+            # Latency from execute to the first rows in hand; for a
+            # server-side cursor this is where the query really runs.
+            first_row_time = time.time()
+            fetch_log["first_row_seconds"] = first_row_time - run_log["timing"]["query"]["start"]
+            tracing.add_span("first_row", run_log["timing"]["query"]["start"], first_row_time)
+        fetch_log["batch_count"] += 1
+        fetch_log["row_count"] += len(batch)
+        fetch_log["peak_rss_kb"] = _peak_rss_kb()
+        yield batch
+    fetch_log["peak_rss_kb"] = _peak_rss_kb()
+    logger.info("fetch_batches=%d fetch_rows=%d peak_rss_kb=%d" % (
+        fetch_log["batch_count"], fetch_log["row_count"], fetch_log["peak_rss_kb"]))
+
+
+def _step2(cs, batches, out_filenm, run_log, writer_options=None, reporter=None):
+    """
+    write query results to file and some info to run_log
+
+    A progress.ProgressReporter, if given, is fed the rows and bytes written.
+    """
+    wo_time_start = time.time()
+    sink_options = dict(writer_options or {})
+    workers = sink_options.pop("workers", 1)
+    worker_pool = sink_options.pop("worker_pool", None)
+    # Compile the per-column conversions...
+    plan = converters.compile_plan(cs.description)
+    pool = None
+    own_pool = None
+    if workers > 1:
+        if sinks.mk_text_encoder(out_filenm, plan) is not None:
+            # Encode on a process pool; results are written in submission order.
+            if worker_pool is None:
+                # Only safe while no other thread is running; run-query
+                # starts its pool up front (see _open_worker_pool).
+                worker_pool = own_pool = sinks.WorkerPool(workers)
+            pool = worker_pool.encoder(out_filenm, cs.description)
+        else:
+            logger.info("--workers is only used for text output; encoding on one thread")
+    # Open output; the sink is picked by the file extension...
+    try:
+        sink = sinks.open_sink(out_filenm, plan, pool=pool, **sink_options)
+        encode, write = sink.encode_batch, sink.write_encoded
+        if reporter is not None:
+            # The row count is only known up front for a client-side cursor.
+            total_rows = cs.rowcount if getattr(cs, "name", None) is None and cs.rowcount >= 0 else None
+            reporter.start_export(total_rows, sink.output_size)
+            encode, write = reporter.wrap(encode, write)
+        # Write query results to output; fetching, converting and writing
+        # run concurrently...
+        run_log["timing"]["stages"] = pipeline.run(batches, encode, write,
+                                                   queue_size=max(pipeline.DEFAULT_QUEUE_SIZE, 2*workers))
+        sink.close()
+    except:
+        if own_pool is not None:
+            own_pool.terminate()
+        raise
+    if own_pool is not None:
+        own_pool.close()
     wo_time_end = time.time()
     wo_time_elapsed = wo_time_end - wo_time_start
     logger.info("writeout_elapsed_seconds=%.1f" % (wo_time_elapsed,))
@@ -291,6 +548,11 @@ def _step2(cs, out_filenm, run_log):
     run_log["timing"]["writeout"]["start"] = wo_time_start
     run_log["timing"]["writeout"]["end"] = wo_time_end
     run_log["timing"]["writeout"]["elapsed"] = wo_time_elapsed
+    if isinstance(sink, sinks.ShardedSink):
+        run_log["shards"] = sink.filenms
+        run_log["result_size"] = sum(os.stat(filenm).st_size for filenm in sink.filenms)
+        logger.info("saved results to %d shards of %r" % (len(sink.filenms), out_filenm))
+        return
     if "stdout" not in out_filenm:
         run_log["result_size"] = os.stat(out_filenm).st_size
     else:
@@ -298,42 +560,86 @@ def _step2(cs, out_filenm, run_log):
     logger.info("saved results to %r" % (out_filenm,))
 
 
-def _run_select_to_file(cs, sql, out_filenm, run_log, args):
-    # Run query...
-    _step1(cs, sql, run_log)
+def _run_select_to_file(cs, sql, out_filenm, run_log, args, fetch_size=DEFAULT_FETCH_SIZE,
+                        writer_options=None, canceller=None, inc=None):
+    """
+    run sql and write its result set to out_filenm
 
-    # Write-out the result...
+    For an incremental run (inc, an incremental.Incremental), the result
+    goes to its delta file and is committed once written.
+    """
+    reporter = _open_progress(args)
+    phase = "failed"
+    if inc is not None:
+        out_filenm = inc.delta_filenm
+        writer_options = dict(writer_options or {}, header=inc.header)
     try:
-        if cs.description and out_filenm != "/dev/null":
-            # cs.description is None if the SQL did not return a result set.
-            # out_filenm is /dev/null if the user doesn't want the result set written to a file.
-            _step2(cs, out_filenm, run_log)
+        with _logged_run(run_log, args):
+            # Run query...
+            _step1(cs, sql, run_log)
+
+            # Write-out the result...
+            batches = _iter_batches(cs, fetch_size, run_log)
+            if canceller is not None:
+                batches = canceller.guard(batches)
+            if getattr(cs, "name", None) is not None:
+                # A server-side (named) cursor only has a description once the
+                # first batch has been fetched.
+                first_batch = next(batches, None)
+                if first_batch is not None:
+                    batches = itertools.chain([first_batch], batches)
+            if inc is not None and cs.description:
+                batches = inc.track(cs, batches)
+            if cs.description and out_filenm != "/dev/null":
+                # cs.description is None if the SQL did not return a result set.
+                # out_filenm is /dev/null if the user doesn't want the result set written to a file.
+                _step2(cs, batches, out_filenm, run_log, writer_options=writer_options, reporter=reporter)
+                if getattr(cs, "name", None) is not None:
+                    # A server-side cursor's rowcount is -1; count the fetched rows.
+                    run_log["row_count"] = run_log["fetch"]["row_count"]
+            if inc is not None:
+                inc.commit(run_log)
+            phase = "done"
+    finally:
+        if inc is not None and phase != "done":
+            inc.abort()
+        if reporter is not None:
+            reporter.stop(phase)
+
+
+@contextlib.contextmanager
+def _logged_run(run_log, args):
+    """
+    write run_log, with the run's outcome, once the block is done
+    """
+    try:
+        yield
+        run_log.setdefault("outcome", "ok")
+    except:
+        # A cancelled run has recorded why already, unless the server's
+        # statement_timeout got there first.
+        if getattr(args, "timeout", None) and cancel.is_query_cancelled(sys.exc_info()[0]):
+            run_log.setdefault("outcome", "timeout")
+        run_log.setdefault("outcome", "error")
+        raise
     finally:
         _write_run_log(run_log, args)
 
 
 def _write_run_log(run_log, args):
     """
-    write out the run_log to S3
+    spool the run_log for shipping to S3
     """
     config = load_config(args)
     if not config.get("s3_usage_data", {}):
         # Skip if configuration is empty...
         logger.info("no usage data logged")
         return
-    # Establish the bucket key to write to...
-    bucketname = config["s3_usage_data"]["bucket"]
-    prefix = config["s3_usage_data"]["key_prefix"].lstrip("/").rstrip("/")
-    cymd = datetime.date.today().strftime("%Y/%m/%d")
-    keyname = "/".join((prefix, cymd, uuid.uuid4().hex))
-    # Connect and write...
-    s3 = S3Connection(config["s3_usage_data"]["access_key_id"],
-                      config["s3_usage_data"]["secret_access_key"])
-    bucket = s3.get_bucket(bucketname)
-    key = bucket.new_key(keyname)
-    key.set_contents_from_string(json.dumps(run_log, indent=4)+"\n")
-    uri = "s3://%s/%s" % (bucketname, keyname)
-    logger.info("usage data logged to %s" % (uri,))
+    with tracing.span("usage_spool"):
+        spooled = usage.spool(run_log, config["s3_usage_data"])
+    logger.info("usage data spooled (%d records waiting)" % (spooled,))
+    if usage.should_ship(config["s3_usage_data"], spooled):
+        usage.ship_in_background(get_config_filenm(args))
 
 
 def _pick_query_group(args, conn_args):
@@ -344,24 +650,404 @@ def _pick_query_group(args, conn_args):
     return None 
 
 
+def _pick_fetch_size(args, conn_args):
+    if args.fetch_size:
+        return args.fetch_size
+    if conn_args.get("fetch_size"):
+        return int(conn_args.get("fetch_size"))
+    return DEFAULT_FETCH_SIZE
+
+
+def _pick_stream(args, conn_args):
+    if args.stream:
+        return True
+    return bool(conn_args.get("stream", False))
+
+
+@contextlib.contextmanager
+def _open_worker_pool(args):
+    """
+    start the --workers encoding processes, or yield None
+
+    This has to happen before the canceller's timer, progress reporting
+    or the pipeline start threads: forking a process that has other
+    threads can deadlock the child in Python 2.  It also has to happen
+    before connecting, so the children don't share the libpq connection.
+    """
+    if args.workers <= 1 or args.unload:
+        yield None
+        return
+    pool = sinks.WorkerPool(args.workers)
+    try:
+        yield pool
+    except:
+        pool.terminate()
+        raise
+    pool.close()
+
+
+def _pick_writer_options(args):
+    return {
+        "compress_level": args.compress_level,
+        "compress_threads": args.compress_threads,
+        "workers": args.workers,
+        "max_rows_per_file": args.max_rows_per_file,
+        "max_bytes_per_file": args.max_bytes_per_file,
+    }
+
+
+def _open_progress(args):
+    """
+    return a started progress.ProgressReporter if progress was asked for, else None
+    """
+    interval = getattr(args, "progress", None)
+    status_filenm = getattr(args, "status_file", None)
+    if interval is None and status_filenm is None:
+        return None
+    reporter = progress.ProgressReporter(interval or progress.DEFAULT_INTERVAL, status_filenm)
+    reporter.start()
+    return reporter
+
+
+def _open_result_cache(args, config):
+    """
+    return (the ResultCache, TTL) for this run, or (None, None)
+
+    The TTL is --cache-ttl, else the template's TTL from the config;
+    --cache-ttl 0 turns the cache off.
+    """
+    if args.cache_ttl is not None:
+        ttl = args.cache_ttl
+    else:
+        ttl = result_cache.template_ttl(config, args.qt_filename)
+    if not ttl:
+        return None, None
+    if args.incremental or args.checkpoint_key or args.script:
+        logger.info("result cache doesn't apply to incremental, checkpointed or script runs")
+        return None, None
+    sharded = args.max_rows_per_file or args.max_bytes_per_file or \
+        (args.partition_by and args.partition_output == "shards")
+    if sharded or not result_cache.is_cacheable(args.out_filename):
+        logger.info("result cache only applies to a single output file")
+        return None, None
+    try:
+        return result_cache.open_cache(config), ttl
+    except (IOError, OSError), exc:
+        logger.info("result cache unavailable: %s" % (exc,))
+        return None, None
+
+
+def _expand_slices(args, ns, name):
+    """
+    return the query for each partition, for --partition-by var:NAME
+    """
+    values = ns.get(name)
+    if not isinstance(values, list):
+        if not args.partitions:
+            raise ValueError, "--partitions is required with --partition-by var:%s unless %s is a list" % (name, name)
+        values = range(args.partitions)
+    sqls = []
+    for i, value in enumerate(values):
+        slice_ns = dict(ns)
+        slice_ns.update({name: value, "partition": i, "partitions": len(values)})
+        sqls.append(query_template.expand_file(args.qt_filename, slice_ns))
+    return sqls
+
+
+def _mk_slice_queries(cs, q, spec, partitions):
+    """
+    return the query for each partition, for the column --partition-by modes
+    """
+    kind, col, bounds = spec
+    if not partitions:
+        raise ValueError, "--partitions is required with --partition-by %s:%s" % (kind, col)
+    cuts = None
+    if kind == "range":
+        if bounds is None:
+            # This runs the query once more, so declare LO:HI when known.
+            with tracing.span("partition_bounds"):
+                cs.execute(partition.bounds_sql(q, col))
+                bounds = cs.fetchone()
+            logger.info("partition bounds min=%r max=%r" % bounds)
+        if None not in bounds:
+            cuts = partition.range_cuts(bounds[0], bounds[1], partitions)
+    return partition.slice_queries(q, kind, col, partitions, cuts)
+
+
+def _slice_batches(cs, sql, fetch_size, slice_log):
+    """
+    yield the batches of one partition, running its query when first asked
+    """
+    _step1(cs, sql, slice_log)
+    for batch in _iter_batches(cs, fetch_size, slice_log):
+        yield batch
+
+
+def _with_first_batch(batches):
+    """
+    fetch the first batch up front, so a server-side cursor has its description
+    """
+    first_batch = next(batches, None)
+    if first_batch is None:
+        return iter([])
+    return itertools.chain([first_batch], batches)
+
+
+def _run_partitioned(conn, conn_args, session, slice_sqls, out_filenm, run_log, args, fetch_size,
+                     writer_options, canceller):
+    """
+    run the partition queries concurrently, one connection each, into out_filenm
+
+    The partitions are merged into out_filenm in partition order, or
+    with --partition-output=shards each is written to its own shard.
+    Each partition is read through a server-side cursor, fetch_size rows
+    at a time.
+    """
+    n = len(slice_sqls)
+    shards = args.partition_output == "shards"
+    if shards and (writer_options.get("max_rows_per_file") or writer_options.get("max_bytes_per_file")):
+        raise ValueError, "--partition-output=shards can't be combined with --max-rows-per-file/--max-bytes-per-file"
+    logger.info("running %d partitions (%s)" % (n, args.partition_output))
+    slice_logs = [{"query": sql, "timing": {}} for sql in slice_sqls]
+    run_log["partitions"] = slice_logs
+    reporter = _open_progress(args)
+    if reporter is not None and shards:
+        reporter.expected_exports = n
+    phase = "failed"
+    opened = []
+    try:
+        with _logged_run(run_log, args):
+            # The first partition reuses the connection already open.
+            cursors = []
+            for i, sql in enumerate(slice_sqls):
+                if i > 0:
+                    conn = connect(conn_args)
+                    opened.append(conn)
+                    canceller.add(conn)
+                cs = conn.cursor()
+                set_session(cs, session[0], session[1], statement_timeout=args.timeout)
+                # A client-side cursor would hold its whole slice in memory,
+                # all n at once, so partitions stream whenever they can.
+                if script.can_declare_cursor(sql):
+                    cs = conn.cursor(name="rqt_%s" % (uuid.uuid4().hex,))
+                    cs.itersize = fetch_size
+                else:
+                    logger.info("partition %d is not a query; its result is read into memory" % (i,))
+                cursors.append(cs)
+            if shards:
+                _write_partition_shards(cursors, slice_sqls, slice_logs, out_filenm, run_log, fetch_size,
+                                        writer_options, canceller, reporter)
+            else:
+                _write_partitions_merged(cursors, slice_sqls, slice_logs, out_filenm, run_log, fetch_size,
+                                         writer_options, canceller, reporter)
+            run_log["row_count"] = sum(slice_log.get("fetch", {}).get("row_count", 0) for slice_log in slice_logs)
+            phase = "done"
+    finally:
+        for conn in opened:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        if reporter is not None:
+            reporter.stop(phase)
+
+
+def _write_partitions_merged(cursors, slice_sqls, slice_logs, out_filenm, run_log, fetch_size,
+                             writer_options, canceller, reporter):
+    # Every partition's query starts right away; each reads ahead a few
+    # batches and then waits for the partitions before it to be written.
+    readers = [partition.SliceReader(_slice_batches(cs, sql, fetch_size, slice_log))
+               for cs, sql, slice_log in zip(cursors, slice_sqls, slice_logs)]
+    for reader in readers:
+        reader.start()
+    try:
+        batches = itertools.chain.from_iterable(reader.batches() for reader in readers)
+        batches = _with_first_batch(canceller.guard(batches))
+        merged = partition.MergedCursor(cursors)
+        if merged.description and out_filenm != "/dev/null":
+            _step2(merged, batches, out_filenm, run_log, writer_options=writer_options, reporter=reporter)
+        else:
+            for batch in batches:
+                pass
+    finally:
+        for reader in readers:
+            reader.stop()
+
+
+def _write_partition_shards(cursors, slice_sqls, slice_logs, out_filenm, run_log, fetch_size,
+                            writer_options, canceller, reporter):
+    from multiprocessing.pool import ThreadPool # lazy import; only needed for shards
+
+    def run_slice(i):
+        cs, slice_log = cursors[i], slice_logs[i]
+        batches = _with_first_batch(canceller.guard(_slice_batches(cs, slice_sqls[i], fetch_size, slice_log)))
+        if not cs.description or out_filenm == "/dev/null":
+            for batch in batches:
+                pass
+            return
+        # Like ShardedSink, write under a hidden name until complete.
+        final_filenm = sinks.shard_filenm(out_filenm, i)
+        dirnm, basenm = os.path.split(final_filenm)
+        tmp_filenm = os.path.join(dirnm, "." + basenm)
+        _step2(cs, batches, tmp_filenm, slice_log, writer_options=writer_options, reporter=reporter)
+        os.rename(tmp_filenm, final_filenm)
+        slice_log["shard"] = final_filenm
+
+    pool = ThreadPool(len(cursors))
+    try:
+        wait_result(pool.map_async(run_slice, range(len(cursors))))
+    except:
+        # Stop the partitions still running.
+        for cs in cursors:
+            cs.connection.cancel()
+        pool.terminate()
+        raise
+    pool.close()
+    run_log["shards"] = [slice_log["shard"] for slice_log in slice_logs if "shard" in slice_log]
+    run_log["result_size"] = sum(slice_log.get("result_size", 0) for slice_log in slice_logs)
+    logger.info("saved results to %d partition shards of %r" % (len(run_log["shards"]), out_filenm))
+
+
+def _run_script(conn, statements, out_filenm, run_log, args, fetch_size, stream, writer_options, canceller):
+    """
+    run statements in order on conn, writing each result set to its own file
+
+    Each statement gets its own entry in run_log["statements"].  With a
+    client-side cursor the result is in memory once executed, so it is
+    written while the next statement runs on the server.
+    """
+    from multiprocessing.pool import ThreadPool # lazy import; only needed for scripts
+
+    filenms = script.result_filenms(statements, out_filenm, sinks.shard_filenm)
+    step_logs = [{"query": stmt, "timing": {}} for stmt in statements]
+    run_log["statements"] = step_logs
+    reporter = _open_progress(args)
+    if reporter is not None:
+        reporter.expected_exports = len([filenm for filenm in filenms if filenm])
+    writer = ThreadPool(1)
+    pending = None
+    phase = "failed"
+    try:
+        with _logged_run(run_log, args):
+            for i, (stmt, step_log, filenm) in enumerate(zip(statements, step_logs, filenms)):
+                logger.info("running statement %d of %d" % (i + 1, len(statements)))
+                if script.needs_autocommit(stmt):
+                    # Not allowed in a transaction block; commit the work so far.
+                    conn.commit()
+                    conn.autocommit = True
+                    try:
+                        _step1(conn.cursor(), stmt, step_log)
+                    finally:
+                        conn.autocommit = False
+                    continue
+                named = stream and filenm is not None and script.can_declare_cursor(stmt)
+                if named:
+                    cs = conn.cursor(name="rqt_%s" % (uuid.uuid4().hex,))
+                    cs.itersize = fetch_size
+                else:
+                    cs = conn.cursor()
+                _step1(cs, stmt, step_log)
+                if filenm is None:
+                    if cs.description:
+                        logger.info("statement %d returned rows; only SELECT, WITH, VALUES, SHOW and EXPLAIN results are written" % (i + 1,))
+                    continue
+                batches = canceller.guard(_iter_batches(cs, fetch_size, step_log))
+                if named:
+                    batches = _with_first_batch(batches)
+                if not cs.description:
+                    # e.g. SELECT ... INTO
+                    continue
+                if out_filenm == "/dev/null":
+                    for batch in batches:
+                        pass
+                    continue
+                step_log["output"] = filenm
+                if pending is not None:
+                    # One result set is written at a time.
+                    wait_result(pending)
+                    pending = None
+                if named:
+                    # A named cursor fetches over the connection, so the next
+                    # statement has to wait.
+                    _step2(cs, batches, filenm, step_log, writer_options=writer_options, reporter=reporter)
+                else:
+                    pending = writer.apply_async(_step2, (cs, batches, filenm, step_log),
+                                                 {"writer_options": writer_options, "reporter": reporter})
+            if pending is not None:
+                wait_result(pending)
+            conn.commit()
+            run_log["row_count"] = sum(step_log.get("fetch", {}).get("row_count", 0) for step_log in step_logs)
+            run_log["outputs"] = [step_log["output"] for step_log in step_logs if "output" in step_log]
+            run_log["result_size"] = sum(step_log.get("result_size", 0) for step_log in step_logs)
+            phase = "done"
+    finally:
+        writer.close()
+        writer.join()
+        if reporter is not None:
+            reporter.stop(phase)
+
+
+def _open_incremental(args):
+    """
+    return the incremental.Incremental for --incremental, or None
+    """
+    if not args.incremental:
+        return None
+    if args.unload or args.partition_by or args.max_rows_per_file or args.max_bytes_per_file:
+        raise ValueError, "--incremental can't be combined with --unload, --partition-by or --max-*-per-file"
+    state_filenm = args.state_file or incremental.state_filenm(args.qt_filename, args.connection, args.out_filename,
+                                                                 args.json_params)
+    return incremental.Incremental(state_filenm, args.incremental, args.out_filename, args.incremental_output)
+
+
+def _open_checkpoint(args, q):
+    """
+    return the checkpoint.Checkpoint for --checkpoint-key, or None
+
+    With --resume, the output is cut back to the last checkpoint.
+    """
+    if not args.checkpoint_key:
+        if args.resume:
+            raise ValueError, "--resume requires --checkpoint-key"
+        return None
+    if args.unload or args.partition_by or args.incremental or args.max_rows_per_file or args.max_bytes_per_file:
+        raise ValueError, "--checkpoint-key can't be combined with --unload, --partition-by, --incremental or --max-*-per-file"
+    ckpt = checkpoint.Checkpoint(args.out_filename, args.checkpoint_key, q)
+    if args.resume:
+        ckpt.load()
+    return ckpt
+
+
+def _checkpoint_writer_options(ckpt, writer_options, chunk_rows):
+    """
+    return writer_options for output committed in chunks to ckpt
+    """
+    resumed = ckpt.state is not None
+    return dict(writer_options, chunk_rows=chunk_rows, chunk_key=ckpt.key, on_commit=ckpt.commit,
+                append=resumed, header=not resumed)
+
+
 def do_run_query(args):
-    # Expand the query template.
     ns = setup_namespace(args.json_params)
-    q = query_template.expand_file(args.qt_filename, ns)
-    # Get the Redshift connection.
-    conn = get_connection(args)
-    cs = conn.cursor()
-    # Set the query_group.
+    # The template selects only the rows past the last watermark.
+    inc = _open_incremental(args)
+    if inc is not None:
+        ns["watermark"] = inc.watermark
+        logger.info("incremental run on %s from watermark %r" % (args.incremental, inc.watermark))
+    # Expand the query template.
+    spec = partition.parse_spec(args.partition_by) if args.partition_by else None
+    slice_sqls = None
+    with tracing.span("template_expand"):
+        if spec is not None and spec[0] == "var":
+            slice_sqls = _expand_slices(args, ns, spec[1])
+            # Together the partitions are the logical query (e.g. for
+            # the run log and the result cache key).
+            q = ";\n".join(slice_sqls)
+        else:
+            q = query_template.expand_file(args.qt_filename, ns)
     conn_args = get_conn_args(args)
     query_group = _pick_query_group(args, conn_args)
-    if query_group:
-        cs.execute("SET query_group TO '%s';" % (query_group,))
-        logger.info("SET query_group TO '%s';" % (query_group,))
-    # Set the search_path.
     search_path = conn_args.get("search_path")
-    if search_path is not None:
-        cs.execute("SET search_path TO %s;" % (search_path,))
-        logger.info("SET search_path TO %s;" % (search_path,))
     # Start a "run log" dictionary.
     run_log = {}
     run_log["version"] = "1"
@@ -373,10 +1059,98 @@ def do_run_query(args):
     run_log["query"] = q
     run_log["query_group"] = query_group
     run_log["search_path"] = search_path
+    run_log["timeout"] = args.timeout
     run_log["timing"] = {}
-    # Execute the query.
-    # FINISH: verify the output file extension makes sense.
-    _run_select_to_file(cs, q, args.out_filename, run_log, args)
-
-
-
+    if args.unload and (args.max_rows_per_file or args.max_bytes_per_file or args.compress_level is not None or
+                        args.compress_threads != 1 or args.workers > 1):
+        raise ValueError, "--unload can't be combined with --max-*-per-file, --compress-level, --compress-threads or --workers"
+    if args.script and (args.unload or args.partition_by or args.incremental or args.checkpoint_key or
+                        args.max_rows_per_file or args.max_bytes_per_file):
+        raise ValueError, "--script can't be combined with --unload, --partition-by, --incremental, --checkpoint-key or --max-*-per-file"
+    # Order the query by the checkpoint key, past the last checkpoint.
+    ckpt = _open_checkpoint(args, q)
+    if ckpt is not None:
+        run_log["checkpoint"] = {"key": ckpt.key, "resumed_rows": ckpt.base_rows}
+    # Serve the result from the local cache if a fresh copy is there.
+    cache, cache_ttl = _open_result_cache(args, load_config(args))
+    if cache is not None:
+        cache_key = cache.mk_key(q, args.connection, conn_args, search_path, query_group, args.out_filename)
+        try:
+            cached = cache.serve(cache_key, args.out_filename, cache_ttl)
+        except (IOError, OSError), exc:
+            logger.warning("couldn't serve the result from the cache: %s" % (exc,))
+            cached = None
+        run_log["result_cache"] = {"key": cache_key, "hit": cached is not None}
+        if cached is not None:
+            with _logged_run(run_log, args):
+                run_log["row_count"] = cached.get("row_count")
+                run_log["result_size"] = cached["size"]
+            return
+    # Start the --workers processes first, so they don't inherit the connection.
+    with _open_worker_pool(args) as worker_pool:
+        # Get the Redshift connection.
+        conn = connect(conn_args)
+        # Cancel the query on the server on SIGINT/SIGTERM or after --timeout.
+        with cancel.Canceller(conn, args.timeout, run_log) as canceller:
+            cs = conn.cursor()
+            set_session(cs, query_group, search_path, statement_timeout=args.timeout)
+            if args.unload:
+                if spec is not None:
+                    raise ValueError, "--partition-by doesn't apply to --unload, which is parallel already"
+                # Export via UNLOAD to S3 rather than through this connection.
+                s3_config = load_config(args).get("s3_unload")
+                if not s3_config:
+                    raise errors.RQTUnloadConfigError, "s3_unload is missing from the config"
+                with _logged_run(run_log, args):
+                    unload.run_unload(cs, q, s3_config, args.out_filename, run_log,
+                                      threads=args.unload_threads or s3_config.get("threads", unload.DEFAULT_THREADS))
+            else:
+                # Pick how the result set is fetched.
+                fetch_size = _pick_fetch_size(args, conn_args)
+                stream = _pick_stream(args, conn_args)
+                # Pick how the result set is written.
+                writer_options = _pick_writer_options(args)
+                run_log["writer_options"] = writer_options
+                writer_options = dict(writer_options, worker_pool=worker_pool)
+                if args.script:
+                    # Run the statements one by one on this session.
+                    statements = script.split_statements(q)
+                    logger.info("running a script of %d statements" % (len(statements),))
+                    _run_script(conn, statements, args.out_filename, run_log, args, fetch_size, stream,
+                                writer_options, canceller)
+                elif spec is not None:
+                    # Split the query into partitions run over as many connections.
+                    if slice_sqls is None:
+                        slice_sqls = _mk_slice_queries(cs, q, spec, args.partitions)
+                    run_log["partition_by"] = args.partition_by
+                    _run_partitioned(conn, conn_args, (query_group, search_path), slice_sqls, args.out_filename,
+                                     run_log, args, fetch_size, writer_options, canceller)
+                else:
+                    if stream and not script.can_declare_cursor(q):
+                        # DDL, INSERT, UNLOAD, SHOW, ... can't be DECLAREd as a cursor.
+                        logger.info("not a query; running it without a server-side cursor")
+                    elif stream:
+                        # A named cursor keeps the result set on the server and only
+                        # fetch_size rows at a time are held in client memory.
+                        cs = conn.cursor(name="rqt_%s" % (uuid.uuid4().hex,))
+                        cs.itersize = fetch_size
+                        logger.info("streaming result with server-side cursor fetch_size=%d" % (fetch_size,))
+                    sql = q
+                    if ckpt is not None:
+                        sql = ckpt.keyset_sql(q)
+                        writer_options = _checkpoint_writer_options(ckpt, writer_options, args.chunk_rows)
+                    # Execute the query.
+                    # FINISH: verify the output file extension makes sense.
+                    _run_select_to_file(cs, sql, args.out_filename, run_log, args, fetch_size=fetch_size,
+                                        writer_options=writer_options, canceller=canceller, inc=inc)
+                    if ckpt is not None:
+                        # The export is complete; nothing is left to resume.
+                        ckpt.remove()
+    # Keep a copy of the result for later identical runs.
+    if cache is not None and "result_size" in run_log:
+        try:
+            cache.store(cache_key, args.out_filename, {"row_count": run_log.get("row_count"),
+                                                       "qt_filename": args.qt_filename})
+        except (IOError, OSError), exc:
+            # The export itself succeeded.
+            logger.warning("couldn't store the result in the cache: %s" % (exc,))
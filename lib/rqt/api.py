@@ -13,18 +13,43 @@
 #  limitations under the License.
 
 
-import rqt.cli_parser
+import threading
+
 import rqt.actions
+import rqt.pool
+
+
+# Connection pools keyed by (config file name, connection name).
+_pools = {}
+_pools_lock = threading.Lock()
 
 
-def get_conn(conn_name):
+def get_pool(conn_name, config_filenm=None, **pool_kwargs):
     """
-    return a pycopg2 DB connection by name using the .rqt-config
+    return the shared connection pool for a connection name in the .rqt-config
+
+    pool_kwargs (max_size, idle_timeout, check_after, wait_timeout) are
+    only used when the pool is first created.
     """
-    argv = ["--connection", conn_name, "run-psql"] # run-psql is a placeholder so parser will work
-    parser = rqt.cli_parser.mk_argparser()
-    args = parser.parse_args(argv)
-    conn = rqt.actions.get_connection(args)
-    return conn
+    if config_filenm is None:
+        config_filenm = rqt.actions.get_config_filenm(None)
+    key = (config_filenm, conn_name)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            # The config is looked up per new connection, so edits to the
+            # file are picked up without restarting the pool.
+            def connect():
+                config = rqt.actions.load_config_file(config_filenm)
+                return rqt.actions.connect(rqt.actions.select_conn_args(config, conn_name))
+            pool = _pools[key] = rqt.pool.ConnectionPool(connect, **pool_kwargs)
+    return pool
 
 
+def get_conn(conn_name, config_filenm=None):
+    """
+    return a pycopg2 DB connection by name using the .rqt-config
+
+    The connection comes from a pool; close() returns it to the pool.
+    """
+    return get_pool(conn_name, config_filenm).get()
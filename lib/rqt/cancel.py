@@ -0,0 +1,186 @@
+#  Copyright 2014 Accuen
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""
+query deadlines and server-side cancellation
+
+A Canceller guards a connection while a statement runs and its result
+is fetched.  On SIGINT/SIGTERM, or once its deadline passes, it cancels
+the running statement on the server with conn.cancel(), so the query
+stops holding a WLM slot right away instead of running on after this
+process is gone.  The server-side statement_timeout (see
+actions.set_session), set SERVER_TIMEOUT_GRACE seconds later, is the
+backstop should the process die without cancelling; if it fires first
+the outcome is still "timeout".
+
+psycopg2 normally waits inside libpq, where Python signal handlers don't
+run until the statement finishes.  While a Canceller is active in the
+main thread a wait callback polls the connection from Python instead,
+so a signal is acted on immediately.
+"""
+import sys
+import time
+import errno
+import select
+import signal
+import logging
+import threading
+
+from . import errors
+
+
+logger = logging.getLogger(__name__)
+
+
+# The server-side statement_timeout is set this many seconds past the
+# client's deadline, so the client normally cancels first and knows why.
+SERVER_TIMEOUT_GRACE = 5.0
+
+
+def is_query_cancelled(exc_type):
+    """
+    return True for psycopg2's QueryCanceledError (e.g. statement_timeout)
+    """
+    # If psycopg2 isn't loaded, it didn't raise exc_type.
+    extensions = sys.modules.get("psycopg2.extensions")
+    if exc_type is None or extensions is None:
+        return False
+    return issubclass(exc_type, extensions.QueryCanceledError)
+
+
+SIGNAL_OUTCOMES = {
+    signal.SIGINT: "interrupted",
+    signal.SIGTERM: "terminated",
+}
+
+
+def _wait_select(conn):
+    """
+    a psycopg2 wait callback which lets signal handlers run while waiting
+    """
+    import psycopg2.extensions
+    while 1:
+        state = conn.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            return
+        elif state == psycopg2.extensions.POLL_READ:
+            fds = ([conn.fileno()], [], [])
+        elif state == psycopg2.extensions.POLL_WRITE:
+            fds = ([], [conn.fileno()], [])
+        else:
+            raise conn.OperationalError("bad state from poll: %s" % (state,))
+        try:
+            select.select(*fds)
+        except select.error, exc:
+            # A signal handler returned normally; keep waiting.
+            if exc.args[0] != errno.EINTR:
+                raise
+
+
+class Canceller:
+    """
+    A context manager cancelling conn's statement on a signal or after timeout seconds.
+
+    More connections (e.g. one per partition) can be guarded with add().
+
+    The outcome ("timeout", "interrupted" or "terminated") is recorded as
+    run_log["outcome"], and any exception the cancelled statement raises
+    leaves the block as RQTQueryCancelledError.  Signals are only handled
+    when used from the main thread.
+    """
+
+    def __init__(self, conn, timeout=None, run_log=None):
+        self.conns = [conn]
+        self.timeout = timeout
+        self.run_log = run_log
+        self.outcome = None
+        self.timer = None
+        self.handlers = None
+        self.wait_callback = None
+
+    def __enter__(self):
+        if isinstance(threading.current_thread(), threading._MainThread):
+            import psycopg2.extensions
+            self.handlers = dict((signum, signal.signal(signum, self._on_signal))
+                                 for signum in SIGNAL_OUTCOMES)
+            self.wait_callback = psycopg2.extensions.get_wait_callback()
+            psycopg2.extensions.set_wait_callback(_wait_select)
+        if self.timeout:
+            self.timer = threading.Timer(self.timeout, self._cancel, ("timeout",))
+            self.timer.daemon = True
+            self.timer.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.timer is not None:
+            self.timer.cancel()
+        if self.handlers is not None:
+            import psycopg2.extensions
+            for signum, handler in self.handlers.items():
+                signal.signal(signum, handler)
+            psycopg2.extensions.set_wait_callback(self.wait_callback)
+        if self.outcome is None and self.timeout and is_query_cancelled(exc_type):
+            # The server's statement_timeout fired before the client deadline.
+            self.outcome = "timeout"
+            if self.run_log is not None:
+                self.run_log["outcome"] = "timeout"
+        if exc_type is not None and self.outcome is not None and exc_type is not errors.RQTQueryCancelledError:
+            # e.g. psycopg2's QueryCanceledError, or a failed fetch
+            logger.info("cancelled statement raised %s: %s" % (exc_type.__name__, exc_val))
+            raise errors.RQTQueryCancelledError, self._describe()
+        return False
+
+    def _describe(self):
+        if self.outcome == "timeout":
+            return "query cancelled after the %ss timeout" % (self.timeout,)
+        return "query cancelled (%s)" % (self.outcome,)
+
+    def _cancel(self, outcome):
+        """
+        cancel the running statement, once; may be called from any thread
+        """
+        if self.outcome is not None:
+            return
+        self.outcome = outcome
+        if self.run_log is not None:
+            self.run_log["outcome"] = outcome
+        logger.info("cancelling the running statement (%s)" % (outcome,))
+        for conn in list(self.conns):
+            try:
+                conn.cancel()
+            except Exception, exc:
+                logger.info("cancel failed: %s" % (exc,))
+
+    def add(self, conn):
+        """
+        also cancel conn's statement
+        """
+        self.conns.append(conn)
+
+    def _on_signal(self, signum, frame):
+        self._cancel(SIGNAL_OUTCOMES[signum])
+        raise errors.RQTQueryCancelledError, self._describe()
+
+    def guard(self, batches):
+        """
+        yield from batches until cancelled
+
+        Once the result set has arrived there's nothing left to cancel on
+        the server, so the deadline is also checked between batches.
+        """
+        for batch in batches:
+            if self.outcome is not None:
+                raise errors.RQTQueryCancelledError, self._describe()
+            yield batch
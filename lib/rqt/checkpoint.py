@@ -0,0 +1,120 @@
+#  Copyright 2014 Accuen
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""
+checkpointed, resumable exports
+
+run-query --checkpoint-key KEY runs the query ordered by KEY and commits
+the output in chunks of about --chunk-rows rows (see
+sinks.CheckpointedSink).  After each chunk the last KEY written, the row
+count and the output's size go to the sidecar file OUT_FILE.checkpoint.
+After a dropped connection, run-query --resume cuts the output back to
+the checkpointed size and re-issues the query for the rows with KEY
+past the checkpoint only.  The sidecar is removed once the export is
+complete.
+
+KEY should be (nearly) unique, e.g. an id or event timestamp; rows with
+the same KEY are never split over chunks.  NULL keys are exported last.
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+
+from .query_template import sql_literal
+from .incremental import json_value
+from .util import copy_if_shared
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_CHUNK_ROWS = 1000000
+
+
+def _query_hash(q):
+    if isinstance(q, unicode):
+        q = q.encode("utf-8")
+    return hashlib.sha1(q).hexdigest()
+
+
+class Checkpoint:
+    """
+    the sidecar checkpoint file of one output file
+    """
+
+    def __init__(self, out_filenm, key, q):
+        self.filenm = out_filenm + ".checkpoint"
+        self.out_filenm = out_filenm
+        self.key = key
+        self.query_sha1 = _query_hash(q)
+        self.state = None
+        self.base_rows = 0
+
+    def load(self):
+        """
+        load the checkpoint to resume from and cut the output back to it
+
+        Returns the checkpoint state, or None if there is nothing to resume.
+        """
+        if not os.path.exists(self.filenm):
+            logger.info("no checkpoint at %r; starting from the beginning" % (self.filenm,))
+            return None
+        with open(self.filenm) as fp:
+            state = json.load(fp)
+        if state["query_sha1"] != self.query_sha1 or state["key"] != self.key:
+            raise ValueError, "checkpoint %r is for a different query or key; remove it to start over" % (self.filenm,)
+        if not os.path.exists(self.out_filenm) or os.path.getsize(self.out_filenm) < state["size"]:
+            raise ValueError, "%r is shorter than its checkpoint; remove %r to start over" % (
+                self.out_filenm, self.filenm)
+        copy_if_shared(self.out_filenm)
+        with open(self.out_filenm, "r+b") as fp:
+            fp.truncate(state["size"])
+        logger.info("resuming after %s=%r (%d rows, %d bytes committed)" % (
+            self.key, state["last_key"], state["rows"], state["size"]))
+        self.state = state
+        self.base_rows = state["rows"]
+        return state
+
+    def keyset_sql(self, q):
+        """
+        return q ordered by the key, restricted to the rows past the checkpoint
+        """
+        where = ""
+        if self.state is not None and self.state["last_key"] is None:
+            # NULL keys come last and are never split, so they were the tail.
+            where = "where 1 = 0\n"
+        elif self.state is not None:
+            where = "where %s > %s or %s is null\n" % (self.key, sql_literal(self.state["last_key"]), self.key)
+        return "select * from (\n%s\n) rqt_keyset\n%sorder by %s nulls last" % (q.strip().rstrip(";"), where, self.key)
+
+    def commit(self, key, rows, size):
+        """
+        record a committed chunk; rows counts this run's rows only
+        """
+        state = {"key": self.key, "query_sha1": self.query_sha1, "last_key": json_value(key),
+                 "rows": self.base_rows + rows, "size": size, "updated": time.time()}
+        tmp_filenm = "%s.%d.tmp" % (self.filenm, os.getpid())
+        with open(tmp_filenm, "w") as fp:
+            json.dump(state, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(tmp_filenm, self.filenm)
+        self.state = state
+
+    def remove(self):
+        if os.path.exists(self.filenm):
+            os.remove(self.filenm)
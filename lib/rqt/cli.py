@@ -18,9 +18,9 @@ CLI for Redshift queries with templates
 """
 import sys
 import logging
-import boto
 
 from . import cli_parser 
+from . import tracing
 from .version import __version__
 
 
@@ -35,10 +35,8 @@ def setup_logging():
 
 
 def main():
-    if boto.config.has_section("Boto"):
-        # Having this set to True caused some problems with S3 at some point.
-        # Maybe it still does.
-        boto.config.set("Boto", "https_validate_certificates", "False")
+    # boto is configured by rqt.s3 when it is first needed, so commands
+    # that don't touch S3 never import it.
 
     # Maybe this is nicer...
     #if len(sys.argv) == 1:
@@ -54,7 +52,7 @@ def main():
     #logging.getLogger("rqt.save_result").setLevel(logging.DEBUG if args.debug else logging.INFO) # for future reference
 
     args = parser.parse_args(sys.argv[1:])
-    args.func(args)
+    tracing.run_action(args.func, args, trace_filenm=args.trace, profile=args.profile, top=args.profile_top)
 
     return
 
@@ -21,6 +21,11 @@ from textwrap import dedent
 
 from .version import __version__
 from . import actions
+from . import tracing
+from . import partition
+from . import incremental
+from . import checkpoint
+from . import explain
 from .help import mk_help_text
 
 
@@ -33,7 +38,9 @@ COMMANDS = [
     "run-query",
     "show-query",
     "show-plan",
+    "plan-diff",
     "run-psql",
+    "flush-usage",
 ]
 
 
@@ -105,6 +112,66 @@ def add_show_plan_subparser(subparsers):
     parser.add_argument("--json_params", "-p", metavar="JSON_FILE",
         help="JSON file containing variables to add to the template namespace")
 
+    parser.add_argument("--timeout", metavar="SECONDS", type=float, default=None,
+        help="cancel the explain on the server after SECONDS (also sets statement_timeout)")
+
+    parser.add_argument("--format", choices=["raw", "tree", "json"], default="raw",
+        help="print the plan as is (default), as a tree annotated with cost shares and flags, or as JSON")
+
+    parser.add_argument("--top", metavar="N", type=int, default=10,
+        help="list the N nodes with the largest share of the plan's cost (default 10)")
+
+    parser.add_argument("--huge-rows", dest="huge_rows", metavar="ROWS", type=int, default=explain.DEFAULT_HUGE_ROWS,
+        help="flag nodes estimated to return at least ROWS rows (default %d)" % (explain.DEFAULT_HUGE_ROWS,))
+
+    parser.add_argument("--fail-on", dest="fail_on", metavar="FLAGS", default=None,
+        help="exit with status 1 if the plan has any of FLAGS (comma-separated: %s; or any)" % (",".join(explain.FLAGS),))
+
+    return parser
+
+
+def add_plan_diff_subparser(subparsers):
+    description = dedent("""\
+        Shows how the query plans of a template differ between parameter
+        sets (--json_params, given twice or more) or git revisions (--rev).
+        The first is the baseline.
+    """)
+
+    parser = subparsers.add_parser("plan-diff",
+                                   description=description,
+                                   help="Compares query plans across parameter sets or template versions.")
+    parser.set_defaults(func=actions.do_plan_diff)
+
+    parser.add_argument("qt_filename", metavar="QUERY_FILE", help="the query template file")
+
+    parser.add_argument("--json_params", "-p", metavar="JSON_FILE", action="append", default=None,
+        help="a JSON file of template variables; give it once per parameter set to compare")
+
+    parser.add_argument("--rev", metavar="REV", action="append", default=None,
+        help="a git revision of QUERY_FILE to compare; once to compare with the working copy")
+
+    parser.add_argument("--connections", metavar="N", type=int, default=4,
+        help="run the explains concurrently over up to N connections (default 4)")
+
+    parser.add_argument("--timeout", metavar="SECONDS", type=float, default=None,
+        help="cancel the explains on the server after SECONDS (also sets statement_timeout)")
+
+    parser.add_argument("--format", choices=["text", "json"], default="text",
+        help="print the differences as text (default) or JSON, which also has each plan")
+
+    parser.add_argument("--min-change", dest="min_change", metavar="FRACTION", type=float, default=0.1,
+        help="report a step whose cost or row estimate changed by more than FRACTION (default 0.1)")
+
+    parser.add_argument("--top", metavar="N", type=int, default=10,
+        help="list the N costliest steps of each plan in the JSON output (default 10)")
+
+    parser.add_argument("--huge-rows", dest="huge_rows", metavar="ROWS", type=int, default=explain.DEFAULT_HUGE_ROWS,
+        help="flag steps estimated to return at least ROWS rows (default %d)" % (explain.DEFAULT_HUGE_ROWS,))
+
+    parser.add_argument("--fail-on", dest="fail_on", metavar="FLAGS", default=None,
+        help="exit with status 1 if a plan gains any of FLAGS over the baseline (comma-separated: %s; or any)" % (
+            ",".join(explain.FLAGS),))
+
     return parser
 
 
@@ -119,11 +186,82 @@ def add_run_query_subparser(subparsers):
     parser.set_defaults(func=actions.do_run_query)
  
     parser.add_argument("qt_filename", metavar="QUERY_FILE", help="the query template file")
-    parser.add_argument("out_filename", metavar="OUT_FILE", help="the output file (must have .csv extension)")
+    parser.add_argument("out_filename", metavar="OUT_FILE", help="the output file (.csv, .txt or .jsonl, optionally with .gz/.bz2/.xz/.zst/.lz4; or .parquet, .arrow)")
 
     parser.add_argument("--json_params", metavar="JSON_FILE",
         help="JSON file containing variables to add to the template namespace")
 
+    parser.add_argument("--stream", action="store_true", default=False,
+        help="stream the result through a server-side cursor (default is taken from config)")
+
+    parser.add_argument("--fetch-size", dest="fetch_size", metavar="ROWS", type=int, default=None,
+        help="rows fetched per batch (default is taken from config, else 10000)")
+
+    parser.add_argument("--compress-level", dest="compress_level", metavar="LEVEL", type=int, default=None,
+        help="compression level for .gz/.bz2/.xz/.zst/.lz4 output (default depends on the codec)")
+
+    parser.add_argument("--compress-threads", dest="compress_threads", metavar="N", type=int, default=1,
+        help="threads compressing independent blocks of the output (default 1)")
+
+    parser.add_argument("--workers", metavar="N", type=int, default=1,
+        help="processes converting and serialising batches for text output (default 1)")
+
+    parser.add_argument("--max-rows-per-file", dest="max_rows_per_file", metavar="ROWS", type=int, default=None,
+        help="split the output into OUT-00000.EXT, OUT-00001.EXT, ... of at most ROWS rows each")
+
+    parser.add_argument("--max-bytes-per-file", dest="max_bytes_per_file", metavar="BYTES", type=int, default=None,
+        help="start a new output shard once BYTES (before compression) have been written")
+
+    parser.add_argument("--cache-ttl", dest="cache_ttl", metavar="SECONDS", type=int, default=None,
+        help="serve an identical query's result from the local result cache if younger than SECONDS "
+             "(overrides the config's per-template result_cache ttl; 0 turns the cache off)")
+
+    parser.add_argument("--unload", action="store_true", default=False,
+        help="export via UNLOAD to the config's s3_unload prefix and download the slice files")
+
+    parser.add_argument("--unload-threads", dest="unload_threads", metavar="N", type=int, default=None,
+        help="threads used to download UNLOAD slice files (default is taken from config, else 8)")
+
+    parser.add_argument("--timeout", metavar="SECONDS", type=float, default=None,
+        help="cancel the query on the server if it hasn't finished (fetch included) after SECONDS; also sets statement_timeout")
+
+    parser.add_argument("--partitions", metavar="N", type=int, default=None,
+        help="split the query into N disjoint partitions run concurrently over N connections")
+
+    parser.add_argument("--partition-by", dest="partition_by", metavar="SPEC", default=None,
+        help="how to partition: mod:COL, hash:COL, range:COL[:LO:HI] or var:NAME (a template variable)")
+
+    parser.add_argument("--partition-output", dest="partition_output", choices=partition.OUTPUTS, default="merge",
+        help="merge the partitions into OUT_FILE in partition order, or write one shard each (default merge)")
+
+    parser.add_argument("--incremental", metavar="COLUMN", default=None,
+        help="fetch only rows past the last run's high-water mark of COLUMN, given to the template as 'watermark'")
+
+    parser.add_argument("--incremental-output", dest="incremental_output", choices=incremental.MODES, default="append",
+        help="append new rows to OUT_FILE, or write them to the next shard OUT-NNNNN.EXT (default append)")
+
+    parser.add_argument("--state-file", dest="state_file", metavar="STATE_FILE", default=None,
+        help="the watermark state file (default is per template, connection, OUT_FILE and --json_params "
+             "file under $RQT_STATE_DIR or ~/.rqt-state)")
+
+    parser.add_argument("--script", action="store_true", default=False,
+        help="run the template's statements one by one in one session and transaction; each SELECT's result goes to its own file")
+
+    parser.add_argument("--checkpoint-key", dest="checkpoint_key", metavar="COLUMN", default=None,
+        help="export ordered by COLUMN, checkpointing to OUT_FILE.checkpoint after every chunk of rows")
+
+    parser.add_argument("--chunk-rows", dest="chunk_rows", metavar="N", type=int, default=checkpoint.DEFAULT_CHUNK_ROWS,
+        help="rows per checkpointed chunk (default %d)" % (checkpoint.DEFAULT_CHUNK_ROWS,))
+
+    parser.add_argument("--resume", action="store_true", default=False,
+        help="resume an interrupted --checkpoint-key export from its last checkpoint")
+
+    parser.add_argument("--progress", metavar="SECONDS", type=float, default=None,
+        help="log export progress (rows, bytes, rates, ETA) to stderr every SECONDS")
+
+    parser.add_argument("--status-file", dest="status_file", metavar="STATUS_FILE", default=None,
+        help="also keep the latest progress in STATUS_FILE as JSON (every 10s unless --progress is given)")
+
     return parser
 
 
@@ -140,6 +278,19 @@ def add_run_psql_subparser(subparsers):
     return parser
 
 
+def add_flush_usage_subparser(subparsers):
+    description = dedent("""\
+        Ships the locally spooled usage logs to S3.
+    """)
+ 
+    parser = subparsers.add_parser("flush-usage",
+                                   description=description,
+                                   help="Ships the locally spooled usage logs to S3.")
+    parser.set_defaults(func=actions.do_flush_usage)
+ 
+    return parser
+
+
 def mk_argparser():
     desc = "Utility for running Redshift queries."
 
@@ -168,6 +319,16 @@ def mk_argparser():
                         help="the connection parameters to use from the config (default is taken from config)", 
                         default="default")
 
+    parser.add_argument("--trace", metavar="TRACE_FILE", default=None,
+                        help="write timing spans for the run as a Chrome trace-event JSON file")
+
+    parser.add_argument("--profile", choices=tracing.PROFILE_KINDS, default=None,
+                        help="profile the run (cpu: cProfile, mem: tracemalloc or peak RSS per span) and print the top hotspots to stderr")
+
+    parser.add_argument("--profile-top", dest="profile_top", metavar="N", type=int,
+                        default=tracing.DEFAULT_PROFILE_TOP,
+                        help="number of hotspots --profile prints (default %d)" % (tracing.DEFAULT_PROFILE_TOP,))
+
     metavar = "SUBCOMMAND"
     subparsers = parser.add_subparsers(description="Use 'rqt SUBCOMMAND ...' to run rqt.",
                                        dest="mode", metavar=metavar)
@@ -177,7 +338,9 @@ def mk_argparser():
     add_run_query_subparser(subparsers)
     add_show_query_subparser(subparsers)
     add_show_plan_subparser(subparsers)
+    add_plan_diff_subparser(subparsers)
     add_run_psql_subparser(subparsers)
+    add_flush_usage_subparser(subparsers)
 
     return parser
 
@@ -0,0 +1,214 @@
+#  Copyright 2014 Accuen
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""
+compressed output streams picked by file extension
+
+With more than one thread the output is cut into blocks which are
+compressed independently on a thread pool and written out in order.
+Each block is a complete gzip member (or bzip2/xz stream, zstd/lz4
+frame), and the stock command line tools read such concatenations as
+one stream.
+"""
+import sys
+import zlib
+import collections
+
+from . import tracing
+
+
+DEFAULT_BLOCK_SIZE = 4 << 20
+
+
+CODECS = {
+    ".gz": "gzip",
+    ".bz2": "bz2",
+    ".xz": "xz",
+    ".zst": "zstd",
+    ".lz4": "lz4",
+}
+
+
+DEFAULT_LEVELS = {
+    "gzip": 6,
+    "bz2": 9,
+    "xz": 6,
+    "zstd": 3,
+    "lz4": 0,
+}
+
+
+def split_codec(filenm):
+    """
+    return (filenm without the compression extension, codec name or None)
+    """
+    for ext, codec in CODECS.items():
+        if filenm.endswith(ext):
+            return filenm[:-len(ext)], codec
+    return filenm, None
+
+
+########################################################################
+
+
+class _LZ4Compressor:
+    """
+    lz4.frame compressor with the compress()/flush() interface of zlib's
+    """
+
+    def __init__(self, level):
+        import lz4.frame # optional dependency
+        self.compressor = lz4.frame.LZ4FrameCompressor(compression_level=level)
+        self.started = False
+
+    def _begin(self):
+        if self.started:
+            return ""
+        self.started = True
+        return self.compressor.begin()
+
+    def compress(self, data):
+        return self._begin() + self.compressor.compress(data)
+
+    def flush(self):
+        return self._begin() + self.compressor.flush()
+
+
+def _import_lzma():
+    try:
+        import lzma
+    except ImportError:
+        from backports import lzma # optional dependency on Python 2
+    return lzma
+
+
+def mk_compressor(codec, level=None):
+    """
+    return a streaming compressor object with compress() and flush()
+    """
+    if level is None:
+        level = DEFAULT_LEVELS[codec]
+    if codec == "gzip":
+        # wbits=31 makes zlib write a gzip header and trailer.
+        return zlib.compressobj(level, zlib.DEFLATED, 31)
+    elif codec == "bz2":
+        import bz2
+        return bz2.BZ2Compressor(level)
+    elif codec == "xz":
+        return _import_lzma().LZMACompressor(preset=level)
+    elif codec == "zstd":
+        import zstandard # optional dependency
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    elif codec == "lz4":
+        return _LZ4Compressor(level)
+    raise ValueError, "unsupported compression codec: %r" % (codec,)
+
+
+def compress_block(codec, data, level=None):
+    """
+    return data compressed as one self-contained member/stream/frame
+    """
+    with tracing.span("compress", codec=codec, bytes=len(data)):
+        compressor = mk_compressor(codec, level)
+        return compressor.compress(data) + compressor.flush()
+
+
+########################################################################
+
+
+class CompressedWriter:
+    """
+    A write-only file object compressing into "fileobj" on this thread.
+    """
+
+    def __init__(self, fileobj, codec, level=None):
+        self.fileobj = fileobj
+        self.compressor = mk_compressor(codec, level)
+
+    def write(self, data):
+        with tracing.span("compress", bytes=len(data)):
+            data = self.compressor.compress(data)
+        self.fileobj.write(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.fileobj.write(self.compressor.flush())
+        if self.fileobj is not sys.stdout:
+            self.fileobj.close()
+
+
+class ParallelCompressedWriter:
+    """
+    A write-only file object compressing blocks into "fileobj" on a thread pool.
+
+    At most 2*threads blocks are in flight, so a slow consumer holds up
+    the writer instead of growing memory.
+    """
+
+    def __init__(self, fileobj, codec, level=None, threads=2, block_size=DEFAULT_BLOCK_SIZE):
+        from multiprocessing.pool import ThreadPool # lazy import; only needed with threads
+        self.fileobj = fileobj
+        self.codec = codec
+        self.level = level
+        self.block_size = block_size
+        self.pool = ThreadPool(threads)
+        self.max_pending = 2 * threads
+        self.pending = collections.deque()
+        self.block_count = 0
+        self.buf = []
+        self.buf_len = 0
+
+    def write(self, data):
+        self.buf.append(data)
+        self.buf_len += len(data)
+        if self.buf_len >= self.block_size:
+            self._submit()
+
+    def _submit(self):
+        data = "".join(self.buf)
+        self.buf = []
+        self.buf_len = 0
+        self.pending.append(self.pool.apply_async(compress_block, (self.codec, data, self.level)))
+        self.block_count += 1
+        while len(self.pending) > self.max_pending:
+            self._write_next()
+
+    def _write_next(self):
+        self.fileobj.write(self.pending.popleft().get())
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.buf or self.block_count == 0:
+            # An empty result still needs one valid (empty) block.
+            self._submit()
+        while self.pending:
+            self._write_next()
+        self.pool.close()
+        self.pool.join()
+        if self.fileobj is not sys.stdout:
+            self.fileobj.close()
+
+
+def open_compressed(fileobj, codec, level=None, threads=1):
+    """
+    return a write-only file object compressing into fileobj
+    """
+    if threads > 1:
+        return ParallelCompressedWriter(fileobj, codec, level, threads)
+    return CompressedWriter(fileobj, codec, level)
@@ -0,0 +1,213 @@
+#  Copyright 2014 Accuen
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""
+per-column converters compiled from cursor.description
+
+The conversion plan is built once per result set from the psycopg2
+type codes (PostgreSQL type OIDs) and then applied column-wise to each
+fetched batch, so there is no per-cell type dispatch.
+"""
+
+import json
+
+
+NULL = "NULL"
+
+
+# PostgreSQL type OIDs grouped into the kinds of column rqt writes out.
+TYPE_KINDS = {
+    16: "bool",         # boolean
+    18: "text",         # "char"
+    19: "text",         # name
+    20: "int",          # int8
+    21: "int",          # int2
+    23: "int",          # int4
+    25: "text",         # text
+    26: "int",          # oid
+    700: "float",       # float4
+    701: "float",       # float8
+    1042: "text",       # bpchar
+    1043: "text",       # varchar
+    1082: "date",       # date
+    1083: "time",       # time
+    1114: "timestamp",  # timestamp
+    1184: "timestamp",  # timestamptz
+    1266: "time",       # timetz
+    1700: "numeric",    # numeric
+}
+
+
+def _cell_to_bytes(x):
+    """
+    return any result cell as a UTF-8 byte string
+    """
+    if type(x) is str:
+        return x
+    elif x is None:
+        return NULL
+    elif type(x) is unicode:
+        return x.encode("utf-8")
+    else:
+        return str(x)
+
+
+def _text_column(col):
+    # The str's coming out of Redshift are already UTF-8 byte arrays,
+    # so only NULLs need replacing.
+    if None in col:
+        return [NULL if x is None else x for x in col]
+    return col
+
+
+def _str_column(col):
+    # ints, numerics, floats, booleans, dates and timestamps all have
+    # an ASCII str() form.
+    if None in col:
+        return [NULL if x is None else str(x) for x in col]
+    return map(str, col)
+
+
+def _any_column(col):
+    return map(_cell_to_bytes, col)
+
+
+KIND_CONVERTERS = {
+    "text": _text_column,
+    "int": _str_column,
+    "float": _str_column,
+    "numeric": _str_column,
+    "bool": _str_column,
+    "date": _str_column,
+    "time": _str_column,
+    "timestamp": _str_column,
+    "other": _any_column,
+}
+
+
+########################################################################
+# JSON tokens
+########################################################################
+
+
+JSON_NULL = "null"
+
+FLOAT_INF = float("inf")
+
+_encode_json_string = json.encoder.encode_basestring_ascii
+
+
+def _json_string(s):
+    # Invalid UTF-8 passes through to CSV as is; JSON has to have text,
+    # so bad bytes become U+FFFD.
+    try:
+        return _encode_json_string(s)
+    except UnicodeDecodeError:
+        return _encode_json_string(s.decode("utf-8", "replace"))
+
+
+def _json_text_column(col):
+    try:
+        return [JSON_NULL if x is None else _encode_json_string(x) for x in col]
+    except UnicodeDecodeError:
+        return [JSON_NULL if x is None else _json_string(x) for x in col]
+
+
+def _json_number_column(col):
+    # int and Decimal str() forms are valid JSON numbers.
+    return [JSON_NULL if x is None else str(x) for x in col]
+
+
+def _json_float_column(col):
+    # NaN and infinities have no JSON form.
+    return [JSON_NULL if x is None or x != x or x in (FLOAT_INF, -FLOAT_INF) else repr(x)
+            for x in col]
+
+
+def _json_bool_column(col):
+    return [JSON_NULL if x is None else ("true" if x else "false") for x in col]
+
+
+def _json_quoted_column(col):
+    return [JSON_NULL if x is None else '"%s"' % (x,) for x in col]
+
+
+def _json_any_column(col):
+    return [JSON_NULL if x is None else _json_string(_cell_to_bytes(x)) for x in col]
+
+
+KIND_JSON_CONVERTERS = {
+    "text": _json_text_column,
+    "int": _json_number_column,
+    "float": _json_float_column,
+    "numeric": _json_number_column,
+    "bool": _json_bool_column,
+    "date": _json_quoted_column,
+    "time": _json_quoted_column,
+    "timestamp": _json_quoted_column,
+    "other": _json_any_column,
+}
+
+
+########################################################################
+
+
+class ConversionPlan:
+    """
+    column names, kinds and converters for one result set
+    """
+
+    def __init__(self, description):
+        self.col_nms = [desc[0] for desc in description]
+        self.type_codes = [desc[1] for desc in description]
+        self.kinds = [TYPE_KINDS.get(type_code, "other") for type_code in self.type_codes]
+        self.converters = [KIND_CONVERTERS[kind] for kind in self.kinds]
+        self.json_converters = [KIND_JSON_CONVERTERS[kind] for kind in self.kinds]
+        # psycopg2 reports precision and scale for numeric columns.
+        self.precisions = [desc[4] if len(desc) > 5 else None for desc in description]
+        self.scales = [desc[5] if len(desc) > 5 else None for desc in description]
+
+    def to_bytes(self, batch):
+        """
+        return the batch as rows of UTF-8 byte strings
+        """
+        if not batch:
+            return []
+        cols = zip(*batch)
+        return zip(*[conv(col) for conv, col in zip(self.converters, cols)])
+
+    def to_json_tokens(self, batch):
+        """
+        return the batch as rows of JSON value tokens
+        """
+        if not batch:
+            return []
+        cols = zip(*batch)
+        return zip(*[conv(col) for conv, col in zip(self.json_converters, cols)])
+
+    def to_columns(self, batch):
+        """
+        return the batch as a list of column tuples with the original values
+        """
+        if not batch:
+            return [() for col_nm in self.col_nms]
+        return zip(*batch)
+
+
+def compile_plan(description):
+    """
+    return the ConversionPlan for a cursor.description
+    """
+    return ConversionPlan(description)
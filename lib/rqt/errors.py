@@ -24,3 +24,15 @@ class RQTMissingConfigError(RQTError):
 class RQTInvalidConnectionError(RQTError):
     "exception raised when an unknown connection key is used"
 
+
+
+class RQTUnloadConfigError(RQTError):
+    "exception raised when UNLOAD is requested without an s3_unload config"
+
+
+class RQTPoolExhaustedError(RQTError):
+    "exception raised when no pooled connection is returned in time"
+
+
+class RQTQueryCancelledError(RQTError):
+    "exception raised when a query is cancelled by a signal or its --timeout deadline"
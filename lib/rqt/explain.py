@@ -0,0 +1,345 @@
+#  Copyright 2014 Accuen
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""
+structured EXPLAIN plans
+
+parse() turns the rows of a Redshift EXPLAIN into a tree of Nodes with
+their cost, rows, width and distribution (DS_*) strategy.  analyze()
+works out each node's share of the plan's cost and flags the patterns
+that usually make a query slow:
+
+    * bcast       -- DS_BCAST_INNER, the inner table is broadcast to every node
+    * dist_both   -- DS_DIST_BOTH, both sides of a join are redistributed
+    * nested_loop -- a nested loop join, usually a missing join predicate
+    * huge_rows   -- a row estimate of at least huge_rows
+
+Costs are cumulative (a node's cost includes its children's), so a
+node's own cost is its total less its children's totals.  Leader node
+steps have 1,000,000,000,000 added to their cost; that offset is left out.
+
+diff() lines up two plans of (versions of) the same query step by step
+and reports the steps added, removed, redistributed or changed in cost.
+"""
+import re
+import difflib
+
+
+FLAGS = ("bcast", "dist_both", "nested_loop", "huge_rows")
+
+DEFAULT_HUGE_ROWS = 1000000000
+
+LEADER_COST = 1000000000000.0
+
+_NODE = re.compile(r"^(\s*)(->\s+)?(.*?)\s+\(cost=([\d.]+)\.\.([\d.]+) rows=(\d+) width=(\d+)\)\s*$")
+
+_DIST = re.compile(r"\b(DS_[A-Z_]+)\b")
+
+
+def parse_flags(s):
+    """
+    return the flags in a comma-separated list; "any" is all of them
+    """
+    if s == "any":
+        return FLAGS
+    flags = tuple(flag.strip() for flag in s.split(",") if flag.strip())
+    unknown = [flag for flag in flags if flag not in FLAGS]
+    if unknown or not flags:
+        raise ValueError, "unknown plan flags %r; expected any or some of %s" % (s, ",".join(FLAGS))
+    return flags
+
+
+def _cost(s):
+    cost = float(s)
+    if cost >= LEADER_COST:
+        # Rounded back to the two decimals of the plan.
+        cost = round(cost - LEADER_COST, 2)
+    return cost
+
+
+class Node:
+    """
+    a step of a query plan
+    """
+
+    def __init__(self, op, startup_cost, total_cost, rows, width, indent):
+        self.op = op
+        match = _DIST.search(op)
+        self.dist = match.group(1) if match else None
+        self.startup_cost = startup_cost
+        self.total_cost = total_cost
+        self.rows = rows
+        self.width = width
+        self.indent = indent
+        self.details = []
+        self.children = []
+        self.own_cost = total_cost
+        self.cost_share = 0.0
+        self.flags = []
+
+    def walk(self):
+        """
+        yield this node and its descendants, depth first
+        """
+        yield self
+        for child in self.children:
+            for node in child.walk():
+                yield node
+
+    def as_dict(self):
+        return {
+            "op": self.op,
+            "dist": self.dist,
+            "startup_cost": self.startup_cost,
+            "total_cost": self.total_cost,
+            "own_cost": self.own_cost,
+            "cost_share": self.cost_share,
+            "rows": self.rows,
+            "width": self.width,
+            "details": self.details,
+            "flags": self.flags,
+            "children": [child.as_dict() for child in self.children],
+        }
+
+
+class Plan:
+    """
+    a parsed plan: its root Node and the warnings printed after the plan
+    """
+
+    def __init__(self, root, warnings):
+        self.root = root
+        self.warnings = warnings
+
+    def nodes(self):
+        return list(self.root.walk()) if self.root is not None else []
+
+    def hotspots(self, top=None):
+        """
+        return the nodes by descending cost share, flagged ones first on ties
+        """
+        ranked = sorted(self.nodes(), key=lambda node: (-node.cost_share, -len(node.flags)))
+        return ranked[:top] if top else ranked
+
+    def flagged(self, flags=FLAGS):
+        """
+        return the nodes with any of flags
+        """
+        return [node for node in self.nodes() if set(node.flags) & set(flags)]
+
+    def as_dict(self, top=None):
+        return {
+            "plan": self.root.as_dict() if self.root is not None else None,
+            "warnings": self.warnings,
+            "hotspots": [_hotspot_dict(node) for node in self.hotspots(top)],
+        }
+
+
+def _hotspot_dict(node):
+    return {"op": node.op, "cost_share": node.cost_share, "own_cost": node.own_cost,
+            "rows": node.rows, "flags": node.flags}
+
+
+def parse(lines):
+    """
+    return the Plan for the lines of an EXPLAIN
+    """
+    root = None
+    stack = [] # the open nodes, outermost first
+    warnings = []
+    for line in lines:
+        line = line.rstrip()
+        if not line.strip():
+            continue
+        match = _NODE.match(line)
+        if match is not None:
+            indent = len(match.group(1)) + len(match.group(2) or "")
+            node = Node(match.group(3).strip(), _cost(match.group(4)), _cost(match.group(5)),
+                        int(match.group(6)), int(match.group(7)), indent)
+            while stack and stack[-1].indent >= indent:
+                stack.pop()
+            if stack:
+                stack[-1].children.append(node)
+            elif root is None:
+                root = node
+            else:
+                raise ValueError, "unexpected second root in plan: %r" % (line,)
+            stack.append(node)
+        elif line.startswith("-----"):
+            # e.g. "----- Nested Loop Join in the query plan - review the join predicates ... -----"
+            warnings.append(line.strip("- "))
+        elif stack:
+            # A detail (Hash Cond, Filter, ...) of the innermost node left of it.
+            indent = len(line) - len(line.lstrip())
+            while len(stack) > 1 and stack[-1].indent >= indent:
+                stack.pop()
+            stack[-1].details.append(line.strip())
+        else:
+            warnings.append(line.strip())
+    return Plan(root, warnings)
+
+
+def analyze(plan, huge_rows=DEFAULT_HUGE_ROWS):
+    """
+    set the own cost, cost share and flags of every node of plan; returns plan
+    """
+    if plan.root is None:
+        return plan
+    for node in plan.nodes():
+        node.own_cost = max(node.total_cost - sum(child.total_cost for child in node.children), 0.0)
+    total = sum(node.own_cost for node in plan.nodes())
+    for node in plan.nodes():
+        node.cost_share = node.own_cost / total if total else 0.0
+        node.flags = []
+        if node.dist == "DS_BCAST_INNER":
+            node.flags.append("bcast")
+        if node.dist == "DS_DIST_BOTH":
+            node.flags.append("dist_both")
+        if "Nested Loop" in node.op:
+            node.flags.append("nested_loop")
+        if node.rows >= huge_rows:
+            node.flags.append("huge_rows")
+    return plan
+
+
+_FLAG_NOTES = {
+    "bcast": "inner table broadcast to every node",
+    "dist_both": "both join inputs redistributed",
+    "nested_loop": "nested loop join; check the join predicates",
+    "huge_rows": "huge row estimate",
+}
+
+
+def format_tree(plan):
+    """
+    return plan as an indented tree annotated with cost shares and flags
+    """
+    lines = []
+
+    def add(node, depth):
+        note = "; ".join(_FLAG_NOTES[flag] for flag in node.flags)
+        lines.append("%5.1f%% %s%s (cost=%.2f..%.2f rows=%d width=%d)%s" % (
+            100*node.cost_share, "   "*depth, node.op, node.startup_cost, node.total_cost, node.rows, node.width,
+            "  <-- " + note if note else ""))
+        for detail in node.details:
+            lines.append("       %s    %s" % ("   "*depth, detail))
+        for child in node.children:
+            add(child, depth + 1)
+
+    if plan.root is not None:
+        add(plan.root, 0)
+    for warning in plan.warnings:
+        lines.append("warning: %s" % (warning,))
+    return "\n".join(lines)
+
+
+def format_hotspots(plan, top):
+    """
+    return the top nodes by cost share, one per line
+    """
+    lines = []
+    for node in plan.hotspots(top):
+        lines.append(("%5.1f%%  %-50s rows=%-12d %s" % (
+            100*node.cost_share, node.op, node.rows, ",".join(node.flags))).rstrip())
+    return "\n".join(lines)
+
+
+def _shape(node):
+    """
+    return node's operation without its distribution strategy
+    """
+    return " ".join(_DIST.sub("", node.op).split())
+
+
+def _flatten(node, depth=0):
+    """
+    return [(depth, node)] for node and its descendants, depth first
+    """
+    nodes = [(depth, node)]
+    for child in node.children:
+        nodes.extend(_flatten(child, depth + 1))
+    return nodes
+
+
+def _changed(a, b, min_change):
+    if a == b:
+        return False
+    return abs(b - a) > min_change * max(abs(a), abs(b))
+
+
+def diff(base, other, min_change=0.1):
+    """
+    return the differences of plan other from plan base (both analyzed)
+
+    Steps are matched by their depth and operation (less the DS_*
+    strategy).  Matched steps are reported if their distribution changed
+    or their cost or row estimate changed by more than min_change (a
+    fraction).  "new_flags" lists the flags other has that base doesn't.
+    """
+    base_nodes = _flatten(base.root) if base.root is not None else []
+    other_nodes = _flatten(other.root) if other.root is not None else []
+    matcher = difflib.SequenceMatcher(None, [(d, _shape(n)) for d, n in base_nodes],
+                                      [(d, _shape(n)) for d, n in other_nodes], autojunk=False)
+    added, removed, changed, new_flags = [], [], [], []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            for (depth, a), (_, b) in zip(base_nodes[i1:i2], other_nodes[j1:j2]):
+                if a.dist != b.dist or _changed(a.total_cost, b.total_cost, min_change) or \
+                        _changed(a.rows, b.rows, min_change):
+                    changed.append({"op": _shape(b), "depth": depth, "dist": [a.dist, b.dist],
+                                    "total_cost": [a.total_cost, b.total_cost], "rows": [a.rows, b.rows]})
+                flags = [flag for flag in b.flags if flag not in a.flags]
+                if flags:
+                    new_flags.append({"op": b.op, "flags": flags})
+            continue
+        removed.extend({"op": n.op, "depth": d} for d, n in base_nodes[i1:i2])
+        added.extend({"op": n.op, "depth": d} for d, n in other_nodes[j1:j2])
+        new_flags.extend({"op": n.op, "flags": n.flags} for d, n in other_nodes[j1:j2] if n.flags)
+    base_cost = base.root.total_cost if base.root is not None else 0.0
+    other_cost = other.root.total_cost if other.root is not None else 0.0
+    return {
+        "total_cost": [base_cost, other_cost],
+        "cost_ratio": other_cost / base_cost if base_cost else None,
+        "same_shape": not added and not removed,
+        "added": added,
+        "removed": removed,
+        "changed": changed,
+        "new_flags": new_flags,
+    }
+
+
+def format_diff(base_label, label, d):
+    """
+    return a diff() as text
+    """
+    lines = ["== %s vs %s" % (label, base_label)]
+    ratio = " (x%.2f)" % (d["cost_ratio"],) if d["cost_ratio"] is not None else ""
+    lines.append("total cost %.2f -> %.2f%s" % (d["total_cost"][0], d["total_cost"][1], ratio))
+    if d["same_shape"] and not d["changed"]:
+        lines.append("same plan")
+    for node in d["removed"]:
+        lines.append("- %s%s" % ("  "*node["depth"], node["op"]))
+    for node in d["added"]:
+        lines.append("+ %s%s" % ("  "*node["depth"], node["op"]))
+    for node in d["changed"]:
+        notes = []
+        if node["dist"][0] != node["dist"][1]:
+            notes.append("%s -> %s" % (node["dist"][0] or "no redistribution", node["dist"][1] or "no redistribution"))
+        notes.append("cost %.2f -> %.2f" % tuple(node["total_cost"]))
+        notes.append("rows %d -> %d" % tuple(node["rows"]))
+        lines.append("~ %s%s: %s" % ("  "*node["depth"], node["op"], "; ".join(notes)))
+    for node in d["new_flags"]:
+        lines.append("! %s (%s)" % (node["op"], ",".join(node["flags"])))
+    return "\n".join(lines)
@@ -30,11 +30,23 @@ def mk_help_text(commands):
 
         == rqt Features ==
             * download query result to CSV file
+            * or to JSON Lines (.jsonl), Parquet (.parquet) or Arrow IPC (.arrow, .feather) files
             * template with Jinja2 or Mako; template engine auto-detection
+            * compiled templates are cached under $RQT_CACHE_DIR (default ~/.cache/rqt), if only you can write to it
             * expand template without execution (using show-query)
             * view query plan (using show-plan)
+            * compare plans across parameter sets or template versions (using plan-diff)
             * manage connection params via config file
             * use default WLM query_group via config file or option (--query_group=GROUP)
+            * stream large results through a server-side cursor (--stream, --fetch-size=ROWS)
+            * export very large results via UNLOAD to S3 with parallel download (--unload)
+            * compress output by extension: .gz, .bz2, .xz, .zst, .lz4 (multi-threaded with --compress-threads)
+            * split a query into partitions extracted concurrently over several connections (--partitions)
+            * incremental extraction from a saved high-water mark (--incremental)
+            * resume an export after a dropped connection (--checkpoint-key, --resume)
+            * run multi-statement scripts in one session, one output per SELECT (--script)
+            * find plan hotspots and fail CI on broadcasts or nested loops (show-plan --fail-on)
+            * trace and profile a run without code changes (--trace, --profile)
 
         == rqt quick reference ==
             * Global options:
@@ -45,17 +57,94 @@ def mk_help_text(commands):
                     * show debug output
                 * --query_group=GROUP
                     * define WLM query_group to use (default is from config)
+                * --trace=TRACE_FILE
+                    * write timing spans (config load, template expansion, connect, SET, execute,
+                      first row, fetch, convert, write, compress, usage log) as a Chrome
+                      trace-event file; open it in chrome://tracing or ui.perfetto.dev
+                * --profile=cpu|mem [--profile-top=N]
+                    * print the top N hotspots to stderr: cProfile over all pipeline threads,
+                      or tracemalloc (peak RSS growth per span where tracemalloc is missing)
             * Create a config file:
                 * rqt create-config
                     * Creates ~/.rqt-config if it does not exist.
             * Run a query:
                 * rqt run-query QUERY_FILE OUTPUT_FILE [--json_params=PARAMS_FILE] [--query_group=GROUP]
+                    * --stream uses a server-side cursor so memory stays flat for any result size
+                    * --fetch-size=ROWS sets the rows per fetch (config: "fetch_size" per connection)
+                    * the "stream" and "fetch_size" connection keys in the config set the defaults
+                    * --workers=N converts and serialises batches on N processes (text output only)
+                    * --max-rows-per-file=ROWS and/or --max-bytes-per-file=BYTES split the output into
+                      shards OUT-00000.EXT, OUT-00001.EXT, ...; each shard appears once it is complete,
+                      and each is written and compressed on a thread of its own, two shards at a time
+                    * --cache-ttl=SECONDS reuses the result of an identical query (same SQL, connection,
+                      search_path, query_group and output type) run less than SECONDS ago; the
+                      config's "result_cache" section sets "dir" and "max_bytes" (default 10 GB),
+                      and its "ttl" object maps template name patterns (e.g. "daily_*.sql") to
+                      default TTLs in seconds, so those templates are cached without --cache-ttl
+                      (--cache-ttl=0 turns the cache off); the cache dir is created private (0700)
+                    * --unload runs UNLOAD ... PARALLEL ON MANIFEST to the config's "s3_unload"
+                      prefix and merges the slice files into OUTPUT_FILE (.csv, .txt, .gz); the
+                      slice files are deleted afterwards, even on failure, unless "keep" is set.
+                      It doesn't take --compress-*, --workers or --max-*-per-file
+                    * --compress-level=LEVEL and --compress-threads=N tune compressed output; with
+                      N > 1 blocks are compressed in parallel and concatenated in order
+                    * --unload-threads=N sets the slice download threads (config: "s3_unload" "threads")
+                    * --timeout=SECONDS sets statement_timeout and cancels the query on the server
+                      once SECONDS pass (fetching included); SIGINT/SIGTERM cancel it too, and the
+                      run log's "outcome" says ok, error, timeout, interrupted or terminated
+                    * --partitions=N --partition-by=SPEC splits the query into N disjoint partitions
+                      run concurrently over N connections; SPEC is mod:COL (integer column),
+                      hash:COL, range:COL[:LO:HI] (equal-width ranges, MIN/MAX looked up unless
+                      given) or var:NAME (the template is expanded per partition with NAME,
+                      "partition" and "partitions"; a list NAME gives one partition per element)
+                    * --partition-output=merge|shards merges the partitions into OUTPUT_FILE in
+                      partition order (default; queries overlap, writing is sequential) or writes
+                      partition i to OUT-0000i.EXT (fully parallel); partitions are read through
+                      server-side cursors, --fetch-size rows at a time
+                    * --incremental=COLUMN passes the largest COLUMN value of the last successful run
+                      to the template as "watermark" (None at first) and saves the new one afterwards;
+                      the state lives under $RQT_STATE_DIR (default ~/.rqt-state) per template,
+                      connection, OUTPUT_FILE and --json_params file, or in --state-file=STATE_FILE
+                    * --incremental-output=append|shard appends the new rows to OUTPUT_FILE (text
+                      formats, compressed or not) or writes them to the next shard OUT-NNNNN.EXT
+                    * --script runs the template's statements (split at semicolons outside quotes
+                      and comments) one by one in one session and transaction, committed at the
+                      end; a single SELECT writes OUTPUT_FILE, several write OUT-NNNNN.EXT in order
+                    * --checkpoint-key=COLUMN orders the result by COLUMN and commits OUTPUT_FILE
+                      (text formats) every --chunk-rows=N rows (default 1000000), recording the
+                      last COLUMN value in OUTPUT_FILE.checkpoint; --resume cuts the file back to
+                      the checkpoint and fetches only the rest
+                    * --progress=SECONDS logs rows, bytes before/after compression, rows/s, MB/s
+                      and (when the row count is known) an ETA to stderr every SECONDS
+                    * --status-file=STATUS_FILE keeps the latest progress there as JSON, replaced
+                      atomically; "phase" is query, export, done or failed, "updated" is a timestamp
             * Show a query after template expansion:
                 * rqt show-query QUERY_FILE [--json_params=PARAMS_FILE]
             * Show a query plan:
-                * rqt show-plan QUERY_FILE [--json_params=PARAMS_FILE]
+                * rqt show-plan QUERY_FILE [--json_params=PARAMS_FILE] [--timeout=SECONDS]
+                    * --format=tree prints the plan annotated with each step's share of the cost
+                      and its flags, then the --top=N costliest steps; --format=json the same as JSON
+                    * flags: bcast (DS_BCAST_INNER), dist_both (DS_DIST_BOTH), nested_loop, and
+                      huge_rows (a row estimate of at least --huge-rows=ROWS, default 1000000000)
+                    * --fail-on=FLAGS (comma-separated, or any) exits with status 1 if a step has
+                      one of FLAGS, e.g. as a pre-flight check in CI
+            * Compare query plans:
+                * rqt plan-diff QUERY_FILE -p PARAMS_FILE1 -p PARAMS_FILE2 [...]
+                * rqt plan-diff QUERY_FILE --rev=REV1 [--rev=REV2] [--json_params=PARAMS_FILE]
+                    * the first parameter set or revision is the baseline; one --rev is compared
+                      with the working copy; the explains run over --connections=N (default 4)
+                    * reports steps added (+), removed (-), redistributed or changed in cost or
+                      rows by more than --min-change=FRACTION (~), and newly flagged steps (!)
+                    * --fail-on=FLAGS exits with status 1 if a plan gains one of FLAGS
             * Start a psql session:
                 * rqt run-psql
+            * Ship spooled usage logs to S3 now:
+                * rqt flush-usage
+                    * run logs are spooled locally and shipped in the background as gzipped
+                      JSON Lines objects; the config's "s3_usage_data" section may set
+                      "spool_dir", "batch_records" (default 1000) and "batch_seconds" (default 3600)
+                    * template and query text is uploaded once per distinct body to "body_prefix"
+                      (default KEY_PREFIX/bodies) as SHA256.sql.gz and referenced by hash
     """ % (", ".join(commands)) )
     return help_text
 
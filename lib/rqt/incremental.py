@@ -0,0 +1,204 @@
+#  Copyright 2014 Accuen
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""
+incremental extraction driven by a high-water mark
+
+run-query --incremental COL keeps, per query template, connection,
+output file and --json_params file, a small JSON state file holding the
+largest COL value exported so far.
+The template sees it as "watermark" (None on the first run) and is
+expected to select only newer rows, e.g.
+
+    select * from events
+    {% if watermark is not none %}where event_id > {{ watermark }}{% endif %}
+
+The new rows are written to a hidden delta file next to the output and,
+once the export has succeeded, either appended to the output (text
+formats; compressed output gets another gzip member/stream/frame) or
+renamed to the next shard OUT-NNNNN.EXT.  Only then is the state file
+replaced, atomically, with the new watermark.  The state also records
+the output's size after each append, so output left over from an
+append that didn't finish is cut off on the next run.
+"""
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+
+from . import compress
+from .sinks import shard_filenm
+from .util import copy_if_shared
+
+
+logger = logging.getLogger(__name__)
+
+
+MODES = ["append", "shard"]
+
+
+def get_state_dir():
+    return os.path.expanduser(os.environ.get("RQT_STATE_DIR", "~/.rqt-state"))
+
+
+def state_filenm(qt_filenm, conn_name, out_filenm, json_filenm=None):
+    """
+    return the default state file for a query template, connection, output and parameter file
+
+    Runs of one template into different outputs, or with different
+    --json_params files, each keep their own watermark.
+    """
+    key = "\0".join((os.path.abspath(qt_filenm), conn_name, os.path.abspath(out_filenm),
+                     os.path.abspath(json_filenm) if json_filenm else ""))
+    return os.path.join(get_state_dir(), hashlib.sha1(key).hexdigest() + ".json")
+
+
+def json_value(value):
+    """
+    return a key or watermark value as saved in a JSON state file
+    """
+    # Numbers stay numbers; timestamps, dates, Decimals and strings are
+    # kept in their str() form, which is also a valid SQL literal body.
+    if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+        return value
+    if isinstance(value, unicode):
+        return value
+    return str(value)
+
+
+def _appendable(filenm):
+    base = compress.split_codec(filenm)[0]
+    return base.endswith(".csv") or base.endswith(".txt") or base.endswith(".jsonl")
+
+
+class Incremental:
+    """
+    one incremental run: the watermark going in, the delta file, and the commit
+    """
+
+    def __init__(self, state_filenm, column, out_filenm, mode="append"):
+        if mode == "append" and not _appendable(out_filenm):
+            raise ValueError, "only text output can be appended to; use --incremental-output=shard for %r" % (out_filenm,)
+        self.state_filenm = state_filenm
+        self.column = column
+        self.out_filenm = out_filenm
+        self.mode = mode
+        self.state = {}
+        if os.path.exists(state_filenm):
+            with open(state_filenm) as fp:
+                self.state = json.load(fp)
+            if self.state.get("column") not in (None, column):
+                raise ValueError, "state file %r tracks column %r, not %r" % (
+                    state_filenm, self.state["column"], column)
+        self.watermark = self.state.get("watermark")
+        self.new_watermark = None
+        self.rows = 0
+        dirnm, basenm = os.path.split(out_filenm)
+        self.delta_filenm = os.path.join(dirnm, ".delta-" + basenm)
+        # Without output yet, the delta becomes the output, header and all.
+        self.header = not (mode == "append" and self._existing_size())
+
+    def _existing_size(self):
+        """
+        return the size of the output to append to, after cutting off a partial append
+        """
+        if not os.path.exists(self.out_filenm):
+            if "output_size" in self.state:
+                logger.info("%r is gone; starting it again from watermark %r" % (self.out_filenm, self.watermark))
+            return 0
+        # It may be served by hard link from the result cache.
+        copy_if_shared(self.out_filenm)
+        size = os.path.getsize(self.out_filenm)
+        committed = self.state.get("output_size")
+        if committed is not None and size > committed:
+            logger.info("cutting %d bytes of an unfinished append off %r" % (size - committed, self.out_filenm))
+            with open(self.out_filenm, "r+b") as fp:
+                fp.truncate(committed)
+            size = committed
+        return size
+
+    def track(self, cs, batches):
+        """
+        yield batches, keeping the largest non-NULL value of the watermark column
+        """
+        col_nms = [col[0] for col in cs.description or []]
+        if self.column not in col_nms:
+            raise ValueError, "the query result has no %r column to take the watermark from" % (self.column,)
+        i = col_nms.index(self.column)
+        for batch in batches:
+            values = [row[i] for row in batch if row[i] is not None]
+            if values:
+                top = max(values)
+                if self.new_watermark is None or top > self.new_watermark:
+                    self.new_watermark = top
+            self.rows += len(batch)
+            yield batch
+
+    def commit(self, run_log):
+        """
+        move the delta into place, then save the new watermark
+        """
+        info = {"column": self.column, "mode": self.mode, "state_file": self.state_filenm,
+                "watermark_before": self.watermark, "rows": self.rows}
+        run_log["incremental"] = info
+        if self.rows == 0:
+            logger.info("no rows past watermark %r" % (self.watermark,))
+            self.abort()
+            info["watermark_after"] = self.watermark
+            return
+        state = dict(self.state)
+        if self.mode == "shard":
+            shard_no = state.get("next_shard", 0)
+            final_filenm = shard_filenm(self.out_filenm, shard_no)
+            os.rename(self.delta_filenm, final_filenm)
+            state["next_shard"] = shard_no + 1
+            info["shard"] = final_filenm
+        elif self.header:
+            os.rename(self.delta_filenm, self.out_filenm)
+            state["output_size"] = os.path.getsize(self.out_filenm)
+        else:
+            with open(self.delta_filenm, "rb") as src:
+                with open(self.out_filenm, "ab") as dst:
+                    shutil.copyfileobj(src, dst, 1 << 20)
+                    dst.flush()
+                    os.fsync(dst.fileno())
+            os.remove(self.delta_filenm)
+            state["output_size"] = os.path.getsize(self.out_filenm)
+        state.update({"column": self.column, "watermark": json_value(self.new_watermark),
+                      "updated": time.time()})
+        self._save(state)
+        info["watermark_after"] = state["watermark"]
+        logger.info("watermark %s: %r -> %r" % (self.column, self.watermark, state["watermark"]))
+
+    def _save(self, state):
+        dirnm = os.path.dirname(self.state_filenm)
+        if dirnm and not os.path.isdir(dirnm):
+            os.makedirs(dirnm)
+        tmp_filenm = "%s.%d.tmp" % (self.state_filenm, os.getpid())
+        with open(tmp_filenm, "w") as fp:
+            json.dump(state, fp, indent=4)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(tmp_filenm, self.state_filenm)
+        self.state = state
+
+    def abort(self):
+        """
+        drop the delta file
+        """
+        if os.path.exists(self.delta_filenm):
+            os.remove(self.delta_filenm)
@@ -0,0 +1,207 @@
+#  Copyright 2014 Accuen
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""
+partitioned extraction: one logical query split into disjoint slices
+
+--partition-by picks how the query is split into --partitions slices:
+
+    * mod:COL          -- slice i gets ABS(MOD(COL, N)) = i (integer COL)
+    * hash:COL         -- slice i gets ABS(MOD(FNV_HASH(COL), N)) = i (any COL)
+    * range:COL        -- N equal-width ranges between MIN(COL) and MAX(COL)
+    * range:COL:LO:HI  -- N equal-width ranges between the numbers LO and HI
+    * var:NAME         -- the template is expanded once per slice with NAME,
+                          "partition" (0..N-1) and "partitions" (N) in the
+                          namespace; if the namespace already holds a list
+                          NAME, there is one slice per element instead
+
+For the column modes the query is wrapped as a subselect and filtered.
+NULLs go to slice 0, and range values below the first or above the
+last cut to the first or last slice, so the slices never overlap and
+always cover the whole result.  Any ORDER BY only holds within a slice.
+
+Each slice runs on its own connection.  The slices are either merged
+into the output file in slice order, or written as one shard each.
+"""
+import sys
+import time
+import Queue
+import decimal
+import datetime
+import threading
+
+from .query_template import sql_literal
+
+
+KINDS = ["mod", "hash", "range", "var"]
+
+OUTPUTS = ["merge", "shards"]
+
+DEFAULT_QUEUE_SIZE = 4
+
+_DONE = object()
+
+
+def parse_spec(spec):
+    """
+    return (kind, column or variable name, (lo, hi) or None) for a --partition-by value
+    """
+    parts = spec.split(":")
+    kind = parts[0]
+    if kind not in KINDS or len(parts) < 2 or not parts[1]:
+        raise ValueError, "invalid --partition-by %r; expected mod:COL, hash:COL, range:COL[:LO:HI] or var:NAME" % (spec,)
+    if kind == "range" and len(parts) == 4:
+        return kind, parts[1], (_parse_number(parts[2]), _parse_number(parts[3]))
+    if len(parts) != 2:
+        raise ValueError, "invalid --partition-by %r" % (spec,)
+    return kind, parts[1], None
+
+
+def _parse_number(s):
+    try:
+        return int(s)
+    except ValueError:
+        return float(s)
+
+
+def bounds_sql(q, col):
+    """
+    return SQL selecting the MIN and MAX of col over q's result
+    """
+    return "select min(%s), max(%s) from (\n%s\n) rqt_partition" % (col, col, _strip(q))
+
+
+# what MIN/MAX of a column must be for range partitioning (datetime is a date)
+_RANGE_TYPES = (int, long, float, decimal.Decimal, datetime.date)
+
+
+def range_cuts(lo, hi, n):
+    """
+    return the n-1 values cutting [lo, hi] into n equal-width ranges
+    """
+    if not all(isinstance(x, _RANGE_TYPES) and not isinstance(x, bool) for x in (lo, hi)):
+        raise ValueError, "range partitioning needs a numeric, date or timestamp column, not %r..%r" % (lo, hi)
+    try:
+        width = hi - lo
+    except TypeError:
+        raise ValueError, "can't cut %r..%r into ranges" % (lo, hi)
+    if isinstance(width, (int, long, datetime.timedelta)):
+        return [lo + width * i // n for i in range(1, n)]
+    return [lo + width * i / n for i in range(1, n)]
+
+
+def _strip(q):
+    return q.strip().rstrip(";")
+
+
+def _where(kind, col, n, i, cuts):
+    if kind == "mod":
+        expr = "ABS(MOD(%s, %d)) = %d" % (col, n, i)
+    elif kind == "hash":
+        expr = "ABS(MOD(FNV_HASH(%s), %d)) = %d" % (col, n, i)
+    else:
+        lower = "%s >= %s" % (col, sql_literal(cuts[i-1])) if i > 0 else None
+        upper = "%s < %s" % (col, sql_literal(cuts[i])) if i < n - 1 else None
+        expr = " AND ".join(x for x in (lower, upper) if x)
+    if i == 0:
+        expr = "%s OR %s IS NULL" % (expr, col)
+    return expr
+
+
+def slice_queries(q, kind, col, n, cuts=None):
+    """
+    return the n queries selecting the disjoint slices of q's result
+    """
+    if n < 2 or (kind == "range" and not cuts):
+        return [q]
+    if kind == "range":
+        n = len(cuts) + 1
+    return ["select * from (\n%s\n) rqt_partition where %s" % (_strip(q), _where(kind, col, n, i, cuts))
+            for i in range(n)]
+
+
+class SliceReader(threading.Thread):
+    """
+    reads one slice's batches on its own thread into a bounded queue
+
+    batches is an iterable of row batches which runs the slice's query
+    when first iterated.  At most queue_size batches are read ahead.
+    """
+
+    def __init__(self, batches, queue_size=DEFAULT_QUEUE_SIZE):
+        threading.Thread.__init__(self, name="rqt-slice")
+        self.daemon = True
+        self.source = batches
+        self.queue = Queue.Queue(queue_size)
+        self.stopped = threading.Event()
+        self.exc_info = None
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def run(self):
+        try:
+            for batch in self.source:
+                if not self._put(batch):
+                    return
+        except:
+            self.exc_info = sys.exc_info()
+        self._put(_DONE)
+
+    def batches(self):
+        """
+        yield the slice's batches, re-raising any error reading them
+        """
+        while 1:
+            try:
+                item = self.queue.get(timeout=0.1)
+            except Queue.Empty:
+                continue
+            if item is _DONE:
+                break
+            yield item
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+
+    def stop(self):
+        self.stopped.set()
+
+
+class MergedCursor:
+    """
+    the cursor attributes the sinks need, for slices merged into one output
+    """
+
+    def __init__(self, cursors):
+        self.cursors = cursors
+
+    @property
+    def description(self):
+        return self.cursors[0].description
+
+    @property
+    def name(self):
+        return self.cursors[0].name
+
+    @property
+    def rowcount(self):
+        counts = [cs.rowcount for cs in self.cursors]
+        return sum(counts) if min(counts) >= 0 else -1
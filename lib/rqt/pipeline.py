@@ -0,0 +1,182 @@
+#  Copyright 2014 Accuen
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""
+fetch / convert / write pipeline for exporting a result set
+
+The fetch stage pulls batches from the cursor on one thread, the
+convert stage encodes them on another, and the calling thread writes
+(and compresses) them.  The stages are connected by bounded queues, so
+a slow stage holds up the ones before it rather than growing memory,
+and network wait, conversion and compression overlap.
+"""
+import sys
+import time
+import Queue
+import logging
+import threading
+
+from . import tracing
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_QUEUE_SIZE = 4
+
+_DONE = object()
+
+
+class _Aborted(Exception):
+    "raised inside a stage when another stage has failed"
+
+
+class StageTimer:
+    """
+    busy and wait seconds for one stage
+    """
+
+    def __init__(self):
+        self.busy = 0.0
+        self.wait = 0.0
+        self.batches = 0
+
+    def as_dict(self):
+        return {"busy": self.busy, "wait": self.wait, "batches": self.batches}
+
+
+class Pipeline:
+    """
+    runs convert(batch) and write(converted) over batches on three stages
+    """
+
+    def __init__(self, batches, convert, write, queue_size=DEFAULT_QUEUE_SIZE):
+        self.batches = batches
+        self.convert = convert
+        self.write = write
+        self.fetched = Queue.Queue(queue_size)
+        self.converted = Queue.Queue(queue_size)
+        self.stop = threading.Event()
+        self.exc_info = None
+        self.timers = {"fetch": StageTimer(), "convert": StageTimer(), "write": StageTimer()}
+
+    def _put(self, q, item, timer):
+        t0 = time.time()
+        while 1:
+            if self.stop.is_set():
+                raise _Aborted
+            try:
+                q.put(item, timeout=0.1)
+                break
+            except Queue.Full:
+                pass
+        timer.wait += time.time() - t0
+
+    def _get(self, q, timer):
+        t0 = time.time()
+        while 1:
+            if self.stop.is_set():
+                raise _Aborted
+            try:
+                item = q.get(timeout=0.1)
+                break
+            except Queue.Empty:
+                pass
+        timer.wait += time.time() - t0
+        return item
+
+    def _fail(self):
+        if self.exc_info is None:
+            self.exc_info = sys.exc_info()
+        self.stop.set()
+
+    def _fetch_stage(self):
+        timer = self.timers["fetch"]
+        try:
+            it = iter(self.batches)
+            while 1:
+                t0 = time.time()
+                batch = next(it, _DONE)
+                timer.busy += time.time() - t0
+                self._put(self.fetched, batch, timer)
+                if batch is _DONE:
+                    break
+                timer.batches += 1
+        except _Aborted:
+            pass
+        except:
+            self._fail()
+
+    def _convert_stage(self):
+        timer = self.timers["convert"]
+        try:
+            while 1:
+                batch = self._get(self.fetched, timer)
+                if batch is _DONE:
+                    self._put(self.converted, _DONE, timer)
+                    break
+                t0 = time.time()
+                converted = self.convert(batch)
+                t1 = time.time()
+                timer.busy += t1 - t0
+                tracing.add_span("convert", t0, t1, rows=len(batch))
+                timer.batches += 1
+                self._put(self.converted, converted, timer)
+        except _Aborted:
+            pass
+        except:
+            self._fail()
+
+    def run(self):
+        """
+        run the pipeline to completion and return the per-stage timing
+        """
+        threads = [threading.Thread(target=tracing.profiled_thread(self._fetch_stage), name="rqt-fetch"),
+                   threading.Thread(target=tracing.profiled_thread(self._convert_stage), name="rqt-convert")]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        timer = self.timers["write"]
+        try:
+            while 1:
+                converted = self._get(self.converted, timer)
+                if converted is _DONE:
+                    break
+                t0 = time.time()
+                self.write(converted)
+                t1 = time.time()
+                timer.busy += t1 - t0
+                tracing.add_span("write", t0, t1)
+                timer.batches += 1
+        except _Aborted:
+            pass
+        except:
+            self._fail()
+        self.stop.set()
+        for thread in threads:
+            thread.join()
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        timing = dict((name, timer.as_dict()) for name, timer in self.timers.items())
+        logger.info("stage_busy_seconds fetch=%.1f convert=%.1f write=%.1f" % (
+            timing["fetch"]["busy"], timing["convert"]["busy"], timing["write"]["busy"]))
+        return timing
+
+
+def run(batches, convert, write, queue_size=DEFAULT_QUEUE_SIZE):
+    """
+    run batches through convert() and write() on a three stage pipeline
+    """
+    return Pipeline(batches, convert, write, queue_size).run()
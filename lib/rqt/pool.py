@@ -0,0 +1,193 @@
+#  Copyright 2014 Accuen
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""
+thread-safe pool of Redshift connections
+"""
+import time
+import logging
+import threading
+
+from . import errors
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_MAX_SIZE = 8
+DEFAULT_IDLE_TIMEOUT = 300.0
+DEFAULT_CHECK_AFTER = 30.0
+DEFAULT_WAIT_TIMEOUT = 30.0
+
+
+class PooledConnection(object):
+    """
+    A connection checked out of a ConnectionPool.
+
+    Everything is delegated to the underlying psycopg2 connection except
+    close(), which rolls back any open transaction and returns the
+    connection to the pool.  As with psycopg2, using it as a context
+    manager commits (or rolls back on an exception) and leaves it open.
+    A connection that is never closed goes back to the pool once it is
+    garbage collected.
+    """
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        if self._conn is None:
+            raise errors.RQTError, "connection was returned to the pool"
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool.put(conn)
+
+    def __del__(self):
+        if self._conn is not None:
+            logger.info("returning a pooled connection that was never closed")
+            self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+
+class ConnectionPool:
+    """
+    A pool of at most max_size connections made by connect().
+
+    Idle connections are closed after idle_timeout seconds.  A connection
+    idle for more than check_after seconds is checked with "SELECT 1"
+    before it is handed out, and replaced if the check fails.  get()
+    waits up to wait_timeout seconds for a connection to be returned
+    when all max_size are in use.
+    """
+
+    def __init__(self, connect, max_size=DEFAULT_MAX_SIZE, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 check_after=DEFAULT_CHECK_AFTER, wait_timeout=DEFAULT_WAIT_TIMEOUT):
+        self.connect = connect
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.check_after = check_after
+        self.wait_timeout = wait_timeout
+        self.idle = [] # (conn, last_used), oldest first
+        self.in_use = 0
+        self.cond = threading.Condition()
+
+    def _expire_idle(self):
+        # Called with the lock held.
+        cutoff = time.time() - self.idle_timeout
+        while self.idle and self.idle[0][1] < cutoff:
+            _close_quietly(self.idle.pop(0)[0])
+
+    def _is_healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if time.time() - last_used < self.check_after:
+            return True
+        try:
+            cs = conn.cursor()
+            cs.execute("SELECT 1;")
+            cs.fetchone()
+            conn.rollback()
+            return True
+        except Exception, exc:
+            logger.info("dropping pooled connection that failed its health check: %s" % (exc,))
+            return False
+
+    def get(self):
+        """
+        return a PooledConnection; close() it to give it back
+        """
+        deadline = time.time() + self.wait_timeout
+        with self.cond:
+            while 1:
+                self._expire_idle()
+                if self.idle:
+                    conn, last_used = self.idle.pop()
+                    self.in_use += 1
+                    break
+                if self.in_use < self.max_size:
+                    conn, last_used = None, None
+                    self.in_use += 1
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise errors.RQTPoolExhaustedError, "all %d connections are in use" % (self.max_size,)
+                self.cond.wait(remaining)
+        # Check or connect without holding the lock...
+        try:
+            if conn is not None and not self._is_healthy(conn, last_used):
+                _close_quietly(conn)
+                conn = None
+            if conn is None:
+                conn = self.connect()
+        except:
+            with self.cond:
+                self.in_use -= 1
+                self.cond.notify()
+            raise
+        return PooledConnection(self, conn)
+
+    def put(self, conn):
+        """
+        return a connection to the pool
+
+        The session is RESET ALL so SETs don't leak to the next borrower;
+        a connection left in autocommit or with temp tables is closed.
+        """
+        try:
+            conn.rollback()
+            if getattr(conn, "autocommit", False):
+                raise errors.RQTError, "autocommit was turned on"
+            cs = conn.cursor()
+            # The session's temp schema is only on its implicit search path
+            # once it has made temp objects.
+            cs.execute("SELECT current_schemas(true);")
+            if "pg_temp" in str(cs.fetchone()[0]):
+                raise errors.RQTError, "temp tables were created"
+            cs.execute("RESET ALL;")
+            conn.commit()
+        except Exception, exc:
+            logger.info("dropping pooled connection: %s" % (exc,))
+            _close_quietly(conn)
+        with self.cond:
+            self.in_use -= 1
+            if not conn.closed:
+                self.idle.append((conn, time.time()))
+            self.cond.notify()
+
+    def close_all(self):
+        """
+        close the idle connections
+        """
+        with self.cond:
+            while self.idle:
+                _close_quietly(self.idle.pop()[0])
+
+
+def _close_quietly(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
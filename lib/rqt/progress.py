@@ -0,0 +1,181 @@
+#  Copyright 2014 Accuen
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""
+periodic progress reports for long exports
+
+A ProgressReporter is fed the rows and (uncompressed) bytes of every
+batch the export writes, and every interval seconds logs a progress line
+to stderr and optionally rewrites a JSON status file.  The status file
+is replaced atomically and carries an "updated" timestamp, so a watcher
+can tell a slow export (rows still moving) from a hung one (no new rows,
+or no new report at all).
+"""
+import os
+import json
+import time
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_INTERVAL = 10.0
+
+
+class ProgressReporter:
+    """
+    reports export progress every interval seconds on a background thread
+
+    The phase is "query" until the export starts writing, then "export",
+    and finally "done" or "failed".
+    """
+
+    def __init__(self, interval=DEFAULT_INTERVAL, status_filenm=None):
+        self.interval = interval
+        self.status_filenm = status_filenm
+        self.expected_exports = 1 # outputs written concurrently, e.g. one per partition
+        self.exports = 0
+        self.known_rows = 0
+        self.unknown_rows = False
+        self.output_sizes = [] # callables returning the bytes on disk so far, or None
+        self.lock = threading.Lock()
+        self.phase = "query"
+        self.rows = 0
+        self.bytes = 0
+        self.start_time = None
+        self.last = None # (time, rows, bytes) at the previous report
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.start_time = time.time()
+        self.last = (self.start_time, 0, 0)
+        self.thread = threading.Thread(target=self._run, name="rqt-progress")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.report()
+            except Exception, exc:
+                # Progress reporting must never take the export down.
+                logger.info("progress report failed: %s" % (exc,))
+
+    def wrap(self, encode, write):
+        """
+        return encode() and write() pipeline stages which count rows and bytes
+        """
+        def counting_encode(batch):
+            return len(batch), encode(batch)
+
+        def counting_write(item):
+            rows, encoded = item
+            nbytes = write(encoded)
+            # Several outputs may be written at once.
+            with self.lock:
+                self.rows += rows
+                self.bytes += nbytes or 0
+        return counting_encode, counting_write
+
+    def start_export(self, total_rows=None, output_size=None):
+        """
+        note that an output has started writing; once per output
+        """
+        with self.lock:
+            self.phase = "export"
+            self.exports += 1
+            if total_rows is None:
+                self.unknown_rows = True
+            else:
+                self.known_rows += total_rows
+            if output_size is not None:
+                self.output_sizes.append(output_size)
+
+    @property
+    def total_rows(self):
+        # Only known once every output has started and reported its count.
+        if self.unknown_rows or self.exports < self.expected_exports:
+            return None
+        return self.known_rows
+
+    def _output_bytes(self):
+        sizes = [output_size() for output_size in self.output_sizes]
+        if not sizes or None in sizes:
+            return None
+        return sum(sizes)
+
+    def snapshot(self):
+        """
+        return the current progress as a dict
+        """
+        now = time.time()
+        rows, nbytes = self.rows, self.bytes
+        last_time, last_rows, last_bytes = self.last
+        self.last = (now, rows, nbytes)
+        elapsed = now - self.start_time
+        interval = max(now - last_time, 1e-6)
+        status = {
+            "phase": self.phase,
+            "updated": now,
+            "elapsed_seconds": elapsed,
+            "rows": rows,
+            "total_rows": self.total_rows,
+            "bytes": nbytes,
+            "output_bytes": self._output_bytes(),
+            # rates over the last interval, so a stall shows up right away
+            "rows_per_second": (rows - last_rows) / interval,
+            "mb_per_second": (nbytes - last_bytes) / interval / 1e6,
+            "avg_rows_per_second": rows / max(elapsed, 1e-6),
+            "avg_mb_per_second": nbytes / max(elapsed, 1e-6) / 1e6,
+            "eta_seconds": None,
+        }
+        if self.total_rows and rows and self.phase == "export":
+            status["percent"] = 100.0 * rows / self.total_rows
+            # The ETA uses the average rate; it is steadier than the last interval's.
+            status["eta_seconds"] = (self.total_rows - rows) * elapsed / rows
+        return status
+
+    def report(self):
+        status = self.snapshot()
+        line = "progress phase=%s rows=%d bytes=%d" % (status["phase"], status["rows"], status["bytes"])
+        if status["output_bytes"] is not None:
+            line += " output_bytes=%d" % (status["output_bytes"],)
+        line += " rows_per_second=%.0f mb_per_second=%.2f elapsed_seconds=%.0f" % (
+            status["rows_per_second"], status["mb_per_second"], status["elapsed_seconds"])
+        if status["eta_seconds"] is not None:
+            line += " total_rows=%d percent=%.1f eta_seconds=%.0f" % (
+                status["total_rows"], status["percent"], status["eta_seconds"])
+        logger.info(line)
+        if self.status_filenm is not None:
+            self.write_status(status)
+
+    def write_status(self, status):
+        tmp_filenm = "%s.%d.tmp" % (self.status_filenm, os.getpid())
+        with open(tmp_filenm, "w") as fp:
+            json.dump(status, fp)
+        os.rename(tmp_filenm, self.status_filenm)
+
+    def stop(self, phase="done"):
+        """
+        stop reporting and make a final report
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.phase = phase
+        self.report()
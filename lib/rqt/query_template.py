@@ -16,25 +16,177 @@
 """
 expand functions for query templates
 
+Compiled templates are cached by content hash: in-process in an LRU, and
+on disk under $RQT_CACHE_DIR (default ~/.cache/rqt) as Jinja2 bytecode
+and Mako modules, so repeated expansions skip parsing and compiling.
+
+The template engines (and psycopg2's adapt) are only imported once a
+template that needs them is expanded.
 """
 import os
 import sys
+import stat
+import time
+import hashlib
+import logging
+import threading
+import collections
+
+
+_adapt = False # not looked up yet
 
-try:
-    from psycopg2.extensions import adapt
-except:
-    adapt = None
 
-import jinja2
-import mako.template
-import mako.exceptions
-import pystache
+def get_adapt():
+    """
+    return psycopg2's adapt function, or None if psycopg2 is not installed
+    """
+    global _adapt
+    if _adapt is False:
+        try:
+            from psycopg2.extensions import adapt
+        except:
+            adapt = None
+        _adapt = adapt
+    return _adapt
+
+
+def sql_literal(value):
+    """
+    return value quoted as an SQL literal
+    """
+    adapt = get_adapt()
+    if adapt is None:
+        return repr(value)
+    return adapt(value).getquoted()
+
+
+logger = logging.getLogger(__name__)
 
 
 class RQTTemplateExpansionError(Exception):
     pass
 
 
+########################################################################
+# Compiled template cache
+########################################################################
+
+
+MEMORY_CACHE_SIZE = 64
+DISK_CACHE_MAX_BYTES = 64 << 20
+DISK_CACHE_PRUNE_INTERVAL = 3600 # seconds
+
+
+class LRUCache:
+    """
+    A thread-safe mapping holding the maxsize most recently used entries.
+    """
+
+    def __init__(self, maxsize=MEMORY_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.data = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.data.pop(key, None)
+            if value is not None:
+                self.data[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+
+_compiled = LRUCache()
+
+
+def _content_key(kind, s):
+    if isinstance(s, unicode):
+        s = s.encode("utf-8")
+    return "%s-%s" % (kind, hashlib.sha1(s).hexdigest())
+
+
+def _private_dir(dirnm):
+    """
+    create dirnm if needed; raise OSError unless only this user can write to it
+
+    The cache holds compiled code that is imported or loaded as is, so a
+    directory others can write to would let them run code as this user.
+    """
+    if not os.path.isdir(dirnm):
+        os.makedirs(dirnm, 0700)
+    st = os.lstat(dirnm)
+    if not stat.S_ISDIR(st.st_mode):
+        raise OSError("%s is not a directory" % (dirnm,))
+    if st.st_uid != os.getuid():
+        raise OSError("%s is not owned by the current user" % (dirnm,))
+    if st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise OSError("%s is group or world writable" % (dirnm,))
+    return dirnm
+
+
+def get_cache_dir(kind, *subdirnms):
+    """
+    return the on-disk cache directory for a template engine, or None if unusable
+    """
+    default_cache_dirnm = os.path.expanduser("~/.cache/rqt")
+    dirnm = os.environ.get("RQT_CACHE_DIR", default_cache_dirnm)
+    try:
+        _private_dir(dirnm)
+        for subdirnm in (kind,) + subdirnms:
+            dirnm = _private_dir(os.path.join(dirnm, subdirnm))
+    except OSError, exc:
+        logger.info("template disk cache disabled: %s" % (exc,))
+        return None
+    return dirnm
+
+
+def prune_cache_dir(dirnm, max_bytes=DISK_CACHE_MAX_BYTES, interval=DISK_CACHE_PRUNE_INTERVAL):
+    """
+    remove the least recently used files until dirnm holds at most max_bytes
+
+    The walk is skipped if dirnm was pruned less than interval seconds ago.
+    """
+    stamp_filenm = os.path.join(dirnm, ".pruned")
+    try:
+        if time.time() - os.stat(stamp_filenm).st_mtime < interval:
+            return
+    except OSError:
+        pass
+    try:
+        with open(stamp_filenm, "a"):
+            os.utime(stamp_filenm, None)
+    except (IOError, OSError):
+        pass
+    entries = []
+    total = 0
+    for root, dirnms, filenms in os.walk(dirnm):
+        for filenm in filenms:
+            path = os.path.join(root, filenm)
+            if path == stamp_filenm:
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((max(st.st_atime, st.st_mtime), st.st_size, path))
+            total += st.st_size
+    entries.sort()
+    for used, size, path in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+
+
 def _detect_template_engine(s):
     # Use she-bang lines to be explicit.
     if s.startswith("#!jinja2"):
@@ -85,7 +237,7 @@ def expand_str(s, namespace):
         return jinja2_expand_str(s, namespace)
     elif kind == "mako":
         return mako_expand_str(s, namespace)
-    elif kind == "mustache":
+    elif kind == "pystache":
         return pystache_expand_str(s, namespace)
     else:
         # Default to using Jinja2.
@@ -97,11 +249,13 @@ def expand_str(s, namespace):
 
 
 def mako_expand_str(s, namespace):
+    import mako.exceptions
+    adapt = get_adapt()
     if adapt is not None and "adapt" not in namespace:
         # Add the "SQL quoting" Pyscopg2 adapt function.
         namespace["adapt"] = lambda v: adapt(v).getquoted()
     try:
-        templ = mako.template.Template(s)
+        templ = _mako_template(s)
         return templ.render(**namespace)
     except:
         raise
@@ -114,11 +268,46 @@ def mako_expand_str(s, namespace):
         raise RQTTemplateExpansionError, "template expansion failed"
 
 
+_mako_compile_lock = threading.Lock()
+
+
+def _mako_template(s):
+    """
+    return the compiled Mako template for s, from the cache if possible
+    """
+    key = _content_key("mako", s)
+    templ = _compiled.get(key)
+    if templ is not None:
+        return templ
+    import mako.template
+    dirnm = get_cache_dir("mako")
+    if dirnm is not None and get_cache_dir("mako", "modules") is None:
+        dirnm = None
+    if dirnm is None:
+        templ = mako.template.Template(s)
+    else:
+        # Mako only caches modules for file templates, so the source is
+        # saved under its content hash and compiled from there.
+        with _mako_compile_lock:
+            src_filenm = os.path.join(dirnm, key + ".mako")
+            if not os.path.exists(src_filenm):
+                tmp_filenm = "%s.%d.tmp" % (src_filenm, os.getpid())
+                with open(tmp_filenm, "wb") as fp:
+                    fp.write(s.encode("utf-8") if isinstance(s, unicode) else s)
+                os.rename(tmp_filenm, src_filenm)
+            templ = mako.template.Template(filename=src_filenm, uri=key + ".mako",
+                                           module_directory=os.path.join(dirnm, "modules"))
+            prune_cache_dir(dirnm)
+    _compiled.put(key, templ)
+    return templ
+
+
 ########################################################################
 ########################################################################
 
 
 def pystache_expand_str(s, namespace):
+    import pystache
     return pystache.render(s, namespace)
 
 
@@ -130,9 +319,9 @@ def jinja2_expand_str(s, argdict={}):
     """
     returns the template-completed query from a string
     """
+    import jinja2
     # Treat the string as a Jinja2 template.
-    jenv = _setup_jinja_env()
-    templ = jenv.from_string(s)
+    templ = _jinja_template(s)
     try:
         return templ.render(**argdict)
     except jinja2.exceptions.UndefinedError, exc_val:
@@ -143,7 +332,63 @@ class TemplateError(Exception):
     pass
 
 
-def _setup_jinja_env():
+def _mk_source_loader():
+    """
+    return a Jinja2 loader serving sources registered under their content key
+
+    Going through a loader (rather than from_string) is what lets Jinja2
+    use its bytecode cache.
+    """
+    import jinja2
+
+    class SourceLoader(jinja2.BaseLoader):
+
+        def __init__(self):
+            self.sources = {}
+
+        def get_source(self, environment, template):
+            if template not in self.sources:
+                raise jinja2.TemplateNotFound(template)
+            return self.sources[template], None, lambda: True
+
+    return SourceLoader()
+
+
+_jinja_env = None
+_jinja_loader = None
+_jinja_compile_lock = threading.Lock()
+
+
+def _jinja_template(s):
+    """
+    return the compiled Jinja2 template for s, from the cache if possible
+    """
+    global _jinja_env, _jinja_loader
+    key = _content_key("jinja2", s)
+    templ = _compiled.get(key)
+    if templ is not None:
+        return templ
+    import jinja2
+    with _jinja_compile_lock:
+        dirnm = get_cache_dir("jinja2")
+        if _jinja_env is None:
+            _jinja_loader = _mk_source_loader()
+            bytecode_cache = jinja2.FileSystemBytecodeCache(dirnm) if dirnm else None
+            _jinja_env = _setup_jinja_env(loader=_jinja_loader, bytecode_cache=bytecode_cache)
+        _jinja_loader.sources[key] = s
+        try:
+            templ = _jinja_env.get_template(key)
+        finally:
+            del _jinja_loader.sources[key]
+        if dirnm is not None:
+            prune_cache_dir(dirnm)
+    _compiled.put(key, templ)
+    return templ
+
+
+def _setup_jinja_env(loader=None, bytecode_cache=None):
+    import jinja2
+    adapt = get_adapt()
 
     def jinja_filter_join(seq, sep=", "):
         """
@@ -170,7 +415,9 @@ def _setup_jinja_env():
         return adapt(v).getquoted()
 
 
-    jenv = jinja2.Environment(extensions=['jinja2.ext.do'])
+    # The Environment's own cache is bypassed; _compiled holds the templates.
+    jenv = jinja2.Environment(extensions=['jinja2.ext.do'], loader=loader,
+                              bytecode_cache=bytecode_cache, cache_size=0)
     jenv.undefined = jinja2.StrictUndefined
     jenv.filters["qjoin"] = jinja_filter_qjoin
     jenv.filters["join"] = jinja_filter_join
@@ -0,0 +1,194 @@
+#  Copyright 2014 Accuen
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""
+local content-addressed cache of exported query results
+
+An entry is keyed on a hash of the expanded query, the connection, the
+search_path, the query_group and the output file type.  It is served
+while it is younger than the TTL (--cache-ttl, or the config's per-template
+"ttl" patterns, see template_ttl), and the least recently used
+entries are evicted once the cache grows past its size cap.
+
+    DIR/KEY.EXT    -- the exported result file
+    DIR/KEY.json   -- metadata; its mtime is the entry's last use
+"""
+import os
+import json
+import time
+import shutil
+import fnmatch
+import hashlib
+import logging
+
+from . import compress
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_MAX_BYTES = 10 << 30
+
+
+def _output_ext(filenm):
+    """
+    return the format and compression extension, e.g. ".csv.gz"
+    """
+    base = compress.split_codec(filenm)[0]
+    return os.path.splitext(base)[1] + filenm[len(base):]
+
+
+def is_cacheable(filenm):
+    return not filenm.startswith("stdout") and filenm != "/dev/null"
+
+
+class ResultCache:
+    """
+    a directory of cached result files capped at max_bytes
+    """
+
+    def __init__(self, dirnm, max_bytes=DEFAULT_MAX_BYTES):
+        self.dirnm = dirnm
+        self.max_bytes = max_bytes
+        if not os.path.isdir(dirnm):
+            # Exported result sets may be sensitive.
+            os.makedirs(dirnm, 0700)
+
+    def mk_key(self, query, conn_key, conn_args, search_path, query_group, out_filenm):
+        """
+        return the cache key for a query run
+        """
+        parts = [
+            query,
+            conn_key,
+            "%s:%s/%s@%s" % (conn_args.get("server"), conn_args.get("port"),
+                             conn_args.get("database"), conn_args.get("user")),
+            search_path or "",
+            query_group or "",
+            _output_ext(out_filenm),
+        ]
+        h = hashlib.sha256()
+        for part in parts:
+            if isinstance(part, unicode):
+                part = part.encode("utf-8")
+            h.update(str(part))
+            h.update("\0")
+        return h.hexdigest()
+
+    def _paths(self, key, out_filenm):
+        data_filenm = os.path.join(self.dirnm, key + _output_ext(out_filenm))
+        meta_filenm = os.path.join(self.dirnm, key + ".json")
+        return data_filenm, meta_filenm
+
+    def serve(self, key, out_filenm, ttl):
+        """
+        put a cached result at out_filenm; return the entry metadata or None on a miss
+        """
+        data_filenm, meta_filenm = self._paths(key, out_filenm)
+        try:
+            with open(meta_filenm) as fp:
+                meta = json.load(fp)
+        except (IOError, ValueError):
+            return None
+        if time.time() - meta["created"] > ttl or not os.path.exists(data_filenm):
+            return None
+        if os.path.exists(out_filenm):
+            os.remove(out_filenm)
+        try:
+            os.link(data_filenm, out_filenm)
+        except OSError:
+            # e.g. a different file system
+            shutil.copyfile(data_filenm, out_filenm)
+        os.utime(meta_filenm, None) # mark as recently used
+        logger.info("served result from cache entry %s (age %.0fs)" % (key, time.time() - meta["created"]))
+        return meta
+
+    def store(self, key, out_filenm, meta):
+        """
+        copy an exported result into the cache
+        """
+        data_filenm, meta_filenm = self._paths(key, out_filenm)
+        meta = dict(meta, created=time.time(), size=os.stat(out_filenm).st_size)
+        tmp_suffix = ".%d.tmp" % (os.getpid(),)
+        try:
+            shutil.copyfile(out_filenm, data_filenm + tmp_suffix)
+            os.rename(data_filenm + tmp_suffix, data_filenm)
+            with open(meta_filenm + tmp_suffix, "w") as fp:
+                json.dump(meta, fp)
+            os.rename(meta_filenm + tmp_suffix, meta_filenm)
+        except:
+            # e.g. a full disk; don't leave a partial copy behind
+            for filenm in (data_filenm + tmp_suffix, meta_filenm + tmp_suffix):
+                if os.path.exists(filenm):
+                    os.remove(filenm)
+            raise
+        logger.info("stored result in cache entry %s" % (key,))
+        self.evict()
+
+    def evict(self):
+        """
+        remove least recently used entries until the cache fits in max_bytes
+        """
+        entries = {}
+        for filenm in os.listdir(self.dirnm):
+            if filenm.endswith(".tmp"):
+                continue
+            path = os.path.join(self.dirnm, filenm)
+            key = filenm.split(".", 1)[0]
+            entry = entries.setdefault(key, {"size": 0, "used": 0, "paths": []})
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entry["size"] += st.st_size
+            entry["paths"].append(path)
+            if filenm.endswith(".json"):
+                entry["used"] = st.st_mtime
+        total = sum(entry["size"] for entry in entries.values())
+        for key, entry in sorted(entries.items(), key=lambda item: item[1]["used"]):
+            if total <= self.max_bytes:
+                break
+            for path in entry["paths"]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= entry["size"]
+            logger.info("evicted result cache entry %s" % (key,))
+
+
+def template_ttl(config, qt_filenm):
+    """
+    return the TTL the config's "result_cache" section gives a template, or None
+
+    "ttl" maps fnmatch patterns, matched against the template's file name
+    and its absolute path, to seconds; the longest matching pattern wins.
+    """
+    ttls = config.get("result_cache", {}).get("ttl", {})
+    names = (os.path.basename(qt_filenm), os.path.abspath(qt_filenm))
+    for pattern in sorted(ttls, key=len, reverse=True):
+        if any(fnmatch.fnmatch(name, pattern) for name in names):
+            return int(ttls[pattern])
+    return None
+
+
+def open_cache(config):
+    """
+    return the ResultCache described by the config's optional "result_cache" section
+    """
+    cache_config = config.get("result_cache", {})
+    default_dirnm = os.path.expanduser("~/.cache/rqt/results")
+    dirnm = os.path.expanduser(cache_config.get("dir", default_dirnm))
+    return ResultCache(dirnm, int(cache_config.get("max_bytes", DEFAULT_MAX_BYTES)))
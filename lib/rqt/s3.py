@@ -0,0 +1,69 @@
+#  Copyright 2014 Accuen
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""
+S3 helpers shared by the usage log and the UNLOAD export engine
+
+boto is only imported when a connection is made.
+"""
+
+
+_boto_configured = False
+
+
+def _configure_boto():
+    global _boto_configured
+    if _boto_configured:
+        return
+    import boto
+    if boto.config.has_section("Boto"):
+        # Having this set to True caused some problems with S3 at some point.
+        # Maybe it still does.
+        boto.config.set("Boto", "https_validate_certificates", "False")
+    _boto_configured = True
+
+
+def connect(s3_config):
+    """
+    return an S3Connection for a config section with AWS keys
+
+    The optional "host", "port" and "is_secure" keys point the connection
+    at an S3-compatible stand-in (e.g. a local test server).
+    """
+    _configure_boto()
+    from boto.s3.connection import S3Connection, OrdinaryCallingFormat
+    kwargs = {}
+    if s3_config.get("host"):
+        kwargs["host"] = s3_config["host"]
+        kwargs["calling_format"] = OrdinaryCallingFormat()
+    if s3_config.get("port"):
+        kwargs["port"] = int(s3_config["port"])
+    if "is_secure" in s3_config:
+        kwargs["is_secure"] = bool(s3_config["is_secure"])
+    return S3Connection(s3_config.get("access_key_id"),
+                        s3_config.get("secret_access_key"),
+                        **kwargs)
+
+
+def split_uri(uri):
+    """
+    split "s3://bucket/key" into ("bucket", "key")
+    """
+    if not uri.startswith("s3://"):
+        raise ValueError, "not an S3 URI: %r" % (uri,)
+    parts = uri[len("s3://"):].split("/", 1)
+    if len(parts) == 1:
+        parts.append("")
+    return parts[0], parts[1]
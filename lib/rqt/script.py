@@ -0,0 +1,155 @@
+#  Copyright 2014 Accuen
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""
+multi-statement scripts
+
+run-query --script splits the expanded template into statements and runs
+them one by one on the same session, in one transaction (committed at the
+end), so temp tables and intermediate steps need neither their own rqt
+process nor connection.  Statements that can't run inside a transaction
+block (e.g. VACUUM) commit the work so far and run on their own.
+"""
+import re
+
+
+# the leading keywords of statements that return rows
+_RESULT_KEYWORDS = ("select", "with", "values", "show", "explain")
+
+# the leading keywords of statements DECLARE ... CURSOR accepts
+_CURSOR_KEYWORDS = ("select", "with", "values")
+
+_NO_TRANSACTION = re.compile(r"^(vacuum|create\s+database|drop\s+database|create\s+library|drop\s+library)\b", re.I)
+
+_DOLLAR_TAG = re.compile(r"\$[A-Za-z_0-9]*\$")
+
+
+def split_statements(sql):
+    """
+    return the non-empty statements of sql, split at semicolons
+
+    Semicolons inside quotes ('...' with backslash escapes, "...",
+    $tag$...$tag$) and comments (-- ... and /* ... */) don't end a
+    statement.
+    """
+    statements = []
+    start = 0
+    i = 0
+    n = len(sql)
+    while i < n:
+        c = sql[i]
+        if c == "'":
+            i = _end_of_string(sql, i)
+        elif c == '"':
+            # A doubled quote is an escaped one; the scan just restarts after it.
+            end = sql.find(c, i + 1)
+            i = n if end < 0 else end + 1
+        elif sql.startswith("--", i):
+            end = sql.find("\n", i)
+            i = n if end < 0 else end + 1
+        elif sql.startswith("/*", i):
+            end = sql.find("*/", i + 2)
+            i = n if end < 0 else end + 2
+        elif c == "$" and _DOLLAR_TAG.match(sql, i):
+            tag = _DOLLAR_TAG.match(sql, i).group()
+            end = sql.find(tag, i + len(tag))
+            i = n if end < 0 else end + len(tag)
+        elif c == ";":
+            statements.append(sql[start:i])
+            i += 1
+            start = i
+        else:
+            i += 1
+    statements.append(sql[start:])
+    return [stmt.strip() for stmt in statements if _strip_comments(stmt).strip()]
+
+
+def _end_of_string(sql, i):
+    """
+    return the index just past the '...' literal starting at sql[i]
+
+    Redshift takes backslash escapes in string literals, so the character
+    after a backslash never ends one.  A doubled quote ends the literal
+    and starts the next, which comes to the same thing.
+    """
+    n = len(sql)
+    i += 1
+    while i < n:
+        if sql[i] == "\\":
+            i += 2
+        elif sql[i] == "'":
+            return i + 1
+        else:
+            i += 1
+    return n
+
+
+def _strip_comments(stmt):
+    """
+    return stmt without its leading comments
+    """
+    while True:
+        stmt = stmt.lstrip()
+        if stmt.startswith("--"):
+            end = stmt.find("\n")
+            stmt = "" if end < 0 else stmt[end+1:]
+        elif stmt.startswith("/*"):
+            end = stmt.find("*/")
+            stmt = "" if end < 0 else stmt[end+2:]
+        else:
+            return stmt
+
+
+def _keyword(stmt):
+    stmt = _strip_comments(stmt).lstrip("(")
+    return stmt.split(None, 1)[0].lower() if stmt else ""
+
+
+def returns_rows(stmt):
+    """
+    return True if stmt looks like it returns a result set
+    """
+    return _keyword(stmt) in _RESULT_KEYWORDS
+
+
+def can_declare_cursor(stmt):
+    """
+    return True if stmt can be run through a server-side (named) cursor
+
+    DECLARE ... CURSOR only takes a query; SHOW and EXPLAIN return rows
+    but have to run on a client-side cursor.
+    """
+    return _keyword(stmt) in _CURSOR_KEYWORDS
+
+
+def needs_autocommit(stmt):
+    """
+    return True if stmt can't run inside a transaction block
+    """
+    return _NO_TRANSACTION.match(_strip_comments(stmt)) is not None
+
+
+def result_filenms(statements, out_filenm, shard_filenm):
+    """
+    return the output file of each statement (None for those without a result)
+
+    A single result goes to out_filenm; several go to shard_filenm(out_filenm, i)
+    for the i-th result, in script order.
+    """
+    results = [i for i, stmt in enumerate(statements) if returns_rows(stmt)]
+    filenms = [None] * len(statements)
+    for j, i in enumerate(results):
+        filenms[i] = out_filenm if len(results) == 1 else shard_filenm(out_filenm, j)
+    return filenms
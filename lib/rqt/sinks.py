@@ -0,0 +1,660 @@
+#  Copyright 2014 Accuen
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""
+result sinks picked by output file extension
+
+Every sink is opened with the output file name and the result set's
+ConversionPlan, is handed each fetched batch through write_batch(), and
+is finished with close().  write_batch() is split into encode_batch(),
+the CPU-bound conversion, and write_encoded(), the file I/O and
+compression, so the two can run on different pipeline stages.
+
+    * .csv, .txt       -- CSV or tab-delimited text
+    * .jsonl           -- newline-delimited JSON objects
+    * .parquet         -- Parquet row groups (needs pyarrow)
+    * .arrow, .feather -- Arrow IPC file (needs pyarrow)
+
+The text formats may add a compression extension (e.g. .jsonl.gz), and
+their batches can be encoded on a WorkerPool of processes.  Any format
+can be split into numbered shard files with a ShardedSink.
+"""
+import os
+import sys
+import Queue
+import threading
+
+from . import compress
+from . import converters
+from .util import open_output, csv_dialect, unlink_if_shared, CSVEncoder, wait_result
+
+
+DEFAULT_ROW_GROUP_ROWS = 1 << 17
+
+
+class CSVBatchEncoder:
+    """
+    encodes batches as CSV bytes
+    """
+
+    def __init__(self, plan, dialect):
+        self.plan = plan
+        self.encoder = CSVEncoder(dialect=dialect)
+
+    def encode_header(self):
+        return self.encoder.encode([self.plan.col_nms])
+
+    def encode_batch(self, batch):
+        return self.encoder.encode(self.plan.to_bytes(batch))
+
+
+class JSONLinesBatchEncoder:
+    """
+    encodes batches as JSON Lines bytes
+    """
+
+    def __init__(self, plan):
+        self.plan = plan
+        # Each line is a %-format with the (pre-encoded) keys baked in.
+        keys = [converters._json_string(col_nm).replace("%", "%%") for col_nm in plan.col_nms]
+        self.line_fmt = "{" + ",".join("%s:%%s" % (key,) for key in keys) + "}\n"
+
+    def encode_header(self):
+        return ""
+
+    def encode_batch(self, batch):
+        line_fmt = self.line_fmt
+        return "".join([line_fmt % row for row in self.plan.to_json_tokens(batch)])
+
+
+def mk_text_encoder(filenm, plan):
+    """
+    returns the batch encoder for a text output file, or None for columnar output
+    """
+    filenm2 = compress.split_codec(filenm)[0]
+    if filenm2.endswith(".jsonl"):
+        return JSONLinesBatchEncoder(plan)
+    elif filenm2.endswith(".csv") or filenm2.endswith(".txt"):
+        return CSVBatchEncoder(plan, csv_dialect(filenm))
+    return None
+
+
+class _Sink:
+    """
+    base class for sinks
+    """
+
+    def write_batch(self, batch):
+        self.write_encoded(self.encode_batch(batch))
+
+    def write_encoded(self, data):
+        """
+        write an encoded batch and return its size in bytes
+        """
+        data = self.ready(data)
+        self.write_ready(data)
+        return self.encoded_size(data)
+
+    def ready(self, data):
+        """
+        return an encoded batch as it is written, e.g. once a WorkerPool has encoded it
+        """
+        return data
+
+    def output_size(self):
+        """
+        return the bytes in the output file so far (after compression), or None if unknown
+        """
+        return _file_size(self.filenm)
+
+
+def _file_size(filenm):
+    if filenm.startswith("stdout"):
+        return None
+    try:
+        return os.stat(filenm).st_size
+    except OSError:
+        return None
+
+
+class TextSink(_Sink):
+    """
+    CSV, tab-delimited (with a header row) or JSON Lines output
+
+    With a WorkerPool, batches are encoded on its processes.  With header
+    false the CSV header row is left out, e.g. for output appended to an
+    existing file with append.
+    """
+
+    def __init__(self, filenm, plan, compress_level=None, compress_threads=1, pool=None, header=True,
+                 append=False):
+        self.filenm = filenm
+        self.plan = plan
+        self.pool = pool
+        self.encoder = mk_text_encoder(filenm, plan)
+        if self.encoder is None:
+            raise ValueError, "unsupported file type: %r" % filenm
+        self.fp = open_output(filenm, compress_level, compress_threads, append)
+        if header:
+            self.fp.write(self.encoder.encode_header())
+
+    def encode_batch(self, batch):
+        if self.pool is not None:
+            return self.pool.encode_batch(batch)
+        return self.encoder.encode_batch(batch)
+
+    def ready(self, data):
+        if self.pool is not None:
+            return wait_result(data)
+        return data
+
+    def write_ready(self, data):
+        self.fp.write(data)
+
+    def encoded_size(self, data):
+        return len(data)
+
+    def close(self):
+        self.fp.close()
+
+
+########################################################################
+
+
+def _arrow_type(pa, plan, i):
+    """
+    return the Arrow type for column i of the plan
+    """
+    kind = plan.kinds[i]
+    if kind == "text":
+        return pa.string()
+    elif kind == "int":
+        return pa.int64()
+    elif kind == "float":
+        return pa.float64()
+    elif kind == "bool":
+        return pa.bool_()
+    elif kind == "date":
+        return pa.date32()
+    elif kind == "time":
+        return pa.time64("us")
+    elif kind == "timestamp":
+        if plan.type_codes[i] == 1184:
+            # timestamptz values come back as tz-aware datetimes.
+            return pa.timestamp("us", tz="UTC")
+        return pa.timestamp("us")
+    elif kind == "numeric" and plan.precisions[i]:
+        return pa.decimal128(plan.precisions[i], plan.scales[i] or 0)
+    # Anything else is written as its text form.
+    return pa.string()
+
+
+def _arrow_values(arrow_type, pa, col):
+    if arrow_type == pa.string():
+        return [None if x is None else converters._cell_to_bytes(x) for x in col]
+    return col
+
+
+class _ArrowSink(_Sink):
+    """
+    base class for typed columnar output written in row groups
+    """
+
+    def __init__(self, filenm, plan, row_group_rows=DEFAULT_ROW_GROUP_ROWS):
+        if filenm.startswith("stdout"):
+            raise ValueError, "columnar output can't be written to stdout: %r" % (filenm,)
+        import pyarrow # optional dependency
+        self.pa = pyarrow
+        self.filenm = filenm
+        self.plan = plan
+        self.types = [_arrow_type(pyarrow, plan, i) for i in range(len(plan.col_nms))]
+        self.schema = pyarrow.schema([pyarrow.field(col_nm, arrow_type)
+                                      for col_nm, arrow_type in zip(plan.col_nms, self.types)])
+        self.row_group_rows = row_group_rows
+        self.pending = []
+        self.pending_rows = 0
+        unlink_if_shared(filenm)
+        self.open(filenm)
+
+    def encode_batch(self, batch):
+        pa = self.pa
+        cols = self.plan.to_columns(batch)
+        arrays = [pa.array(_arrow_values(arrow_type, pa, col), type=arrow_type)
+                  for arrow_type, col in zip(self.types, cols)]
+        return pa.RecordBatch.from_arrays(arrays, self.plan.col_nms)
+
+    def write_ready(self, record_batch):
+        self.pending.append(record_batch)
+        self.pending_rows += record_batch.num_rows
+        if self.pending_rows >= self.row_group_rows:
+            self._write_pending()
+
+    def encoded_size(self, record_batch):
+        # the in-memory size
+        return record_batch.nbytes
+
+    def _write_pending(self):
+        self.write_table(self.pa.Table.from_batches(self.pending, schema=self.schema))
+        self.pending = []
+        self.pending_rows = 0
+
+    def close(self):
+        if self.pending:
+            self._write_pending()
+        self.finish()
+
+
+class ParquetSink(_ArrowSink):
+    """
+    Parquet output; each row group holds up to row_group_rows rows
+    """
+
+    def open(self, filenm):
+        import pyarrow.parquet
+        self.writer = pyarrow.parquet.ParquetWriter(filenm, self.schema)
+
+    def write_table(self, table):
+        self.writer.write_table(table)
+
+    def finish(self):
+        self.writer.close()
+
+
+class ArrowSink(_ArrowSink):
+    """
+    Arrow IPC file (a.k.a. Feather v2) output
+    """
+
+    def open(self, filenm):
+        self.fp = self.pa.OSFile(filenm, "wb")
+        self.writer = self.pa.RecordBatchFileWriter(self.fp, self.schema)
+
+    def write_table(self, table):
+        self.writer.write_table(table)
+
+    def finish(self):
+        self.writer.close()
+        self.fp.close()
+
+
+########################################################################
+
+
+def shard_filenm(filenm, shard_no):
+    """
+    returns the name of shard shard_no, e.g. out.csv.gz -> out-00003.csv.gz
+    """
+    base = compress.split_codec(filenm)[0]
+    codec_ext = filenm[len(base):]
+    stem, ext = os.path.splitext(base)
+    return "%s-%05d%s%s" % (stem, shard_no, ext, codec_ext)
+
+
+_ROTATE = object()
+
+_SHARD_DONE = object()
+
+DEFAULT_SHARD_CONCURRENCY = 2
+SHARD_QUEUE_SIZE = 8
+
+
+class _ShardWriter:
+    """
+    writes (and so compresses) one shard's encoded batches on its own thread
+
+    finish() queues the close and the rename into place; join() waits for
+    them and re-raises a failure.
+    """
+
+    def __init__(self, sink, tmp_filenm, final_filenm):
+        self.sink = sink
+        self.tmp_filenm = tmp_filenm
+        self.final_filenm = final_filenm
+        self.queue = Queue.Queue(SHARD_QUEUE_SIZE)
+        self.exc_info = None
+        self.thread = threading.Thread(target=self._run, name="rqt-shard")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while 1:
+            data = self.queue.get()
+            if data is _SHARD_DONE:
+                break
+            if self.exc_info is None:
+                try:
+                    self.sink.write_ready(data)
+                except:
+                    # Keep draining, so put() never blocks on a dead shard.
+                    self.exc_info = sys.exc_info()
+        if self.exc_info is None:
+            try:
+                _finish_shard(self.sink, self.tmp_filenm, self.final_filenm)
+            except:
+                self.exc_info = sys.exc_info()
+
+    def _reraise(self):
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+
+    def put(self, data):
+        self._reraise()
+        self.queue.put(data)
+
+    def finish(self):
+        self.queue.put(_SHARD_DONE)
+
+    def join(self):
+        while self.thread.is_alive():
+            # A timed join, so signals are handled meanwhile.
+            self.thread.join(0.5)
+        self._reraise()
+
+
+class ShardedSink(_Sink):
+    """
+    output split over numbered shard files
+
+    A shard holds at most max_rows rows, and a new shard is started once
+    max_bytes bytes (before compression) have been written to the current
+    one.  Each shard is written and compressed on a thread of its own,
+    under a hidden ".NAME", and renamed into place once it is finished, so
+    up to concurrency shards are compressed at once and consumers can pick
+    up early shards while later ones are still being written.
+    """
+
+    def __init__(self, filenm, plan, open_shard, max_rows=None, max_bytes=None,
+                 concurrency=DEFAULT_SHARD_CONCURRENCY):
+        if filenm.startswith("stdout"):
+            raise ValueError, "sharded output can't be written to stdout: %r" % (filenm,)
+        self.filenm = filenm
+        self.open_shard = open_shard
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.concurrency = concurrency
+        self.filenms = []
+        self.finishing = []
+        self.rows_encoded = 0
+        self.bytes_written = 0
+        self.rotate_pending = False
+        self._open_next()
+        # Encoding doesn't depend on the shard's file, so every shard
+        # shares the first one's encoder.
+        self.encode = self.sink.encode_batch
+
+    def _open_next(self):
+        final_filenm = shard_filenm(self.filenm, len(self.filenms))
+        dirnm, basenm = os.path.split(final_filenm)
+        tmp_filenm = os.path.join(dirnm, "." + basenm)
+        self.sink = self.open_shard(tmp_filenm)
+        self.writer = _ShardWriter(self.sink, tmp_filenm, final_filenm)
+        self.filenms.append(final_filenm)
+        self.bytes_written = 0
+
+    def _rotate(self):
+        self.writer.finish()
+        self.finishing.append(self.writer)
+        # Leave room for the next shard.
+        while len(self.finishing) >= self.concurrency:
+            self.finishing.pop(0).join()
+        self._open_next()
+        self.rotate_pending = False
+
+    def encode_batch(self, batch):
+        """
+        returns the encoded pieces of batch with shard breaks between them
+        """
+        if not self.max_rows:
+            return [self.encode(batch)]
+        pieces = []
+        while batch:
+            room = self.max_rows - self.rows_encoded
+            piece, batch = batch[:room], batch[room:]
+            pieces.append(self.encode(piece))
+            self.rows_encoded += len(piece)
+            if self.rows_encoded >= self.max_rows:
+                pieces.append(_ROTATE)
+                self.rows_encoded = 0
+        return pieces
+
+    def write_encoded(self, pieces):
+        size = 0
+        for piece in pieces:
+            if piece is _ROTATE:
+                self.rotate_pending = True
+                continue
+            # Shards are only started when there is data to put in them.
+            if self.rotate_pending:
+                self._rotate()
+            data = self.sink.ready(piece)
+            self.writer.put(data)
+            n = self.sink.encoded_size(data)
+            size += n
+            self.bytes_written += n
+            if self.max_bytes and self.bytes_written >= self.max_bytes:
+                self.rotate_pending = True
+        return size
+
+    def output_size(self):
+        """
+        return the bytes in all shards so far, finished or not
+        """
+        size = 0
+        for final_filenm in self.filenms:
+            dirnm, basenm = os.path.split(final_filenm)
+            # A shard is renamed into place once it is finished (and the
+            # final name may still hold a shard from an earlier run).
+            n = _file_size(os.path.join(dirnm, "." + basenm))
+            if n is None:
+                n = _file_size(final_filenm)
+            size += n or 0
+        return size
+
+    def close(self):
+        self.writer.finish()
+        self.finishing.append(self.writer)
+        for writer in self.finishing:
+            writer.join() # re-raises a failed write or close
+
+
+def _finish_shard(sink, tmp_filenm, final_filenm):
+    sink.close()
+    os.rename(tmp_filenm, final_filenm)
+
+
+_COMMIT = object()
+
+
+def _fsync_file(filenm):
+    fd = os.open(filenm, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class CheckpointedSink(_Sink):
+    """
+    text output committed in chunks of at least chunk_rows rows
+
+    The result set must be ordered by the key column, and a chunk only
+    ends where the key changes, so "key > last committed key" selects
+    exactly the rows still to be written.  At the end of each chunk the
+    chunk's sink is closed (finishing its compressed member), the file is
+    fsync'ed, and on_commit(key, rows, size) is called with the chunk's
+    last key, the rows and the file size committed so far; the next chunk
+    is appended to the file.
+    """
+
+    def __init__(self, filenm, open_chunk, key_index, chunk_rows, on_commit, append=False):
+        self.filenm = filenm
+        self.open_chunk = open_chunk
+        self.key_index = key_index
+        self.chunk_rows = chunk_rows
+        self.on_commit = on_commit
+        self.chunk_count = 0 # rows encoded into the current chunk
+        self.rows_encoded = 0
+        self.rows_written = 0
+        self.last_key = None
+        self.sink = open_chunk(append)
+        # As for shards, every chunk shares the first one's encoder.
+        self.encode = self.sink.encode_batch
+
+    def _cuts(self, batch):
+        """
+        return [(index, key of the row before it)] where batch is cut into chunks
+        """
+        k = self.key_index
+        cuts = []
+        i = 0
+        while i < len(batch):
+            room = self.chunk_rows - self.chunk_count
+            if room > 0:
+                step = min(room, len(batch) - i)
+                self.chunk_count += step
+                i += step
+                self.last_key = batch[i-1][k]
+            elif batch[i][k] != self.last_key:
+                # The chunk is full and the key changes here.
+                cuts.append((i, self.last_key))
+                self.chunk_count = 0
+            else:
+                # Rows sharing a key stay in one chunk.
+                self.chunk_count += 1
+                i += 1
+        return cuts
+
+    def encode_batch(self, batch):
+        """
+        returns the encoded pieces of batch with chunk commits between them
+        """
+        pieces = []
+        start = 0
+        for i, key in self._cuts(batch):
+            if i > start:
+                pieces.append(self.encode(batch[start:i]))
+            pieces.append((_COMMIT, key, self.rows_encoded + i))
+            start = i
+        if start < len(batch):
+            pieces.append(self.encode(batch[start:]))
+        self.rows_encoded += len(batch)
+        return pieces
+
+    def write_encoded(self, pieces):
+        size = 0
+        for piece in pieces:
+            if type(piece) is tuple and piece[0] is _COMMIT:
+                self._commit(piece[1], piece[2])
+            else:
+                size += self.sink.write_encoded(piece)
+        return size
+
+    def _commit(self, key, rows):
+        self.sink.close()
+        _fsync_file(self.filenm)
+        self.on_commit(key, rows, os.path.getsize(self.filenm))
+        self.sink = self.open_chunk(True)
+
+    def close(self):
+        self.sink.close()
+        _fsync_file(self.filenm)
+
+
+def open_sink(filenm, plan, compress_level=None, compress_threads=1, pool=None,
+              max_rows_per_file=None, max_bytes_per_file=None, header=True, append=False,
+              chunk_rows=None, chunk_key=None, on_commit=None):
+    """
+    returns the sink for filenm's extension
+    """
+    if chunk_rows:
+        if mk_text_encoder(filenm, plan) is None or filenm.startswith("stdout"):
+            raise ValueError, "checkpointed output must be a .csv, .txt or .jsonl file: %r" % (filenm,)
+        if chunk_key not in plan.col_nms:
+            raise ValueError, "the query result has no %r column to checkpoint on" % (chunk_key,)
+        open_chunk = lambda append_chunk: TextSink(filenm, plan, compress_level, compress_threads, pool,
+                                                   header=header and not append_chunk, append=append_chunk)
+        return CheckpointedSink(filenm, open_chunk, plan.col_nms.index(chunk_key), chunk_rows, on_commit, append)
+    if max_rows_per_file or max_bytes_per_file:
+        open_shard = lambda shard_filenm: open_sink(shard_filenm, plan, compress_level,
+                                                    compress_threads, pool)
+        return ShardedSink(filenm, plan, open_shard, max_rows_per_file, max_bytes_per_file)
+    if filenm.endswith(".parquet"):
+        return ParquetSink(filenm, plan)
+    elif filenm.endswith(".arrow") or filenm.endswith(".feather"):
+        return ArrowSink(filenm, plan)
+    # TextSink raises ValueError for anything else.
+    return TextSink(filenm, plan, compress_level, compress_threads, pool, header, append)
+
+
+########################################################################
+# Process pool encoding
+########################################################################
+
+
+# (filenm, description) -> encoder, in each worker process
+_worker_encoders = {}
+
+_MAX_WORKER_ENCODERS = 16
+
+
+def _encode_in_worker(filenm, description, batch):
+    key = (filenm, description)
+    encoder = _worker_encoders.get(key)
+    if encoder is None:
+        if len(_worker_encoders) >= _MAX_WORKER_ENCODERS:
+            _worker_encoders.clear()
+        encoder = _worker_encoders[key] = mk_text_encoder(filenm, converters.compile_plan(description))
+    return encoder.encode_batch(batch)
+
+
+class _PoolEncoder:
+    """
+    encodes batches for one text output file on a WorkerPool
+    """
+
+    def __init__(self, pool, filenm, description):
+        self.pool = pool
+        self.filenm = filenm
+        # Plain tuples pickle regardless of the DB-API's column type.
+        self.description = tuple(tuple(desc) for desc in description)
+
+    def encode_batch(self, batch):
+        return self.pool.apply_async(_encode_in_worker, (self.filenm, self.description, batch))
+
+
+class WorkerPool:
+    """
+    a pool of processes encoding batches for text output files
+
+    Start it before the process has other threads; forking a threaded
+    process can deadlock the child in Python 2.  encoder() returns the
+    encoder for one output; its encode_batch() returns an AsyncResult, to
+    get() in submission order to write the bytes in the original row order.
+    """
+
+    def __init__(self, workers):
+        import multiprocessing
+        self.pool = multiprocessing.Pool(workers)
+
+    def encoder(self, filenm, description):
+        return _PoolEncoder(self.pool, filenm, description)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def terminate(self):
+        self.pool.terminate()
+        self.pool.join()
@@ -0,0 +1,247 @@
+#  Copyright 2014 Accuen
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""
+phase-level tracing spans and an optional CPU/memory profiler
+
+Code marks its phases with
+
+    with tracing.span("connect"):
+        ...
+
+Spans cost next to nothing until tracing is enabled (rqt --trace FILE or
+--profile mem).  The recorded spans are written as a Chrome trace-event
+JSON file, which chrome://tracing and https://ui.perfetto.dev display as
+a timeline per thread.
+
+--profile cpu runs the action under cProfile, including the pipeline's
+fetch and convert threads, and prints the top functions.  --profile mem
+uses tracemalloc where it is available and otherwise reports the peak
+RSS growth seen during each kind of span.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import resource
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_PROFILE_TOP = 25
+
+PROFILE_KINDS = ["cpu", "mem"]
+
+# the recorded spans, or None when tracing is off
+_events = None
+_track_rss = False
+
+# one cProfile.Profile per profiled thread, or None when not profiling
+_profilers = None
+
+
+def _peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class _NullSpan:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        if _track_rss:
+            self.rss_kb = _peak_rss_kb()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        end = time.time()
+        if _track_rss:
+            self.args["rss_growth_kb"] = _peak_rss_kb() - self.rss_kb
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        add_span(self.name, self.start, end, **self.args)
+        return False
+
+
+def enabled():
+    return _events is not None
+
+
+def enable(track_rss=False):
+    """
+    start recording spans
+    """
+    global _events, _track_rss
+    if _events is None:
+        _events = []
+    _track_rss = _track_rss or track_rss
+
+
+def span(name, **args):
+    """
+    return a context manager recording the time spent in its block as a span
+    """
+    if _events is None:
+        return _NULL_SPAN
+    return _Span(name, args)
+
+
+def add_span(name, start, end, **args):
+    """
+    record a span measured by the caller (start and end as from time.time())
+    """
+    if _events is None:
+        return
+    thread = threading.current_thread()
+    # list.append is atomic, so threads need no lock here.
+    _events.append({"name": name, "ph": "X", "ts": int(start * 1e6), "dur": int((end - start) * 1e6),
+                    "pid": os.getpid(), "tid": thread.ident, "thread_name": thread.name,
+                    "args": args})
+
+
+def write_chrome_trace(filenm):
+    """
+    write the recorded spans as a Chrome trace-event JSON file
+    """
+    events = []
+    thread_names = {}
+    for event in _events or []:
+        event = dict(event)
+        thread_names[(event["pid"], event["tid"])] = event.pop("thread_name")
+        events.append(event)
+    for (pid, tid), thread_name in sorted(thread_names.items()):
+        events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+                       "args": {"name": thread_name}})
+    with open(filenm, "w") as fp:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, fp)
+    logger.info("wrote %d trace events to %r" % (len(events), filenm))
+
+
+def summarize_rss(top=DEFAULT_PROFILE_TOP):
+    """
+    return [(span name, count, total RSS growth KB, max RSS growth KB)], largest growth first
+    """
+    totals = {}
+    for event in _events or []:
+        growth = event["args"].get("rss_growth_kb")
+        if growth is None:
+            continue
+        count, total, largest = totals.get(event["name"], (0, 0, 0))
+        totals[event["name"]] = (count + 1, total + growth, max(largest, growth))
+    rows = [(name,) + v for name, v in totals.items()]
+    rows.sort(key=lambda row: -row[2])
+    return rows[:top]
+
+
+########################################################################
+# profiling
+########################################################################
+
+
+def profiled_thread(target):
+    """
+    wrap a thread target so its work shows up in --profile cpu
+    """
+    if _profilers is None:
+        return target
+
+    def run(*pargs, **kwargs):
+        import cProfile
+        prof = cProfile.Profile()
+        _profilers.append(prof)
+        return prof.runcall(target, *pargs, **kwargs)
+
+    return run
+
+
+def _report_cpu(top, fp):
+    import pstats
+    stats = pstats.Stats(_profilers[0], stream=fp)
+    for prof in _profilers[1:]:
+        stats.add(prof)
+    print >>fp, "top %d functions by cumulative time (all threads):" % (top,)
+    stats.sort_stats("cumulative").print_stats(top)
+    print >>fp, "top %d functions by own time (all threads):" % (top,)
+    stats.sort_stats("time").print_stats(top)
+
+
+def _report_tracemalloc(tracemalloc, top, fp):
+    snapshot = tracemalloc.take_snapshot()
+    current, peak = tracemalloc.get_traced_memory()
+    print >>fp, "traced memory: current=%d KB peak=%d KB" % (current // 1024, peak // 1024)
+    print >>fp, "top %d allocation sites:" % (top,)
+    for stat in snapshot.statistics("lineno")[:top]:
+        print >>fp, "    %s" % (stat,)
+
+
+def _report_rss(top, fp):
+    print >>fp, "peak RSS %d KB; top %d spans by peak RSS growth:" % (_peak_rss_kb(), top)
+    print >>fp, "    %-24s %8s %14s %14s" % ("span", "count", "growth_kb", "max_growth_kb")
+    for name, count, total, largest in summarize_rss(top):
+        print >>fp, "    %-24s %8d %14d %14d" % (name, count, total, largest)
+
+
+def run_action(func, args, trace_filenm=None, profile=None, top=DEFAULT_PROFILE_TOP):
+    """
+    run func(args) with tracing and/or profiling as requested
+    """
+    global _profilers
+    if trace_filenm is None and profile is None:
+        return func(args)
+    tracemalloc = None
+    if profile == "mem":
+        try:
+            import tracemalloc
+        except ImportError:
+            logger.info("tracemalloc is not available; profiling peak RSS growth per span")
+    if trace_filenm is not None or (profile == "mem" and tracemalloc is None):
+        enable(track_rss=(profile == "mem"))
+    if profile == "cpu":
+        _profilers = []
+        func = profiled_thread(func)
+    elif tracemalloc is not None:
+        tracemalloc.start()
+    try:
+        with span("action", command=getattr(args, "mode", None)):
+            return func(args)
+    finally:
+        if profile == "cpu":
+            _report_cpu(top, sys.stderr)
+            _profilers = None
+        elif tracemalloc is not None:
+            _report_tracemalloc(tracemalloc, top, sys.stderr)
+            tracemalloc.stop()
+        elif profile == "mem":
+            _report_rss(top, sys.stderr)
+        if trace_filenm is not None:
+            write_chrome_trace(trace_filenm)
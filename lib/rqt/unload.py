@@ -0,0 +1,243 @@
+#  Copyright 2014 Accuen
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""
+UNLOAD export engine
+
+Instead of pulling every row through the leader node over one socket,
+the query is wrapped in a Redshift UNLOAD so each slice writes its part
+of the result to S3 in parallel.  The slice files listed in the manifest
+are then downloaded concurrently and stitched into the output file.
+"""
+import os
+import sys
+import csv
+import json
+import gzip
+import time
+import uuid
+import shutil
+import logging
+import datetime
+import tempfile
+
+from . import s3
+from .util import unlink_if_shared
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_THREADS = 8
+
+
+def _strip_query(q):
+    """
+    remove surrounding whitespace and trailing semicolons from a query
+    """
+    return q.strip().rstrip(";").strip()
+
+
+def _quote(s):
+    """
+    return s as a single-quoted SQL string literal
+    """
+    return "'%s'" % (s.replace("\\", "\\\\").replace("'", "''"),)
+
+
+def _credentials_clause(s3_config):
+    if s3_config.get("iam_role"):
+        return "IAM_ROLE %s" % (_quote(s3_config["iam_role"]),)
+    creds = "aws_access_key_id=%s;aws_secret_access_key=%s" % (
+        s3_config["access_key_id"], s3_config["secret_access_key"])
+    return "CREDENTIALS %s" % (_quote(creds),)
+
+
+def _output_kind(out_filenm):
+    """
+    return (delimiter, gzipped) for an output file name
+    """
+    gzipped = out_filenm.endswith(".gz")
+    filenm = out_filenm[:-3] if gzipped else out_filenm
+    if filenm.endswith(".csv"):
+        return ",", gzipped
+    elif filenm.endswith(".txt"):
+        return "\t", gzipped
+    raise ValueError, "unsupported file type for UNLOAD: %r" % (out_filenm,)
+
+
+def mk_unload_sql(query, s3_uri, s3_config, delimiter=","):
+    """
+    return the UNLOAD statement writing query's result under s3_uri
+    """
+    lines = [
+        "UNLOAD (%s)" % (_quote(_strip_query(query)),),
+        "TO %s" % (_quote(s3_uri),),
+        _credentials_clause(s3_config),
+        "FORMAT AS CSV DELIMITER AS %s" % (_quote(delimiter),),
+        "NULL AS 'NULL'",
+        "GZIP",
+        "PARALLEL ON",
+        "MANIFEST;",
+    ]
+    return "\n".join(lines)
+
+
+def mk_s3_uri(s3_config):
+    """
+    return a unique s3://bucket/prefix/ to unload one result set to
+    """
+    prefix = s3_config["prefix"].rstrip("/")
+    cymd = datetime.date.today().strftime("%Y/%m/%d")
+    return "/".join((prefix, cymd, uuid.uuid4().hex)) + "/"
+
+
+def get_column_names(cs, query):
+    """
+    return the result column names without running the full query
+    """
+    cs.execute("SELECT * FROM (%s) AS rqt_unload LIMIT 0" % (_strip_query(query),))
+    return [desc[0] for desc in cs.description]
+
+
+def _download(args):
+    """
+    download one slice file to a local file (runs on a pool thread)
+    """
+    bucket, keyname, local_filenm = args
+    key = bucket.get_key(keyname)
+    key.get_contents_to_filename(local_filenm)
+    return local_filenm, os.stat(local_filenm).st_size
+
+
+def _open_output(out_filenm):
+    if out_filenm.startswith("stdout"):
+        return sys.stdout
+    unlink_if_shared(out_filenm)
+    return open(out_filenm, "wb")
+
+
+def _write_header(fp, col_nms, delimiter, gzipped):
+    dialect = "excel" if delimiter == "," else "excel-tab"
+    # UNLOAD ends its lines with a bare newline; the header must match.
+    kwargs = {"dialect": dialect, "lineterminator": "\n"}
+    if gzipped:
+        # The header is its own gzip member; the slice files are appended
+        # as further members, which gunzip reads as one stream.
+        fp2 = gzip.GzipFile(fileobj=fp, mode="wb", compresslevel=6)
+        csv.writer(fp2, **kwargs).writerow(col_nms)
+        fp2.close()
+    else:
+        csv.writer(fp, **kwargs).writerow(col_nms)
+
+
+def download_and_merge(bucket, manifest_keyname, out_filenm, col_nms, delimiter,
+                       gzipped, run_log, threads=DEFAULT_THREADS):
+    """
+    download the manifest's slice files concurrently and merge them in order
+    """
+    from multiprocessing.pool import ThreadPool # lazy import; keeps CLI startup fast
+    manifest = json.loads(bucket.get_key(manifest_keyname).get_contents_as_string())
+    entries = [s3.split_uri(entry["url"])[1] for entry in manifest["entries"]]
+    logger.info("downloading %d slice files with %d threads" % (len(entries), threads))
+    tmp_dirnm = tempfile.mkdtemp(prefix="rqt-unload-")
+    pool = ThreadPool(threads)
+    fp = _open_output(out_filenm)
+    bytes_downloaded = 0
+    try:
+        _write_header(fp, col_nms, delimiter, gzipped)
+        jobs = [(bucket, keyname, os.path.join(tmp_dirnm, "%05d.gz" % i))
+                for i, keyname in enumerate(entries)]
+        # imap() yields in manifest order, so slices are merged as soon as
+        # they and all the ones before them have arrived.
+        for local_filenm, size in pool.imap(_download, jobs):
+            bytes_downloaded += size
+            if gzipped:
+                with open(local_filenm, "rb") as fp_in:
+                    shutil.copyfileobj(fp_in, fp, 1 << 20)
+            else:
+                fp_in = gzip.GzipFile(local_filenm, "rb")
+                try:
+                    shutil.copyfileobj(fp_in, fp, 1 << 20)
+                finally:
+                    fp_in.close()
+            os.remove(local_filenm)
+    finally:
+        pool.close()
+        pool.join()
+        if fp is not sys.stdout:
+            fp.close()
+        shutil.rmtree(tmp_dirnm, ignore_errors=True)
+    run_log["unload"]["slice_count"] = len(entries)
+    run_log["unload"]["bytes_downloaded"] = bytes_downloaded
+    return entries
+
+
+def delete_prefix(s3_config, bucketname, prefix, bucket=None):
+    """
+    delete every key under s3://bucketname/prefix, logging rather than raising errors
+    """
+    try:
+        if bucket is None:
+            bucket = s3.connect(s3_config).get_bucket(bucketname)
+        keys = list(bucket.list(prefix=prefix))
+        if keys:
+            bucket.delete_keys(keys)
+    except Exception, exc:
+        logger.warning("couldn't delete s3://%s/%s: %s" % (bucketname, prefix, exc))
+
+
+def run_unload(cs, query, s3_config, out_filenm, run_log, threads=DEFAULT_THREADS):
+    """
+    export the query result to out_filenm via UNLOAD and add some info to run_log
+    """
+    delimiter, gzipped = _output_kind(out_filenm)
+    col_nms = get_column_names(cs, query)
+    s3_uri = mk_s3_uri(s3_config)
+    bucketname, prefix = s3.split_uri(s3_uri)
+    run_log["unload"] = {"s3_uri": s3_uri}
+    bucket = None
+    try:
+        # Run the UNLOAD...
+        u_time_start = time.time()
+        cs.execute(mk_unload_sql(query, s3_uri, s3_config, delimiter))
+        u_time_end = time.time()
+        logger.info("unload_elapsed_seconds=%.1f uri=%s" % (u_time_end - u_time_start, s3_uri))
+        run_log["timing"]["unload"] = {}
+        run_log["timing"]["unload"]["start"] = u_time_start
+        run_log["timing"]["unload"]["end"] = u_time_end
+        run_log["timing"]["unload"]["elapsed"] = u_time_end - u_time_start
+        # Download and merge the slice files...
+        d_time_start = time.time()
+        bucket = s3.connect(s3_config).get_bucket(bucketname)
+        manifest_keyname = prefix + "manifest"
+        download_and_merge(bucket, manifest_keyname, out_filenm, col_nms,
+                           delimiter, gzipped, run_log, threads=threads)
+        d_time_end = time.time()
+        logger.info("download_elapsed_seconds=%.1f" % (d_time_end - d_time_start,))
+        run_log["timing"]["download"] = {}
+        run_log["timing"]["download"]["start"] = d_time_start
+        run_log["timing"]["download"]["end"] = d_time_end
+        run_log["timing"]["download"]["elapsed"] = d_time_end - d_time_start
+        if "stdout" not in out_filenm:
+            run_log["result_size"] = os.stat(out_filenm).st_size
+        else:
+            run_log["result_size"] = 0
+    finally:
+        # The slice files are only scratch space, also after a failed
+        # UNLOAD (which may have written some) or download.
+        if not s3_config.get("keep"):
+            delete_prefix(s3_config, bucketname, prefix, bucket)
+    logger.info("saved results to %r" % (out_filenm,))
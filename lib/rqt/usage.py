@@ -0,0 +1,305 @@
+#  Copyright 2014 Accuen
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""
+usage log spooling and batched shipping to S3
+
+Run logs are appended to a local spool file, which is cheap enough to
+do before every exit.  Shipping moves the spool aside and uploads it as
+gzipped newline-delimited JSON objects of at most batch_records records
+each.  A batch file is only deleted once all of its objects are in S3,
+and its object names are derived from the batch file name, so a batch
+left over by a crashed upload is simply uploaded again on the next
+flush.
+
+The query template and expanded query bodies are stored content-addressed
+under a separate prefix, as BODY_PREFIX/SHA256.sql.gz, and the run log
+only references them by hash.  Each body is uploaded once; the hashes
+already in S3 are remembered in a local index.
+
+The "s3_usage_data" config section may set:
+
+    * spool_dir      -- default ~/.cache/rqt/usage
+    * batch_records  -- records per S3 object, and the spool size that triggers shipping
+    * batch_seconds  -- ship once the oldest spooled record is this old
+    * body_prefix    -- default KEY_PREFIX/bodies
+"""
+import os
+import sys
+import errno
+import json
+import gzip
+import time
+import uuid
+import fcntl
+import logging
+import hashlib
+import cStringIO
+import subprocess
+
+from . import s3
+from . import tracing
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_BATCH_RECORDS = 1000
+DEFAULT_BATCH_SECONDS = 3600
+
+SPOOL_FILENM = "spool.jsonl"
+STARTED_FILENM = "spool.started" # mtime is when the first spooled record was written
+BATCH_PREFIX = "batch-"
+BODIES_DIRNM = "bodies"
+INDEX_FILENM = "known-bodies.txt"
+
+# run_log fields whose (large, repetitive) text is stored by hash
+BODY_FIELDS = ("query_template", "query")
+
+
+def get_spool_dir(usage_config):
+    default_spool_dirnm = os.path.expanduser("~/.cache/rqt/usage")
+    dirnm = os.path.expanduser(usage_config.get("spool_dir", default_spool_dirnm))
+    if not os.path.isdir(dirnm):
+        os.makedirs(dirnm)
+    return dirnm
+
+
+def _open_locked_spool(dirnm):
+    """
+    return the spool file opened for appending with an exclusive lock held
+    """
+    spool_filenm = os.path.join(dirnm, SPOOL_FILENM)
+    while 1:
+        fp = open(spool_filenm, "a")
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        # The spool may have been moved aside while waiting for the lock.
+        try:
+            if os.fstat(fp.fileno()).st_ino == os.stat(spool_filenm).st_ino:
+                return fp
+        except OSError:
+            pass
+        fp.close()
+
+
+def _load_index(dirnm):
+    """
+    return the set of body hashes known to be in S3
+    """
+    try:
+        with open(os.path.join(dirnm, INDEX_FILENM)) as fp:
+            return set(line.strip() for line in fp)
+    except IOError:
+        return set()
+
+
+def _add_to_index(dirnm, hashes):
+    with open(os.path.join(dirnm, INDEX_FILENM), "a") as fp:
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        fp.writelines("%s\n" % (h,) for h in hashes)
+
+
+def _spool_bodies(run_log, dirnm):
+    """
+    return a copy of run_log referencing its bodies by hash, spooling new bodies
+    """
+    run_log = dict(run_log)
+    bodies_dirnm = os.path.join(dirnm, BODIES_DIRNM)
+    if not os.path.isdir(bodies_dirnm):
+        os.makedirs(bodies_dirnm)
+    known = _load_index(dirnm)
+    for field in BODY_FIELDS:
+        body = run_log.pop(field, None)
+        if body is None:
+            continue
+        if isinstance(body, unicode):
+            body = body.encode("utf-8")
+        h = hashlib.sha256(body).hexdigest()
+        run_log[field + "_sha256"] = h
+        body_filenm = os.path.join(bodies_dirnm, h)
+        if h not in known and not os.path.exists(body_filenm):
+            tmp_filenm = "%s.%d.tmp" % (body_filenm, os.getpid())
+            with open(tmp_filenm, "w") as fp:
+                fp.write(body)
+            os.rename(tmp_filenm, body_filenm)
+    # Version 2 run logs reference bodies by hash.
+    run_log["version"] = "2"
+    return run_log
+
+
+def spool(run_log, usage_config):
+    """
+    append a run log to the local spool; return the number of records spooled
+    """
+    dirnm = get_spool_dir(usage_config)
+    run_log = _spool_bodies(run_log, dirnm)
+    line = json.dumps(run_log, separators=(",", ":")) + "\n"
+    fp = _open_locked_spool(dirnm)
+    try:
+        if os.fstat(fp.fileno()).st_size == 0:
+            open(os.path.join(dirnm, STARTED_FILENM), "w").close()
+        fp.write(line)
+        fp.flush()
+        os.fsync(fp.fileno())
+        with open(fp.name) as fp_in:
+            return sum(1 for _ in fp_in)
+    finally:
+        fp.close()
+
+
+def should_ship(usage_config, spooled_records):
+    """
+    return True if the spool is big or old enough to ship
+    """
+    batch_records = int(usage_config.get("batch_records", DEFAULT_BATCH_RECORDS))
+    batch_seconds = float(usage_config.get("batch_seconds", DEFAULT_BATCH_SECONDS))
+    if spooled_records >= batch_records:
+        return True
+    dirnm = get_spool_dir(usage_config)
+    for filenm in os.listdir(dirnm):
+        if filenm.startswith(BATCH_PREFIX):
+            # A batch from an earlier failed upload is waiting.
+            return True
+    try:
+        started = os.path.getmtime(os.path.join(dirnm, STARTED_FILENM))
+    except OSError:
+        return False
+    return time.time() - started >= batch_seconds
+
+
+def ship_in_background(config_filenm):
+    """
+    start a detached "rqt flush-usage" so this process can exit right away
+    """
+    cmd = [sys.executable, "-c", "from rqt.cli import main; main()",
+           "--config", config_filenm, "flush-usage"]
+    with open(os.devnull, "r+") as devnull:
+        subprocess.Popen(cmd, stdin=devnull, stdout=devnull, stderr=devnull,
+                         close_fds=True, preexec_fn=os.setsid)
+    logger.info("shipping usage logs in the background")
+
+
+def _rotate_spool(dirnm):
+    """
+    move the spool aside as a batch file
+    """
+    spool_filenm = os.path.join(dirnm, SPOOL_FILENM)
+    fp = _open_locked_spool(dirnm)
+    try:
+        if os.fstat(fp.fileno()).st_size == 0:
+            return
+        batch_filenm = "%s%s-%s.jsonl" % (BATCH_PREFIX, time.strftime("%Y%m%dT%H%M%S"), uuid.uuid4().hex)
+        os.rename(spool_filenm, os.path.join(dirnm, batch_filenm))
+        try:
+            os.remove(os.path.join(dirnm, STARTED_FILENM))
+        except OSError, exc:
+            # The spool is a batch already; a missing stamp is no reason to fail.
+            if exc.errno != errno.ENOENT:
+                raise
+    finally:
+        fp.close()
+
+
+def _gzip_lines(lines):
+    buf = cStringIO.StringIO()
+    fp = gzip.GzipFile(fileobj=buf, mode="wb")
+    fp.writelines(lines)
+    fp.close()
+    return buf.getvalue()
+
+
+def _ship_batch(bucket, key_prefix, batch_filenm, batch_records):
+    """
+    upload one batch file as gzipped objects of batch_records records
+    """
+    with open(batch_filenm) as fp:
+        lines = fp.readlines()
+    batch_nm = os.path.basename(batch_filenm)[len(BATCH_PREFIX):-len(".jsonl")]
+    # The date comes from the batch's own timestamp (YYYYmmddTHHMMSS-...),
+    # so a batch retried on a later day is re-sent under the same keys.
+    cymd = "%s/%s/%s" % (batch_nm[0:4], batch_nm[4:6], batch_nm[6:8])
+    uris = []
+    for i in range(0, len(lines), batch_records):
+        keyname = "/".join((key_prefix, cymd, "%s-%04d.jsonl.gz" % (batch_nm, i // batch_records)))
+        key = bucket.new_key(keyname)
+        key.set_contents_from_string(_gzip_lines(lines[i:i+batch_records]))
+        uris.append("s3://%s/%s" % (bucket.name, keyname))
+    os.remove(batch_filenm)
+    return len(lines), uris
+
+
+def _ship_bodies(bucket, body_prefix, dirnm):
+    """
+    upload the spooled bodies not yet in S3; return the number uploaded
+    """
+    bodies_dirnm = os.path.join(dirnm, BODIES_DIRNM)
+    if not os.path.isdir(bodies_dirnm):
+        return 0
+    known = _load_index(dirnm)
+    uploaded = []
+    for h in os.listdir(bodies_dirnm):
+        if h.endswith(".tmp"):
+            continue
+        body_filenm = os.path.join(bodies_dirnm, h)
+        if h not in known:
+            with open(body_filenm) as fp:
+                data = _gzip_lines([fp.read()])
+            key = bucket.new_key("%s/%s.sql.gz" % (body_prefix, h))
+            key.set_contents_from_string(data)
+            uploaded.append(h)
+            known.add(h)
+        os.remove(body_filenm)
+    if uploaded:
+        _add_to_index(dirnm, uploaded)
+    return len(uploaded)
+
+
+def flush(usage_config):
+    """
+    ship everything spooled so far; return the number of records shipped
+    """
+    dirnm = get_spool_dir(usage_config)
+    # Only one flush at a time...
+    lock_fp = open(os.path.join(dirnm, "flush.lock"), "a")
+    try:
+        fcntl.flock(lock_fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        logger.info("another usage log flush is running")
+        lock_fp.close()
+        return 0
+    try:
+        _rotate_spool(dirnm)
+        batch_filenms = sorted(os.path.join(dirnm, filenm) for filenm in os.listdir(dirnm)
+                               if filenm.startswith(BATCH_PREFIX))
+        if not batch_filenms:
+            return 0
+        bucket = s3.connect(usage_config).get_bucket(usage_config["bucket"])
+        key_prefix = usage_config["key_prefix"].lstrip("/").rstrip("/")
+        # Bodies go first so every shipped run log's references resolve.
+        body_prefix = usage_config.get("body_prefix", key_prefix + "/bodies").lstrip("/").rstrip("/")
+        with tracing.span("usage_upload_bodies"):
+            n = _ship_bodies(bucket, body_prefix, dirnm)
+        logger.info("uploaded %d new query bodies to s3://%s/%s/" % (n, bucket.name, body_prefix))
+        batch_records = int(usage_config.get("batch_records", DEFAULT_BATCH_RECORDS))
+        shipped = 0
+        for batch_filenm in batch_filenms:
+            with tracing.span("usage_upload", batch=os.path.basename(batch_filenm)):
+                n, uris = _ship_batch(bucket, key_prefix, batch_filenm, batch_records)
+            shipped += n
+            for uri in uris:
+                logger.info("usage data logged to %s" % (uri,))
+        return shipped
+    finally:
+        lock_fp.close()
@@ -13,12 +13,15 @@
 #  limitations under the License.
 
 
+import os
 import sys
-import gzip
+import shutil
 import cStringIO
 import csv
 import codecs
 
+from . import compress
+
 
 
 class UnicodeWriter:
@@ -54,30 +57,87 @@ class UnicodeWriter:
             self.writerow(row)
 
 
-def open_csv_writer(filenm):
+class CSVEncoder:
+    """
+    Formats batches of rows of UTF-8 byte strings as CSV bytes.
+    """
+
+    def __init__(self, dialect=csv.excel, **kwds):
+        self.queue = cStringIO.StringIO()
+        self.writer = csv.writer(self.queue, dialect=dialect, **kwds)
+
+    def encode(self, rows):
+        self.writer.writerows(rows)
+        data = self.queue.getvalue()
+        self.queue.seek(0)
+        self.queue.truncate(0)
+        return data
+
+
+def csv_dialect(filenm):
+    """
+    returns the csv dialect for a .csv or .txt file name (optionally compressed)
+    """
+    filenm2 = compress.split_codec(filenm)[0]
+    if filenm2.endswith(".csv"):
+        return "excel"
+    elif filenm2.endswith(".txt"):
+        return "excel-tab"
+    raise ValueError, "unsupported file type: %r" % filenm
+
+
+def unlink_if_shared(filenm):
     """
-    returns a fileobj and csv.writer
+    remove filenm if it is a regular file with other hard links
+
+    Opening such a file for writing would also overwrite the other links
+    (e.g. a result cache entry served by hard link).
+    """
+    if os.path.isfile(filenm) and os.stat(filenm).st_nlink > 1:
+        os.remove(filenm)
+
+
+def copy_if_shared(filenm):
+    """
+    give filenm a copy of its contents of its own if it has other hard links
+
+    Like unlink_if_shared(), for a file about to be appended to or truncated.
+    """
+    if os.path.isfile(filenm) and os.stat(filenm).st_nlink > 1:
+        tmp_filenm = "%s.%d.tmp" % (filenm, os.getpid())
+        shutil.copy2(filenm, tmp_filenm)
+        os.rename(tmp_filenm, filenm)
+
+
+def open_output(filenm, compress_level=None, compress_threads=1, append=False):
+    """
+    returns a writable fileobj for filenm, compressed as per its extension
+
+    With append, output goes after filenm's contents; compressed output
+    then starts a new gzip member (bzip2/xz stream, zstd/lz4 frame).
     """
     # stdout is a special file...
     if filenm.startswith("stdout"):
         fp1 = sys.stdout
+    elif append:
+        copy_if_shared(filenm)
+        fp1 = open(filenm, "ab")
     else:
-        fp1 = open(filenm, "w")
-    # May need to wrap in a GzipFile...
-    if filenm.endswith(".gz"):
-        fp2 = gzip.GzipFile(fileobj=fp1, mode="w", compresslevel=6)
-        filenm2 = filenm[:-3]
-    else:
-        fp2 = fp1
-        filenm2 = filenm
-    # Pick CSV or tab-delim output...
-    if filenm2.endswith(".csv"):
-        wtr = UnicodeWriter(fp2, dialect="excel")
-    elif filenm2.endswith(".txt"):
-        wtr = UnicodeWriter(fp2, dialect="excel-tab")
-    else:
-        raise ValueError, "unsupported file type: %r" % filenm
-    # Return the file object for closing and the writer for writing...
-    return fp2, wtr
+        unlink_if_shared(filenm)
+        fp1 = open(filenm, "wb")
+    # May need to wrap in a compressor picked by extension...
+    codec = compress.split_codec(filenm)[1]
+    if codec is not None:
+        return compress.open_compressed(fp1, codec, level=compress_level, threads=compress_threads)
+    return fp1
 
 
+def wait_result(result):
+    """
+    return the value of a multiprocessing AsyncResult, handling signals meanwhile
+    """
+    while not result.ready():
+        # A timed wait, so signals are handled meanwhile; an untimed one
+        # can't be interrupted in Python 2.
+        result.wait(0.5)
+    return result.get()